@@ -0,0 +1,345 @@
+# loadtest/driver.py
+"""
+离线压测：并发打开 N 个 SSE 流（/api/animate/stream、/api/devtools/run_manim_stream），
+统计完成耗时与首个事件耗时的 p50/p95/p99、吞吐量、错误数，以及服务端事件循环延迟。
+
+- 默认自行启动 stub_llm.py 与应用（uvicorn main:app），应用环境：RENDER_BACKEND=fake、DB_BACKEND=sqlite（临时文件）、
+  LLM_BASE_URL 指向桩服务、关闭高清升级与限流（所有请求来自同一 IP）；不需要 MySQL、LaTeX、ffmpeg 或外网，可在 CI 中运行
+- --url 时直接压测已运行的服务（不启动任何进程）
+- 每个请求的公式 / 代码都带本次运行的 ID，代码缓存与渲染缓存不会命中
+- 事件循环延迟取自 /metrics 中 <前缀>_event_loop_lag_seconds 直方图在压测前后的差值（按桶上界估算分位数）
+- 取基线之前先发 --warmup 个不计入统计的请求，再等待启动期的后台工作（验证码池、教学案例封面等）结束：
+  超过 SETTLE_LAG 秒的延迟观测数连续 SETTLE_QUIET 次抓取不再增加，最多等 --settle-timeout 秒
+- --max-p95 / --max-loop-lag-p99 / --max-error-rate 任一超限时以退出码 1 结束
+
+    python loadtest/driver.py -n 40 -c 20 --render-seconds 1
+    python loadtest/driver.py --url http://127.0.0.1:8000 --endpoint devtools -n 10
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import uuid
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import httpx
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+STUB_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_llm.py")
+
+FINAL_EVENTS = ("complete", "error")
+
+DEVTOOLS_CODE = '''from manim import *
+
+
+class GenScene(Scene):
+    def construct(self):
+        self.play(Write(Text("Load test {tag}")))
+'''
+
+# 稳定判定：超过该值的事件循环延迟视为后台工作造成的卡顿
+SETTLE_LAG = 0.05
+SETTLE_QUIET = 3
+
+_BUCKET_RE = re.compile(r'^(\w+)_bucket\{(?:[^}]*,)?le="([^"]+)"[^}]*\}\s+(\S+)$')
+
+
+def percentile(values, q):
+    """最近秩法分位数；空列表返回 None。"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+
+def parse_histogram(text, name):
+    """从 Prometheus 文本中取出无标签直方图的累计桶 {上界: 次数}。"""
+    buckets = {}
+    for line in text.splitlines():
+        m = _BUCKET_RE.match(line)
+        if m and m.group(1) == name:
+            bound = float("inf") if m.group(2) == "+Inf" else float(m.group(2))
+            buckets[bound] = float(m.group(3))
+    return buckets
+
+
+def histogram_quantile(before, after, q):
+    """两次抓取之间新增观测的 q 分位数（所在桶的上界）；没有新增观测时返回 None。"""
+    delta = sorted((bound, after[bound] - before.get(bound, 0)) for bound in after)
+    if not delta or delta[-1][1] <= 0:
+        return None
+    target = q / 100 * delta[-1][1]
+    for bound, count in delta:
+        if count >= target:
+            return bound
+    return delta[-1][0]
+
+
+class StreamResult:
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.status = None
+        self.outcome = None  # complete / error / rejected / http_error / incomplete / exception
+        self.first_event = None
+        self.total = None
+        self.events = 0
+        self.detail = ""
+
+
+async def run_stream(client, endpoint, payload, timeout):
+    """打开一个 SSE 流直到第一个 complete/error 事件（之后的高清升级事件不计入）。"""
+    result = StreamResult(endpoint)
+    path = "/api/animate/stream" if endpoint == "animate" else "/api/devtools/run_manim_stream"
+    start = time.perf_counter()
+    try:
+        async with client.stream("POST", path, json=payload, timeout=timeout) as resp:
+            result.status = resp.status_code
+            if resp.status_code == 429:
+                result.outcome = "rejected"
+                return result
+            if resp.status_code != 200:
+                result.outcome = "http_error"
+                result.detail = (await resp.aread()).decode("utf-8", "replace")[:200]
+                return result
+            async for line in resp.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                if result.first_event is None:
+                    result.first_event = time.perf_counter() - start
+                result.events += 1
+                event = json.loads(line[5:])
+                kind = event.get("step") or event.get("type")
+                if kind in FINAL_EVENTS:
+                    result.outcome = kind
+                    if kind == "error":
+                        result.detail = str(event.get("message", ""))[:200]
+                    break
+            else:
+                result.outcome = "incomplete"
+    except Exception as e:
+        result.outcome = "exception"
+        result.detail = f"{type(e).__name__}: {e}"
+    result.total = time.perf_counter() - start
+    return result
+
+
+def make_payload(endpoint, run_id, i):
+    tag = f"{run_id}-{i}"
+    if endpoint == "animate":
+        return {"matrixA": f"x^{{{i}}} + {run_id}", "matrixB": "", "operation": "formular"}
+    return {"code": DEVTOOLS_CODE.format(tag=tag)}
+
+
+async def scrape_metrics(client, token):
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    try:
+        resp = await client.get("/metrics", headers=headers, timeout=10)
+        return resp.text if resp.status_code == 200 else ""
+    except httpx.HTTPError:
+        return ""
+
+
+def slow_observations(buckets, threshold=SETTLE_LAG):
+    """直方图中大于 threshold 的观测数。"""
+    if not buckets:
+        return 0
+    below = max([count for bound, count in buckets.items() if bound <= threshold] or [0])
+    return buckets.get(float("inf"), 0) - below
+
+
+async def settle(client, token, lag_name, timeout, interval=1.0):
+    """等待事件循环延迟稳定：慢观测数连续 SETTLE_QUIET 次抓取不变时返回 True，超时返回 False。"""
+    deadline = time.monotonic() + timeout
+    last, quiet = None, 0
+    while time.monotonic() < deadline:
+        slow = slow_observations(parse_histogram(await scrape_metrics(client, token), lag_name))
+        quiet = quiet + 1 if slow == last else 0
+        if quiet >= SETTLE_QUIET:
+            return True
+        last = slow
+        await asyncio.sleep(interval)
+    return False
+
+
+async def run_load(base_url, endpoints, total, concurrency, timeout, token, prefix, warmup=0, settle_timeout=0):
+    run_id = uuid.uuid4().hex[:8]
+    lag_name = f"{prefix}_event_loop_lag_seconds"
+    limits = httpx.Limits(max_connections=concurrency + 2, max_keepalive_connections=concurrency + 2)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits) as client:
+        # 预热：不计入统计，标签与正式请求不同，不会让正式请求命中缓存
+        await asyncio.gather(*(run_stream(client, endpoints[i % len(endpoints)],
+                                          make_payload(endpoints[i % len(endpoints)], f"warmup-{run_id}", i), timeout)
+                               for i in range(warmup)))
+        settled = await settle(client, token, lag_name, settle_timeout) if settle_timeout > 0 else None
+        before = parse_histogram(await scrape_metrics(client, token), lag_name)
+        sem = asyncio.Semaphore(concurrency)
+
+        async def one(i):
+            endpoint = endpoints[i % len(endpoints)]
+            async with sem:
+                return await run_stream(client, endpoint, make_payload(endpoint, run_id, i), timeout)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(one(i) for i in range(total)))
+        elapsed = time.perf_counter() - start
+        after = parse_histogram(await scrape_metrics(client, token), lag_name)
+    return results, elapsed, before, after, settled
+
+
+def summarize(results, elapsed, lag_before, lag_after, settled=None):
+    report = {"requests": len(results), "elapsed": round(elapsed, 3), "settled": settled, "endpoints": {}}
+    for endpoint in sorted({r.endpoint for r in results}):
+        rs = [r for r in results if r.endpoint == endpoint]
+        done = [r.total for r in rs if r.outcome == "complete"]
+        first = [r.first_event for r in rs if r.first_event is not None]
+        outcomes = {}
+        for r in rs:
+            outcomes[r.outcome] = outcomes.get(r.outcome, 0) + 1
+        report["endpoints"][endpoint] = {
+            "outcomes": outcomes,
+            "complete_seconds": {f"p{q}": _round(percentile(done, q)) for q in (50, 95, 99)},
+            "first_event_seconds": {f"p{q}": _round(percentile(first, q)) for q in (50, 95, 99)},
+            "throughput_per_second": round(len(done) / elapsed, 3) if elapsed else None,
+            "errors": [r.detail for r in rs if r.outcome != "complete" and r.detail][:5],
+        }
+    completed = sum(1 for r in results if r.outcome == "complete")
+    report["throughput_per_second"] = round(completed / elapsed, 3) if elapsed else None
+    report["error_rate"] = round(1 - completed / len(results), 4) if results else 0.0
+    report["complete_p95"] = _round(percentile([r.total for r in results if r.outcome == "complete"], 95))
+    report["event_loop_lag_seconds"] = {f"p{q}": histogram_quantile(lag_before, lag_after, q) for q in (50, 95, 99)} \
+        if lag_after else None
+    return report
+
+
+def _round(value):
+    return None if value is None else round(value, 3)
+
+
+def check_thresholds(report, args):
+    failures = []
+    if report["error_rate"] > args.max_error_rate:
+        failures.append(f"error rate {report['error_rate']} > {args.max_error_rate}")
+    if args.max_p95 is not None and (report["complete_p95"] is None or report["complete_p95"] > args.max_p95):
+        failures.append(f"complete p95 {report['complete_p95']} > {args.max_p95}")
+    lag = (report["event_loop_lag_seconds"] or {}).get("p99")
+    if args.max_loop_lag_p99 is not None and (lag is None or lag > args.max_loop_lag_p99):
+        failures.append(f"event loop lag p99 {lag} > {args.max_loop_lag_p99}")
+    return failures
+
+
+def _wait_ready(url, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{proc.args} exited with {proc.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout}s")
+
+
+def start_stack(args, workdir):
+    """启动桩服务与应用，返回 (base_url, 进程列表)。"""
+    stub = subprocess.Popen([sys.executable, STUB_SCRIPT, "--port", str(args.stub_port),
+                             "--latency", str(args.llm_latency), "--chunk-delay", str(args.chunk_delay)])
+    procs = [stub]
+    env = dict(os.environ)
+    env.update({
+        "RENDER_BACKEND": "fake",
+        "RENDER_FAKE_SECONDS": str(args.render_seconds),
+        "LLM_BASE_URL": f"http://127.0.0.1:{args.stub_port}/v1",
+        "ALIYUN_KEY": env.get("ALIYUN_KEY") or "sk-loadtest",
+        "DB_BACKEND": "sqlite",
+        "SQLITE_PATH": os.path.join(workdir, "loadtest.sqlite3"),
+        "STORE_SQLITE_PATH": os.path.join(workdir, "kv_store.sqlite3"),
+        # 渲染输出、缓存索引与 manim 中间产物都写到临时目录，不留在仓库的 static/videos 里
+        "VIDEO_DIR": os.path.join(workdir, "videos"),
+        "MANIM_MEDIA_DIR": os.path.join(workdir, "manim_media"),
+        "GALLERY_POSTERS": "0",
+        "RENDER_UPGRADE_QUALITY": "",
+        "RATE_LIMIT_ENABLED": "0",
+        "METRICS_TOKEN": "",
+    })
+    env.update(dict(item.split("=", 1) for item in args.env))
+    try:
+        _wait_ready(f"http://127.0.0.1:{args.stub_port}/stats", stub)
+        app = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port),
+                                "--log-level", "warning"], cwd=APP_DIR, env=env)
+        procs.append(app)
+        base_url = f"http://127.0.0.1:{args.port}"
+        _wait_ready(f"{base_url}/metrics", app)
+    except Exception:
+        stop_stack(procs)
+        raise
+    return base_url, procs
+
+
+def stop_stack(procs):
+    for proc in procs:
+        proc.terminate()
+    for proc in procs:
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SSE 渲染接口离线压测")
+    parser.add_argument("--url", help="压测已运行的服务，不启动桩服务与应用")
+    parser.add_argument("--endpoint", choices=("animate", "devtools", "both"), default="both")
+    parser.add_argument("-n", "--requests", type=int, default=20, help="请求总数")
+    parser.add_argument("-c", "--concurrency", type=int, default=10, help="同时打开的 SSE 流数")
+    parser.add_argument("--timeout", type=float, default=300, help="单个流的超时秒数")
+    parser.add_argument("--warmup", type=int, default=2, help="取基线之前不计入统计的预热请求数")
+    parser.add_argument("--settle-timeout", type=float, default=30,
+                        help="取基线之前等待事件循环延迟稳定的最长秒数，0 为不等待")
+    parser.add_argument("--port", type=int, default=8900, help="自行启动的应用端口")
+    parser.add_argument("--stub-port", type=int, default=8901)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--chunk-delay", type=float, default=0.02)
+    parser.add_argument("--render-seconds", type=float, default=2, help="RENDER_FAKE_SECONDS")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="额外传给应用的环境变量")
+    parser.add_argument("--metrics-token", default=os.getenv("METRICS_TOKEN", ""))
+    parser.add_argument("--metrics-prefix", default=os.getenv("METRICS_PREFIX", "wiscomper"))
+    parser.add_argument("--max-p95", type=float, help="完成耗时 p95 上限（秒）")
+    parser.add_argument("--max-loop-lag-p99", type=float, help="事件循环延迟 p99 上限（秒）")
+    parser.add_argument("--max-error-rate", type=float, default=0.0)
+    parser.add_argument("--json", help="报告另存为 JSON 文件")
+    args = parser.parse_args()
+
+    endpoints = ("animate", "devtools") if args.endpoint == "both" else (args.endpoint,)
+    procs = []
+    with tempfile.TemporaryDirectory(prefix="loadtest-") as workdir:
+        try:
+            if args.url:
+                base_url = args.url.rstrip("/")
+            else:
+                base_url, procs = start_stack(args, workdir)
+                args.metrics_token = ""
+            results, elapsed, before, after, settled = asyncio.run(run_load(
+                base_url, endpoints, args.requests, args.concurrency, args.timeout,
+                args.metrics_token, args.metrics_prefix, args.warmup, args.settle_timeout))
+        finally:
+            stop_stack(procs)
+
+    report = summarize(results, elapsed, before, after, settled)
+    failures = check_thresholds(report, args)
+    report["failures"] = failures
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# loadtest/stub_llm.py
+"""
+压测用的 OpenAI 兼容大模型桩服务：/v1/chat/completions（流式与非流式），返回固定模板的 Manim 场景代码。
+
+- --latency：返回首个响应前的等待秒数（模拟首 token 延迟）；--chunk-delay：流式输出每行之间的间隔
+- 每次返回的代码带 <运行 ID>-<序号> 文本，渲染缓存不会命中，每个请求都真正走一遍渲染
+- 只依赖 fastapi / uvicorn；应用以 LLM_BASE_URL=http://127.0.0.1:<端口>/v1 指向这里
+
+    python loadtest/stub_llm.py --port 8901 --latency 0.5 --chunk-delay 0.02
+"""
+import time
+import uuid
+import json
+import asyncio
+import argparse
+import itertools
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+SCENE_TEMPLATE = '''```python
+from manim import *
+
+
+class GenScene(Scene):
+    def construct(self):
+        title = Text("Load test {tag}")
+        self.play(Write(title))
+        self.wait(1)
+```
+'''
+
+RUN_ID = uuid.uuid4().hex[:8]
+
+app = FastAPI()
+app.state.latency = 0.0
+app.state.chunk_delay = 0.0
+_counter = itertools.count(1)
+_requests = {"stream": 0, "non_stream": 0}
+
+
+def _completion_chunk(completion_id, model, delta, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "stub")
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    content = SCENE_TEMPLATE.format(tag=f"{RUN_ID}-{next(_counter)}")
+    await asyncio.sleep(app.state.latency)
+
+    if not body.get("stream"):
+        _requests["non_stream"] += 1
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+    _requests["stream"] += 1
+
+    async def events():
+        yield f"data: {json.dumps(_completion_chunk(completion_id, model, {'role': 'assistant', 'content': ''}))}\n\n"
+        for line in content.splitlines(keepends=True):
+            yield f"data: {json.dumps(_completion_chunk(completion_id, model, {'content': line}))}\n\n"
+            if app.state.chunk_delay:
+                await asyncio.sleep(app.state.chunk_delay)
+        yield f"data: {json.dumps(_completion_chunk(completion_id, model, {}, 'stop'))}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/stats")
+async def stats():
+    return {"run_id": RUN_ID, **_requests}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI 兼容的大模型桩服务（压测用）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--latency", type=float, default=0.5, help="首个响应前的等待秒数")
+    parser.add_argument("--chunk-delay", type=float, default=0.02, help="流式输出每行之间的间隔秒数")
+    args = parser.parse_args()
+    app.state.latency = args.latency
+    app.state.chunk_delay = args.chunk_delay
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
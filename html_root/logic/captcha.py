@@ -1,48 +1,64 @@
+import os
+import sys
+import time
+import queue
 import random
+import logging
+import threading
+from functools import lru_cache
 from PIL import Image, ImageDraw, ImageFont, ImageFilter
 from io import BytesIO
 
+logger = logging.getLogger(__name__)
 
-# --- 辅助函数：生成验证码 (Linux 字体修复版) ---
-def generate_captcha_image_bytes():
-    # 去除易混淆字符 (0, O, I, 1, L)
-    chars = 'ABCDEFGHJKMNPQRSTUVWXYZ23456789'
-    text = ''.join(random.choices(chars, k=4))
+# 预生成验证码队列长度；0 表示不预生成，每次请求现场绘制
+CAPTCHA_POOL_SIZE = int(os.getenv("CAPTCHA_POOL_SIZE", 32))
+# 后台补充时每绘制一张后休眠的秒数：绘制占用 GIL，连续绘制会拖慢事件循环
+CAPTCHA_REFILL_INTERVAL = float(os.getenv("CAPTCHA_REFILL_INTERVAL", 0.05))
 
-    width, height = 120, 50  # 保持原尺寸
-    image = Image.new('RGB', (width, height), color=(255, 255, 255))
-    draw = ImageDraw.Draw(image)
+# 去除易混淆字符 (0, O, I, 1, L)
+CHARS = 'ABCDEFGHJKMNPQRSTUVWXYZ23456789'
 
-    # -------------------------------------------------------------
-    # [核心修改]：解决 Linux 上字体加载失败导致字体极小的问题
-    # -------------------------------------------------------------
-    font = None
-    # 优先尝试的字体列表（包含 Windows 的 Arial 和 Linux 常见字体）
-    font_list = [
-        "arial.ttf",  # Windows
-        "DejaVuSans.ttf",  # Linux (CentOS/Ubuntu 常见)
-        "LiberationSans-Regular.ttf",  # Linux
-        "FreeSans.ttf",  # Linux
-        "/usr/share/fonts/dejavu/DejaVuSans.ttf",  # 绝对路径尝试
-        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
-    ]
-
-    for font_name in font_list:
+# 优先尝试的字体列表（包含 Windows 的 Arial 和 Linux 常见字体）
+FONT_LIST = [
+    "arial.ttf",  # Windows
+    "DejaVuSans.ttf",  # Linux (CentOS/Ubuntu 常见)
+    "LiberationSans-Regular.ttf",  # Linux
+    "FreeSans.ttf",  # Linux
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",  # 绝对路径尝试
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+]
+
+
+# -------------------------------------------------------------
+# [核心修改]：解决 Linux 上字体加载失败导致字体极小的问题
+# 字体只在第一次用到时查找并加载，之后复用同一个对象
+# -------------------------------------------------------------
+@lru_cache(maxsize=1)
+def _load_font(size=28):
+    for font_name in FONT_LIST:
         try:
-            font = ImageFont.truetype(font_name, 28)  # 保持原字号 28
-            break
-        except:
+            return ImageFont.truetype(font_name, size)  # 保持原字号 28
+        except OSError:
             continue
 
     # 如果所有字体都找不到，尝试使用 Pillow 新版的默认字体大小调整功能
-    if font is None:
-        try:
-            # Pillow 10.0.0+ 支持设置 load_default 的大小
-            font = ImageFont.load_default(size=28)
-        except:
-            # 旧版 Pillow 只能回退到小字体 (这是之前看不清的根源，但已经尽力了)
-            font = ImageFont.load_default()
-    # -------------------------------------------------------------
+    try:
+        # Pillow 10.0.0+ 支持设置 load_default 的大小
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        # 旧版 Pillow 只能回退到小字体 (这是之前看不清的根源，但已经尽力了)
+        return ImageFont.load_default()
+
+
+def _render_captcha():
+    """绘制一张验证码，返回 (文本, PNG 字节)。"""
+    text = ''.join(random.choices(CHARS, k=4))
+
+    width, height = 120, 50  # 保持原尺寸
+    image = Image.new('RGB', (width, height), color=(255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    font = _load_font()
 
     # 绘制干扰线 (保持原样)
     for _ in range(5):
@@ -80,12 +96,108 @@ def generate_captcha_image_bytes():
 
     buf = BytesIO()
     image.save(buf, format="PNG")
-    buf.seek(0)
-    return text, buf
+    return text, buf.getvalue()
+
+
+# --- 辅助函数：生成验证码 (Linux 字体修复版) ---
+def generate_captcha_image_bytes():
+    text, png = _render_captcha()
+    return text, BytesIO(png)
+
+
+class CaptchaPool:
+    """后台线程预先绘制验证码，放入有界队列；请求只需取出一张。队列空时现场绘制，不会阻塞请求。
+    余量低于一半时才补充，且每绘制一张休眠 refill_interval 秒，避免集中绘制抢占 GIL、造成事件循环卡顿。"""
+
+    def __init__(self, size=CAPTCHA_POOL_SIZE, refill_interval=CAPTCHA_REFILL_INTERVAL):
+        self.size = size
+        self.refill_interval = refill_interval
+        self.low_water = size // 2
+        self._queue = queue.Queue(maxsize=max(size, 1))
+        self._thread = None
+        self._stop = threading.Event()
+        self._refill = threading.Event()
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        if self.size <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._refill.set()
+        self._thread = threading.Thread(target=self._produce, name="captcha-producer", daemon=True)
+        self._thread.start()
+
+    def _produce(self):
+        while not self._stop.is_set():
+            # 等待余量降到低水位（get 中触发），定期醒来检查是否需要退出
+            if not self._refill.wait(1):
+                continue
+            self._refill.clear()
+            while not self._stop.is_set() and not self._queue.full():
+                try:
+                    self._queue.put_nowait(_render_captcha())
+                except queue.Full:
+                    break
+                except Exception as e:
+                    logger.error(f"Captcha producer error: {e}")
+                    self._stop.wait(1)
+                    continue
+                self._stop.wait(self.refill_interval)
+
+    def get(self):
+        """返回 (文本, PNG 字节)。每张验证码只会被取出一次。"""
+        try:
+            item = self._queue.get_nowait()
+            self.hits += 1
+        except queue.Empty:
+            self.misses += 1
+            item = _render_captcha()
+        if self.size > 0 and self._queue.qsize() <= self.low_water:
+            self._refill.set()
+        return item
+
+    def stop(self):
+        self._stop.set()
+        self._refill.set()
+
+    def stats(self):
+        return {"size": self.size, "ready": self._queue.qsize(), "hits": self.hits, "misses": self.misses}
+
+
+pool = CaptchaPool()
+
+
+def _benchmark(n=500):
+    """对比每次请求现场绘制（含逐个查找字体）与从预生成队列取出的吞吐。"""
+    def legacy():
+        _load_font.cache_clear()  # 模拟改造前：每次请求都重新查找、加载字体
+        return _render_captcha()
+
+    for name, fn in (("inline, font lookup per call", legacy), ("inline, cached font", _render_captcha)):
+        start = time.perf_counter()
+        for _ in range(n):
+            fn()
+        elapsed = time.perf_counter() - start
+        print(f"{name:32s} {n / elapsed:10.1f} req/s  ({elapsed / n * 1000:.2f} ms/req)")
+
+    bench_pool = CaptchaPool(size=n)
+    for _ in range(n):
+        bench_pool._queue.put(_render_captcha())  # 预先填满，只测取出的开销
+    start = time.perf_counter()
+    for _ in range(n):
+        bench_pool.get()
+    elapsed = time.perf_counter() - start
+    print(f"{'pre-generated pool':32s} {n / elapsed:10.1f} req/s  ({elapsed / n * 1000:.4f} ms/req)")
+
 
 if __name__ == '__main__':
+    if "--bench" in sys.argv:
+        # python -m logic.captcha --bench
+        _benchmark()
+        sys.exit(0)
     # 本地测试代码
     code, data = generate_captcha_image_bytes()
     with open("test_captcha.png", "wb") as f:
         f.write(data.getvalue())
-    print(f"Generated captcha: {code}")
\ No newline at end of file
+    print(f"Generated captcha: {code}")
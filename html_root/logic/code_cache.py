@@ -0,0 +1,180 @@
+# logic/code_cache.py
+"""
+大模型生成代码缓存：相同的 (公式A, 公式B, 运算类型, 提示词版本) 直接复用已成功渲染过的 Manim 代码，
+跳过 qwen-plus 调用。
+
+- 公式先做 LaTeX 规范化（空白、\\left/\\right、间距命令），写法差异不影响命中；
+  \\text{...} 等文本模式分组内的空格有意义，只把连续空白合并为一个
+- 只缓存渲染成功的代码，由调用方在渲染成功后 put
+- 内存层为 LRU + TTL；设置 CODE_CACHE_SQLITE 后额外写入 SQLite，重启或多进程间共享
+"""
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import closing
+
+from logic.prompt import prompt_version
+
+logger = logging.getLogger(__name__)
+
+CODE_CACHE_MAX_ENTRIES = int(os.getenv("CODE_CACHE_MAX_ENTRIES", 512))
+CODE_CACHE_TTL = int(os.getenv("CODE_CACHE_TTL", 7 * 86400))
+CODE_CACHE_SQLITE = os.getenv("CODE_CACHE_SQLITE", "")
+
+# 只影响排版间距、不影响数学含义的命令
+# (?<!\\) 避免误伤矩阵换行符 \\
+_SPACING_RE = re.compile(r"(?<!\\)\\(?:quad|qquad|,|;|:|!|\s)|~")
+_LEFT_RIGHT_RE = re.compile(r"(?<!\\)\\(?:left|right|bigl|bigr|Bigl|Bigr|big|Big)(?![A-Za-z])")
+_CONTROL_WORD_SPACE_RE = re.compile(r"(\\[A-Za-z]+)\s+(?=[A-Za-z])")
+# 参数按文本排版的命令，分组内的空格是内容的一部分
+_TEXT_GROUP_RE = re.compile(
+    r"(?<!\\)\\(text|textrm|textbf|textit|textsf|texttt|textnormal|mathrm|operatorname\*?|mbox|hbox)\s*\{")
+
+
+def _normalize_math(s):
+    s = _SPACING_RE.sub(" ", s)
+    s = _LEFT_RIGHT_RE.sub("", s)
+    # 控制词后紧跟字母时空格有意义 (\alpha b ≠ \alphab)，先占位保留，其余空白全部去掉
+    s = _CONTROL_WORD_SPACE_RE.sub("\\1\0", s)
+    s = re.sub(r"\s+", "", s)
+    return s.replace("\0", " ")
+
+
+def _group_end(latex, start):
+    """start 为 { 之后的位置，返回匹配的 } 之后的位置；不配对时返回 None。"""
+    depth, i = 1, start
+    while i < len(latex):
+        ch = latex[i]
+        if ch == "\\":
+            i += 2
+            continue
+        if ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return None
+
+
+def normalize_latex(latex):
+    if not latex:
+        return ""
+    parts, pos = [], 0
+    for m in _TEXT_GROUP_RE.finditer(latex):
+        if m.start() < pos:  # 位于上一个文本分组内部
+            continue
+        end = _group_end(latex, m.end())
+        if end is None:
+            break
+        parts.append(_normalize_math(latex[pos:m.start()]))
+        text = re.sub(r"\s+", " ", latex[m.end():end - 1])
+        parts.append("\\" + m.group(1) + "{" + text + "}")
+        pos = end
+    parts.append(_normalize_math(latex[pos:]))
+    return "".join(parts)
+
+
+def make_key(latex_a, latex_b, operation, op_desc):
+    raw = "\0".join([normalize_latex(latex_a), normalize_latex(latex_b), operation or "", prompt_version(op_desc)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class CodeCache:
+    def __init__(self, max_entries=CODE_CACHE_MAX_ENTRIES, ttl=CODE_CACHE_TTL, sqlite_path=CODE_CACHE_SQLITE):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sqlite_path = sqlite_path
+        self._lock = threading.Lock()
+        # key -> (code, expires_at)
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if self.sqlite_path:
+            self._init_sqlite()
+
+    def _connect(self):
+        return sqlite3.connect(self.sqlite_path, timeout=5)
+
+    def _init_sqlite(self):
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS code_cache ("
+                    "cache_key TEXT PRIMARY KEY, code TEXT NOT NULL, expires_at REAL NOT NULL)"
+                )
+        except sqlite3.Error as e:
+            logger.error(f"Code cache sqlite init error: {e}")
+            self.sqlite_path = ""
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            item = self._entries.get(key)
+            if item and item[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            if item:
+                del self._entries[key]
+        code = self._sqlite_get(key, now)
+        with self._lock:
+            if code is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._put_memory(key, code, now + self.ttl)
+        return code
+
+    def put(self, key, code):
+        if not code:
+            return
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._put_memory(key, code, expires_at)
+        self._sqlite_put(key, code, expires_at)
+
+    def _put_memory(self, key, code, expires_at):
+        self._entries[key] = (code, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _sqlite_get(self, key, now):
+        if not self.sqlite_path:
+            return None
+        try:
+            with closing(self._connect()) as conn, conn:
+                row = conn.execute(
+                    "SELECT code FROM code_cache WHERE cache_key = ? AND expires_at > ?", (key, now)
+                ).fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"Code cache sqlite read error: {e}")
+            return None
+
+    def _sqlite_put(self, key, code, expires_at):
+        if not self.sqlite_path:
+            return
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO code_cache (cache_key, code, expires_at) VALUES (?, ?, ?)",
+                    (key, code, expires_at)
+                )
+                conn.execute("DELETE FROM code_cache WHERE expires_at <= ?", (time.time(),))
+        except sqlite3.Error as e:
+            logger.error(f"Code cache sqlite write error: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+cache = CodeCache()
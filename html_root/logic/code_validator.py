@@ -0,0 +1,218 @@
+# logic/code_validator.py
+"""
+大模型流式输出 Manim 代码时的增量校验：每收到完整的一行就用 ast 检查当前源码，
+一旦 GenScene.construct（及其调用到的本类辅助方法）已经完整写出，就可以提前结束生成。
+
+判定"完整"的条件：
+  1. 最新开始的一行之前的全部源码能被 ast 解析
+  2. 其中存在 class GenScene 且包含 construct 方法
+  3. 最新一行的缩进不深于 construct 的 def，说明 construct 的方法体已经闭合
+  4. 类中各方法通过 self.xxx(...) 调用的非 Scene 内置方法都已定义
+  5. 最新一行若回到模块顶层，它定义的名字（类之后的辅助函数、常量、import）没有被已写出的代码引用，
+     否则继续接收，直到出现未被引用的顶层语句或生成结束
+
+preflight() 为渲染前的静态预检（毫秒级）：语法/编译、GenScene(Scene).construct、MathTex 中的非 ASCII 字符。
+预检失败的信息直接交给自动修正提示词，不必等一次完整渲染失败。
+"""
+import os
+import re
+import ast
+
+# 静态预检通过后，是否再在常驻 worker 中以 dry_run（不写出视频、跳过动画帧）执行一遍 construct
+PREFLIGHT_DRY_RUN = os.getenv("PREFLIGHT_DRY_RUN", "1") == "1"
+
+# 参数会交给 LaTeX 编译的类，默认模板下不支持中文等非 ASCII 字符
+LATEX_MOBJECTS = {"MathTex", "Tex", "SingleStringMathTex"}
+
+# construct 中常见的 Scene 自带方法，不需要在生成代码里定义
+SCENE_METHODS = {
+    "play", "wait", "add", "remove", "clear", "bring_to_front", "bring_to_back",
+    "add_foreground_mobject", "add_foreground_mobjects", "remove_foreground_mobject",
+    "remove_foreground_mobjects", "wait_until", "pause", "next_section", "add_sound",
+    "add_subcaption", "get_top_level_mobjects", "get_mobject_family_members", "replace",
+    "construct", "setup", "tear_down", "move_camera", "set_camera_orientation",
+    "begin_ambient_camera_rotation", "stop_ambient_camera_rotation", "add_fixed_in_frame_mobjects",
+    "add_fixed_orientation_mobjects", "remove_fixed_in_frame_mobjects", "interactive_embed",
+}
+
+_FENCE_RE = re.compile(r"^\s*```[a-zA-Z]*\s*$")
+
+
+def strip_code_fences(text):
+    """去掉 Markdown 代码块标记，与原先的 replace("```python", "").replace("```", "") 等价但按行处理。"""
+    lines = [line for line in text.split("\n") if not _FENCE_RE.match(line)]
+    return "\n".join(lines).replace("```python", "").replace("```", "")
+
+
+def _indent(line):
+    return len(line) - len(line.lstrip(" \t"))
+
+
+def _find_scene(tree, class_name):
+    for node in tree.body:
+        if isinstance(node, ast.ClassDef) and node.name == class_name:
+            return node
+    return None
+
+
+def _undefined_self_calls(cls):
+    defined = {n.name for n in cls.body if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef))}
+    missing = set()
+    for node in ast.walk(cls):
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute)
+                and isinstance(node.func.value, ast.Name) and node.func.value.id == "self"):
+            name = node.func.attr
+            if name not in defined and name not in SCENE_METHODS:
+                missing.add(name)
+    return missing
+
+
+def _loaded_names(tree):
+    return {n.id for n in ast.walk(tree) if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load)}
+
+
+_TOP_DEF_RE = re.compile(r"^(?:async\s+def|def|class)\s+(\w+)")
+_TOP_ASSIGN_RE = re.compile(r"^(\w+)\s*(?::[^=]*)?=(?!=)")
+
+
+def _top_level_names(line):
+    """模块顶层一行定义的名字：def / class 与跨行赋值只看首行，import 与单行赋值直接解析，
+    if / for 等复合语句首行不定义名字；无法判断时返回 None。"""
+    m = _TOP_DEF_RE.match(line)
+    if m:
+        return {m.group(1)}
+    try:
+        tree = ast.parse(line)
+    except SyntaxError:
+        m = _TOP_ASSIGN_RE.match(line)
+        if m:
+            return {m.group(1)}
+        return set() if line.rstrip().endswith(":") else None
+    names = set()
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            names.update((a.asname or a.name).split(".")[0] for a in node.names)
+        elif isinstance(node, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                names.update(n.id for n in ast.walk(target) if isinstance(n, ast.Name))
+    return names
+
+
+def _call_name(node):
+    func = node.func
+    if isinstance(func, ast.Name):
+        return func.id
+    if isinstance(func, ast.Attribute):
+        return func.attr
+    return None
+
+
+def _non_ascii_latex(tree):
+    """找出 MathTex/Tex 参数中含非 ASCII 字符的字符串常量，返回 [(行号, 类名, 字符串)]。"""
+    found = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or _call_name(node) not in LATEX_MOBJECTS:
+            continue
+        for arg in node.args:
+            for sub in ast.walk(arg):
+                if isinstance(sub, ast.Constant) and isinstance(sub.value, str) and not sub.value.isascii():
+                    found.append((sub.lineno, _call_name(node), sub.value))
+    return found
+
+
+def preflight(code, class_name="GenScene", method="construct"):
+    """渲染前的静态预检，返回错误描述列表；空列表表示通过。"""
+    try:
+        tree = ast.parse(code)
+        compile(tree, f"{class_name}.py", "exec")
+    except SyntaxError as e:
+        line = (e.text or "").strip()
+        return [f"SyntaxError: {e.msg} (line {e.lineno}): {line}"]
+    except ValueError as e:
+        return [f"ValueError: {e}"]
+
+    errors = []
+    cls = _find_scene(tree, class_name)
+    if cls is None:
+        errors.append(f"未找到场景类 `class {class_name}(Scene)`")
+    else:
+        base_names = [b.id if isinstance(b, ast.Name) else getattr(b, "attr", "") for b in cls.bases]
+        if not any(name.endswith("Scene") for name in base_names):
+            errors.append(f"`{class_name}` 必须继承 Scene (line {cls.lineno})")
+        if not any(isinstance(n, ast.FunctionDef) and n.name == method for n in cls.body):
+            errors.append(f"`{class_name}` 中缺少 `def {method}(self):`")
+        for name in sorted(_undefined_self_calls(cls)):
+            errors.append(f"调用了未定义的方法 `self.{name}()`")
+    for lineno, name, value in _non_ascii_latex(tree):
+        errors.append(f"line {lineno}: {name} 中包含非 ASCII 字符 {value!r}，LaTeX 无法编译，文字请改用 Text")
+    return errors
+
+
+def format_preflight_errors(errors):
+    """拼成与渲染报错同样用途的文本，供自动修正提示词使用。"""
+    return "代码预检失败：\n" + "\n".join(f"- {e}" for e in errors)
+
+
+class StreamingSceneValidator:
+    def __init__(self, class_name="GenScene", method="construct"):
+        self.class_name = class_name
+        self.method = method
+        self.text = ""
+        self.code = None  # 判定完整后，截取到的最终代码
+        self._checked_lines = 0
+
+    @property
+    def complete(self):
+        return self.code is not None
+
+    def feed(self, delta):
+        """追加一段增量，返回是否已得到完整的场景代码。"""
+        if self.complete:
+            return True
+        self.text += delta
+        if "\n" not in delta:
+            return False
+        lines = strip_code_fences(self.text).split("\n")[:-1]  # 只看已完整的行
+        if len(lines) <= self._checked_lines:
+            return False
+        self._checked_lines = len(lines)
+        return self._check(lines)
+
+    def _check(self, lines):
+        # 最新开始的语句（最后一个非空、非注释行）
+        idx = len(lines) - 1
+        while idx >= 0 and (not lines[idx].strip() or lines[idx].lstrip().startswith("#")):
+            idx -= 1
+        if idx <= 0:
+            return False
+        prefix = "\n".join(lines[:idx])
+        try:
+            tree = ast.parse(prefix)
+        except SyntaxError:
+            return False
+        cls = _find_scene(tree, self.class_name)
+        if cls is None:
+            return False
+        method = next((n for n in cls.body
+                       if isinstance(n, ast.FunctionDef) and n.name == self.method), None)
+        if method is None:
+            return False
+        def_line = lines[method.lineno - 1]
+        if _indent(lines[idx]) > _indent(def_line):
+            return False
+        if _undefined_self_calls(cls):
+            return False
+        if _indent(lines[idx]) == 0:
+            # 回到模块顶层：类之后可能还有被 construct 用到的辅助函数 / 常量，被引用时继续接收
+            names = _top_level_names(lines[idx])
+            if names is None or names & _loaded_names(tree):
+                return False
+        self.code = prefix.rstrip() + "\n"
+        return True
+
+    def result(self):
+        """生成结束（提前或自然结束）后的代码。"""
+        if self.complete:
+            return self.code
+        return strip_code_fences(self.text).strip()
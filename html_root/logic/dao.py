@@ -0,0 +1,525 @@
+# logic/dao.py
+"""
+数据访问层：用户、算式、动画脚本的全部 SQL 集中在这里，路由只调用异步方法，不再直接拿连接/游标。
+
+- DB_BACKEND=mysql（默认）：aiomysql 异步连接池，不阻塞事件循环
+    MYSQL_POOL_SIZE        常驻连接数
+    MYSQL_POOL_OVERFLOW    高峰时可额外创建的连接数（最大连接数 = SIZE + OVERFLOW）
+    MYSQL_ACQUIRE_TIMEOUT  等待空闲连接的秒数，超时抛出 DatabaseBusy（接口返回 503），而不是无限排队
+- DB_BACKEND=sqlite：同一接口的本地实现（SQLITE_PATH），无需 MySQL 即可运行测试与压测
+
+批量接口（bulk_save/bulk_delete）在同一连接、同一事务内用 executemany 完成，逐项返回结果。
+算式与脚本按内容的 SHA-256 (content_hash) 在用户内去重：(user_id, content_hash) 唯一，重复保存直接返回已有记录。
+
+列表接口按 (created_at, id) 键集分页：游标是上一页最后一行的 (created_at, id)，
+配合 (user_id, created_at, id) 复合索引，翻到第几页都只扫描 LIMIT 行，不用 OFFSET。
+
+所有语句都是参数化的固定模板（见 _SQL），值只通过参数传入，不在代码里拼接 SQL。
+注意这不等于服务端预编译：aiomysql 没有 COM_STMT_PREPARE，是在客户端按连接字符集转义参数后
+替换进语句文本再发送；sqlite3 才是真正的预编译语句（参数单独绑定）。
+"""
+import os
+import base64
+import hashlib
+import asyncio
+import logging
+import sqlite3
+import contextlib
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import aiomysql
+
+logger = logging.getLogger(__name__)
+
+DB_BACKEND = os.getenv("DB_BACKEND", "mysql").lower()
+MYSQL_HOST = os.getenv("MYSQL_HOST", "localhost")
+MYSQL_USER = os.getenv("MYSQL_USER", "root")
+MYSQL_PASSWORD = os.getenv("MYSQL_PASSWORD", "password")
+MYSQL_DB = os.getenv("MYSQL_DB", "visdom_db")
+MYSQL_PORT = int(os.getenv("MYSQL_PORT", 3306))
+MYSQL_POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", 10))
+MYSQL_POOL_OVERFLOW = int(os.getenv("MYSQL_POOL_OVERFLOW", 10))
+MYSQL_ACQUIRE_TIMEOUT = float(os.getenv("MYSQL_ACQUIRE_TIMEOUT", 5))
+SQLITE_PATH = os.getenv("SQLITE_PATH", "visdom_db.sqlite3")
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", 50))
+LIST_PAGE_MAX = int(os.getenv("LIST_PAGE_MAX", 200))
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", 500))
+
+
+class DatabaseUnavailable(Exception):
+    """数据库未连接（启动时连接失败或已关闭）。"""
+
+
+class DatabaseBusy(Exception):
+    """连接池在 MYSQL_ACQUIRE_TIMEOUT 内没有空闲连接。"""
+
+
+class InvalidCursor(ValueError):
+    """分页游标无法解析。"""
+
+
+class DuplicateContent(Exception):
+    """修改后的内容与该用户已有的另一条记录相同。"""
+
+
+# MySQL 方言；SQLite 实现中 %s 替换为 ?，LEFT() 替换为 substr()，插入去重见 _SQLITE_SQL
+# {in} 由调用方按参数个数展开为占位符列表
+_SQL = {
+    "get_user": "SELECT id, username, hashed_password, created_at FROM users WHERE username = %s",
+    "user_exists": "SELECT id FROM users WHERE username = %s",
+    "create_user": "INSERT INTO users (username, hashed_password) VALUES (%s, %s)",
+
+    "add_formula": "INSERT INTO formulas (user_id, latex, note, content_hash) VALUES (%s, %s, %s, %s) "
+                   "ON DUPLICATE KEY UPDATE id = id",
+    "formula_ids_by_hash": "SELECT id, content_hash FROM formulas WHERE user_id = %s AND content_hash IN ({in})",
+    "formula_ids": "SELECT id FROM formulas WHERE user_id = %s AND id IN ({in})",
+    "list_formulas": "SELECT id, user_id, latex, note, created_at FROM formulas "
+                     "WHERE user_id = %s ORDER BY created_at DESC, id DESC LIMIT %s",
+    "list_formulas_after": "SELECT id, user_id, latex, note, created_at FROM formulas "
+                           "WHERE user_id = %s AND (created_at < %s OR (created_at = %s AND id < %s)) "
+                           "ORDER BY created_at DESC, id DESC LIMIT %s",
+    "delete_formula": "DELETE FROM formulas WHERE id = %s AND user_id = %s",
+    "update_formula": "UPDATE formulas SET latex = %s, note = %s, content_hash = %s WHERE id = %s AND user_id = %s",
+
+    "add_script": "INSERT INTO animation_scripts (user_id, code, note, content_hash) VALUES (%s, %s, %s, %s) "
+                  "ON DUPLICATE KEY UPDATE id = id",
+    "script_ids_by_hash": "SELECT id, content_hash FROM animation_scripts WHERE user_id = %s AND content_hash IN ({in})",
+    "script_ids": "SELECT id FROM animation_scripts WHERE user_id = %s AND id IN ({in})",
+    "list_scripts": "SELECT id, user_id, note, LEFT(code, 400) AS code_preview, created_at "
+                    "FROM animation_scripts WHERE user_id = %s ORDER BY created_at DESC, id DESC LIMIT %s",
+    "list_scripts_after": "SELECT id, user_id, note, LEFT(code, 400) AS code_preview, created_at "
+                          "FROM animation_scripts "
+                          "WHERE user_id = %s AND (created_at < %s OR (created_at = %s AND id < %s)) "
+                          "ORDER BY created_at DESC, id DESC LIMIT %s",
+    "get_script": "SELECT id, note, code, created_at FROM animation_scripts WHERE id = %s AND user_id = %s",
+    "delete_script": "DELETE FROM animation_scripts WHERE id = %s AND user_id = %s",
+    "script_codes": "SELECT id, code FROM animation_scripts WHERE id > %s ORDER BY id LIMIT %s",
+    "update_script": "UPDATE animation_scripts SET note = %s, code = %s, content_hash = %s "
+                     "WHERE id = %s AND user_id = %s",
+}
+
+# INSERT OR IGNORE 只忽略唯一约束冲突，外键错误照常抛出（与 ON DUPLICATE KEY UPDATE id = id 一致）
+_SQLITE_SQL = {
+    "add_formula": "INSERT OR IGNORE INTO formulas (user_id, latex, note, content_hash) VALUES (?, ?, ?, ?)",
+    "add_script": "INSERT OR IGNORE INTO animation_scripts (user_id, code, note, content_hash) VALUES (?, ?, ?, ?)",
+}
+
+# 与 visdom_db.sql 对应的 SQLite 表结构
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username VARCHAR(255) NOT NULL UNIQUE,
+    hashed_password VARCHAR(255) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS formulas (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id VARCHAR(255) NOT NULL,
+    latex TEXT NOT NULL,
+    note VARCHAR(255),
+    content_hash CHAR(64) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (user_id, content_hash),
+    FOREIGN KEY (user_id) REFERENCES users(username) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS idx_formulas_user_created ON formulas (user_id, created_at, id);
+CREATE TABLE IF NOT EXISTS animation_scripts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id VARCHAR(255) NOT NULL,
+    note VARCHAR(255) DEFAULT '',
+    code MEDIUMTEXT NOT NULL,
+    content_hash CHAR(64) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (user_id, content_hash),
+    FOREIGN KEY (user_id) REFERENCES users(username) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS idx_scripts_user_created ON animation_scripts (user_id, created_at, id);
+"""
+
+
+def _isoformat(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, str):
+        return value.replace(" ", "T", 1)
+    return value
+
+
+def _row(row):
+    if row and "created_at" in row:
+        row["created_at"] = _isoformat(row["created_at"])
+    return row
+
+
+def content_hash(text):
+    """与 MySQL 的 SHA2(text, 256) 一致，便于对存量数据回填。"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _placeholders(stmt, n, mark="%s"):
+    return stmt.replace("{in}", ", ".join([mark] * n))
+
+
+def encode_cursor(row):
+    """由一行的 (created_at, id) 生成不透明游标。"""
+    raw = f"{row['created_at']}|{row['id']}"  # datetime 与 SQLite 文本都是 "YYYY-MM-DD HH:MM:SS"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.rsplit("|", 1)
+        datetime.fromisoformat(created_at)
+        return created_at, int(row_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"invalid cursor: {cursor!r}") from e
+
+
+class _Database:
+    """各后端共用的业务方法；子类只需实现 connect/close、_fetchone/_fetchall/_execute 与 _transaction。"""
+
+    sql = _SQL
+
+    async def connect(self):
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    async def _fetchone(self, name, args):
+        raise NotImplementedError
+
+    async def _fetchall(self, name, args):
+        raise NotImplementedError
+
+    async def _execute(self, name, args):
+        """执行写语句并提交，返回 (rowcount, lastrowid)；唯一约束冲突抛出 DuplicateContent。"""
+        raise NotImplementedError
+
+    def _transaction(self):
+        """异步上下文管理器，产出带 fetchall(name, args, n_in)/executemany(name, seq) 的事务句柄，正常退出时提交。"""
+        raise NotImplementedError
+
+    async def _save_many(self, kind, username, items):
+        """items 为 [(内容, 备注)]。已存在或批内重复的内容不再插入，返回逐项
+        {"index", "status": "created"|"duplicate", "id"}。"""
+        if not items:
+            return []
+        hashes = [content_hash(content) for content, _ in items]
+        unique = list(dict.fromkeys(hashes))
+        results, new_rows, seen = [], [], set()
+        async with self._transaction() as tx:
+            rows = await tx.fetchall(f"{kind}_ids_by_hash", (username, *unique), len(unique))
+            ids = {r["content_hash"]: r["id"] for r in rows}
+            for i, ((content, note), h) in enumerate(zip(items, hashes)):
+                if h in ids or h in seen:
+                    results.append({"index": i, "status": "duplicate"})
+                    continue
+                seen.add(h)
+                new_rows.append((username, content, note, h))
+                results.append({"index": i, "status": "created"})
+            if new_rows:
+                await tx.executemany(f"add_{kind}", new_rows)
+                created = [row[3] for row in new_rows]
+                rows = await tx.fetchall(f"{kind}_ids_by_hash", (username, *created), len(created))
+                ids.update({r["content_hash"]: r["id"] for r in rows})
+        for result, h in zip(results, hashes):
+            result["id"] = ids.get(h)
+        return results
+
+    async def _delete_many(self, kind, username, ids):
+        """返回逐项 {"id", "status": "deleted"|"not_found"}；不属于该用户的 id 视为 not_found。"""
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            return []
+        async with self._transaction() as tx:
+            found = {r["id"] for r in await tx.fetchall(f"{kind}_ids", (username, *ids), len(ids))}
+            if found:
+                await tx.executemany(f"delete_{kind}", [(i, username) for i in ids if i in found])
+        return [{"id": i, "status": "deleted" if i in found else "not_found"} for i in ids]
+
+    async def _page(self, name, username, limit, cursor):
+        """键集分页，返回 (本页行, 下一页游标或 None)。多取一行用来判断是否还有下一页。"""
+        limit = max(1, min(int(limit), LIST_PAGE_MAX))
+        if cursor:
+            created_at, last_id = decode_cursor(cursor)
+            rows = await self._fetchall(f"{name}_after", (username, created_at, created_at, last_id, limit + 1))
+        else:
+            rows = await self._fetchall(name, (username, limit + 1))
+        next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+        return [_row(r) for r in rows[:limit]], next_cursor
+
+    # --- 用户 ---
+    async def get_user(self, username):
+        return _row(await self._fetchone("get_user", (username,)))
+
+    async def user_exists(self, username):
+        return await self._fetchone("user_exists", (username,)) is not None
+
+    async def create_user(self, username, hashed_password):
+        _, user_id = await self._execute("create_user", (username, hashed_password))
+        return user_id
+
+    # --- 算式 ---
+    async def add_formula(self, username, latex, note):
+        """返回 (id, 是否新建)；相同 LaTeX 已保存过时返回已有记录的 id。"""
+        result = (await self._save_many("formula", username, [(latex, note)]))[0]
+        return result["id"], result["status"] == "created"
+
+    async def bulk_add_formulas(self, username, items):
+        return await self._save_many("formula", username, items)
+
+    async def bulk_delete_formulas(self, username, ids):
+        return await self._delete_many("formula", username, ids)
+
+    async def list_formulas(self, username, limit=LIST_PAGE_SIZE, cursor=None):
+        return await self._page("list_formulas", username, limit, cursor)
+
+    async def delete_formula(self, formula_id, username):
+        rowcount, _ = await self._execute("delete_formula", (formula_id, username))
+        return rowcount
+
+    async def update_formula(self, formula_id, username, latex, note):
+        rowcount, _ = await self._execute("update_formula",
+                                          (latex, note, content_hash(latex), formula_id, username))
+        return rowcount
+
+    # --- 动画脚本 ---
+    async def add_script(self, username, note, code):
+        """返回 (id, 是否新建)；相同代码已保存过时返回已有记录的 id。"""
+        result = (await self._save_many("script", username, [(code, note)]))[0]
+        return result["id"], result["status"] == "created"
+
+    async def bulk_add_scripts(self, username, items):
+        return await self._save_many("script", username, items)
+
+    async def bulk_delete_scripts(self, username, ids):
+        return await self._delete_many("script", username, ids)
+
+    async def list_scripts(self, username, limit=LIST_PAGE_SIZE, cursor=None):
+        return await self._page("list_scripts", username, limit, cursor)
+
+    async def get_script(self, script_id, username):
+        return _row(await self._fetchone("get_script", (script_id, username)))
+
+    async def iter_script_codes(self, batch=200):
+        """按 id 分批遍历全部已保存脚本的代码（视频清理任务用来确定需要保留的渲染结果）。"""
+        last_id = 0
+        while True:
+            rows = await self._fetchall("script_codes", (last_id, batch))
+            for row in rows:
+                yield row["code"]
+            if len(rows) < batch:
+                return
+            last_id = rows[-1]["id"]
+
+    async def delete_script(self, script_id, username):
+        rowcount, _ = await self._execute("delete_script", (script_id, username))
+        return rowcount
+
+    async def update_script(self, script_id, username, note, code):
+        rowcount, _ = await self._execute("update_script", (note, code, content_hash(code), script_id, username))
+        return rowcount
+
+
+class MySQLDatabase(_Database):
+    def __init__(self, pool_size=MYSQL_POOL_SIZE, overflow=MYSQL_POOL_OVERFLOW,
+                 acquire_timeout=MYSQL_ACQUIRE_TIMEOUT):
+        self.pool_size = pool_size
+        self.overflow = overflow
+        self.acquire_timeout = acquire_timeout
+        self._pool = None
+
+    async def connect(self):
+        self._pool = await aiomysql.create_pool(
+            host=MYSQL_HOST,
+            port=MYSQL_PORT,
+            user=MYSQL_USER,
+            password=MYSQL_PASSWORD,
+            db=MYSQL_DB,
+            charset="utf8mb4",
+            minsize=self.pool_size,
+            maxsize=self.pool_size + self.overflow,
+            pool_recycle=3600,
+        )
+        logger.info(f"MySQL pool created: size={self.pool_size}, overflow={self.overflow}")
+
+    async def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+
+    @contextlib.asynccontextmanager
+    async def _connection(self):
+        if self._pool is None:
+            raise DatabaseUnavailable("Database connection not initialized")
+        try:
+            conn = await asyncio.wait_for(self._pool.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            raise DatabaseBusy(f"no free MySQL connection within {self.acquire_timeout}s")
+        try:
+            yield conn
+        finally:
+            self._pool.release(conn)
+
+    async def _fetchone(self, name, args):
+        async with self._connection() as conn, conn.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute(self.sql[name], args)
+            return await cur.fetchone()
+
+    async def _fetchall(self, name, args):
+        async with self._connection() as conn, conn.cursor(aiomysql.DictCursor) as cur:
+            await cur.execute(self.sql[name], args)
+            return list(await cur.fetchall())
+
+    async def _execute(self, name, args):
+        async with self._connection() as conn, conn.cursor() as cur:
+            try:
+                await cur.execute(self.sql[name], args)
+                await conn.commit()
+            except aiomysql.IntegrityError as e:
+                await conn.rollback()
+                if e.args and e.args[0] == 1062:  # ER_DUP_ENTRY
+                    raise DuplicateContent(str(e)) from e
+                raise
+            except BaseException:
+                await conn.rollback()
+                raise
+            return cur.rowcount, cur.lastrowid
+
+    @contextlib.asynccontextmanager
+    async def _transaction(self):
+        async with self._connection() as conn, conn.cursor(aiomysql.DictCursor) as cur:
+            await conn.begin()
+            try:
+                yield _MySQLTransaction(self.sql, cur)
+                await conn.commit()
+            except BaseException:
+                await conn.rollback()
+                raise
+
+    def stats(self):
+        if self._pool is None:
+            return {"backend": "mysql", "connected": False}
+        return {"backend": "mysql", "connected": True, "size": self._pool.size,
+                "free": self._pool.freesize, "maxsize": self._pool.maxsize}
+
+
+class SQLiteDatabase(_Database):
+    """单连接 + 单线程执行器：语句串行执行，足够用于本地开发、测试与压测。"""
+
+    sql = {name: stmt.replace("%s", "?").replace("LEFT(code, 400)", "substr(code, 1, 400)")
+           for name, stmt in _SQL.items()}
+    sql.update(_SQLITE_SQL)
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-dao")
+        # 事务跨多次执行器调用，期间不能穿插其他语句（否则会被它们的提交带走）
+        self._lock = asyncio.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(_SQLITE_SCHEMA)
+        return conn
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def connect(self):
+        self._conn = await self._run(self._open)
+        logger.info(f"SQLite database opened: {self.path}")
+
+    async def close(self):
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+
+    def _check(self):
+        if self._conn is None:
+            raise DatabaseUnavailable("Database connection not initialized")
+        return self._conn
+
+    async def _fetchone(self, name, args):
+        def fn():
+            row = self._check().execute(self.sql[name], args).fetchone()
+            return dict(row) if row else None
+        async with self._lock:
+            return await self._run(fn)
+
+    async def _fetchall(self, name, args):
+        def fn():
+            return [dict(r) for r in self._check().execute(self.sql[name], args).fetchall()]
+        async with self._lock:
+            return await self._run(fn)
+
+    async def _execute(self, name, args):
+        def fn():
+            conn = self._check()
+            try:
+                with conn:
+                    cur = conn.execute(self.sql[name], args)
+            except sqlite3.IntegrityError as e:
+                if "UNIQUE" in str(e):
+                    raise DuplicateContent(str(e)) from e
+                raise
+            return cur.rowcount, cur.lastrowid
+        async with self._lock:
+            return await self._run(fn)
+
+    @contextlib.asynccontextmanager
+    async def _transaction(self):
+        async with self._lock:
+            conn = self._check()
+            try:
+                yield _SQLiteTransaction(self, conn)
+                await self._run(conn.commit)
+            except BaseException:
+                await self._run(conn.rollback)
+                raise
+
+    def stats(self):
+        return {"backend": "sqlite", "connected": self._conn is not None, "path": self.path}
+
+
+class _MySQLTransaction:
+    def __init__(self, sql, cur):
+        self.sql = sql
+        self.cur = cur
+
+    async def fetchall(self, name, args, n_in=0):
+        await self.cur.execute(_placeholders(self.sql[name], n_in), args)
+        return list(await self.cur.fetchall())
+
+    async def executemany(self, name, seq):
+        await self.cur.executemany(self.sql[name], seq)
+        return self.cur.rowcount
+
+
+class _SQLiteTransaction:
+    def __init__(self, db, conn):
+        self.db = db
+        self.conn = conn
+
+    async def fetchall(self, name, args, n_in=0):
+        stmt = _placeholders(self.db.sql[name], n_in, "?")
+        return await self.db._run(lambda: [dict(r) for r in self.conn.execute(stmt, args).fetchall()])
+
+    async def executemany(self, name, seq):
+        return await self.db._run(lambda: self.conn.executemany(self.db.sql[name], seq).rowcount)
+
+
+def create_database(backend=DB_BACKEND):
+    if backend == "sqlite":
+        return SQLiteDatabase()
+    return MySQLDatabase()
+
+
+database = create_database()
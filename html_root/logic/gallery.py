@@ -0,0 +1,210 @@
+# logic/gallery.py
+"""
+教学案例库索引：/api/examples 不再每次请求都读 metadata.json、扫描目录。
+
+- 索引常驻内存，只有存储目录或 metadata.json 的 mtime 变化时才重建
+- 每个 mp4 用 ffmpeg 截取一帧生成 JPEG 封面 (posters/<文件名>.jpg)，同一次调用从输出中解析时长；
+  结果按 (文件大小, mtime) 记录在 posters/index.json，每个视频只处理一次
+- 封面在后台线程生成，不阻塞请求；生成完成前该视频的 poster 为空，前端回退为视频首帧预览
+- metadata.json 中手动填写的 poster 优先
+- GALLERY_POSTERS=0 关闭封面生成（压测等不需要写 static 目录的场景），只使用已有封面
+"""
+import os
+import re
+import json
+import shutil
+import logging
+import threading
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+STORAGE_DIR = os.path.join(BASE_DIR, "static", "assets", "storage")
+STORAGE_URL = "/assets/storage"
+POSTER_SUBDIR = "posters"
+POSTER_WIDTH = int(os.getenv("GALLERY_POSTER_WIDTH", 480))
+POSTER_AT = float(os.getenv("GALLERY_POSTER_AT", 0.5))  # 截取第几秒的画面
+GALLERY_POSTERS = os.getenv("GALLERY_POSTERS", "1") != "0"
+
+_DURATION_RE = re.compile(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)")
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _parse_duration(text):
+    m = _DURATION_RE.search(text or "")
+    if not m:
+        return None
+    h, mnt, sec = m.groups()
+    return round(int(h) * 3600 + int(mnt) * 60 + float(sec), 2)
+
+
+class GalleryIndex:
+    def __init__(self, storage_dir=STORAGE_DIR, url_prefix=STORAGE_URL):
+        self.storage_dir = storage_dir
+        self.url_prefix = url_prefix
+        self.metadata_path = os.path.join(storage_dir, "metadata.json")
+        self.poster_dir = os.path.join(storage_dir, POSTER_SUBDIR)
+        self.poster_index_path = os.path.join(self.poster_dir, "index.json")
+        self.ffmpeg = shutil.which("ffmpeg") if GALLERY_POSTERS else None
+        self._lock = threading.Lock()
+        self._signature = None
+        self._videos = []
+        self._posters = self._load_poster_index()  # 文件名 -> {"size", "mtime", "poster", "duration"}
+        self._pending = set()
+        self._failed = {}  # 文件名 -> (size, mtime)，同一版本的文件失败后不再重试
+        self._worker = None
+        self.rebuilds = 0
+
+    def _load_poster_index(self):
+        try:
+            with open(self.poster_index_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_poster_index(self):
+        os.makedirs(self.poster_dir, exist_ok=True)
+        tmp = self.poster_index_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._posters, f, ensure_ascii=False)
+        os.replace(tmp, self.poster_index_path)
+
+    def _current_signature(self):
+        return _mtime(self.storage_dir), _mtime(self.metadata_path)
+
+    def _load_metadata(self):
+        meta_dict = {}
+        if os.path.exists(self.metadata_path):
+            try:
+                with open(self.metadata_path, "r", encoding="utf-8") as f:
+                    for item in json.load(f):
+                        meta_dict[item["filename"]] = item
+            except Exception as e:
+                logger.error(f"Metadata load error: {e}")
+        return meta_dict
+
+    def _poster_info(self, file):
+        """已生成且与当前文件一致的封面信息；否则返回 None。"""
+        try:
+            st = os.stat(os.path.join(self.storage_dir, file))
+        except OSError:
+            return None
+        info = self._posters.get(file)
+        if info and info["size"] == st.st_size and info["mtime"] == st.st_mtime_ns:
+            return info
+        if self._failed.get(file) == (st.st_size, st.st_mtime_ns):
+            return {}
+        return None
+
+    def _rebuild(self, signature):
+        meta_dict = self._load_metadata()
+        videos, missing = [], []
+        files = sorted(os.listdir(self.storage_dir)) if os.path.isdir(self.storage_dir) else []
+        for file in files:
+            if not file.endswith(".mp4"):
+                continue
+            # 如果有元数据就用，没有就用默认值
+            meta = meta_dict.get(file, {})
+            info = self._poster_info(file)
+            if info is None:
+                missing.append(file)
+            poster = meta.get("poster") or (info or {}).get("poster") or ""  # info 为 {} 表示生成失败
+            videos.append({
+                "filename": file,
+                "title": meta.get("title", file),
+                "description": meta.get("description", "暂无简介"),
+                "url": f"{self.url_prefix}/{file}",
+                "poster": poster,  # 封面图路径，如果为空，前端处理
+                "duration": (info or {}).get("duration"),
+            })
+        self._videos = videos
+        self._signature = signature
+        self.rebuilds += 1
+        if missing:
+            self._schedule_posters(missing)
+
+    def list_videos(self):
+        """返回案例列表；目录与 metadata.json 未变化时直接复用内存中的结果。"""
+        signature = self._current_signature()
+        with self._lock:
+            if signature != self._signature:
+                self._rebuild(signature)
+            return self._videos
+
+    # --- 封面生成 ---
+    def _schedule_posters(self, files):
+        if not self.ffmpeg:
+            return
+        self._pending.update(files)
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._generate_pending, name="gallery-posters", daemon=True)
+            self._worker.start()
+
+    def _generate_pending(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    return
+                file = self._pending.pop()
+            info = self._generate(file)
+            with self._lock:
+                if info is None:
+                    try:
+                        st = os.stat(os.path.join(self.storage_dir, file))
+                        self._failed[file] = (st.st_size, st.st_mtime_ns)
+                    except OSError:
+                        pass
+                else:
+                    self._posters[file] = info
+                    try:
+                        self._save_poster_index()
+                    except OSError as e:
+                        logger.error(f"Gallery poster index write error: {e}")
+                self._signature = None  # 下次请求重建，带上新封面
+
+    def _generate(self, file):
+        src = os.path.join(self.storage_dir, file)
+        try:
+            st = os.stat(src)
+        except OSError:
+            return None
+        os.makedirs(self.poster_dir, exist_ok=True)
+        name = os.path.splitext(file)[0] + ".jpg"
+        dest = os.path.join(self.poster_dir, name)
+        cmd = [self.ffmpeg, "-hide_banner", "-y", "-ss", str(POSTER_AT), "-i", src,
+               "-frames:v", "1", "-vf", f"scale={POSTER_WIDTH}:-2", "-q:v", "5", dest]
+        try:
+            proc = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.error(f"Gallery poster for {file} failed: {e}")
+            return None
+        if proc.returncode != 0 or not os.path.exists(dest):
+            logger.error(f"Gallery poster for {file} failed: {proc.stderr[-500:]}")
+            return None
+        return {
+            "size": st.st_size,
+            "mtime": st.st_mtime_ns,
+            "poster": f"{self.url_prefix}/{POSTER_SUBDIR}/{name}",
+            "duration": _parse_duration(proc.stderr),
+        }
+
+    def warm(self):
+        """启动时建立索引，并开始为缺少封面的视频生成封面。"""
+        if GALLERY_POSTERS and not self.ffmpeg:
+            logger.warning("ffmpeg not found, gallery posters will not be generated")
+        self.list_videos()
+
+    def stats(self):
+        with self._lock:
+            return {"videos": len(self._videos), "rebuilds": self.rebuilds,
+                    "posters": len(self._posters), "pending": len(self._pending)}
+
+
+index = GalleryIndex()
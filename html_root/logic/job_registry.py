@@ -0,0 +1,196 @@
+# logic/job_registry.py
+"""
+渲染任务注册表：流式接口的事件生成器在后台任务中运行，事件写入每个任务自己的有界环形缓冲区，
+SSE 连接只是订阅者。移动端断线后可凭 task_id + Last-Event-ID 重连，补发错过的事件并继续接收，
+不会重新调用大模型或重新渲染。
+
+- 每个事件带递增序号 (SSE 的 id 字段)，缓冲区保留最近 JOB_EVENT_BUFFER 条
+- 所有订阅者都断开后保留 JOB_DETACH_GRACE 秒等待重连，超时仍无人订阅则取消任务（释放渲染槽、结束渲染进程）
+- 结束的任务保留 JOB_TTL 秒供查询状态和补发事件
+- task_id 为 uuid4，持有即可订阅（断线重连时 IP 可能已变化，不按用户校验）
+"""
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+JOB_EVENT_BUFFER = int(os.getenv("JOB_EVENT_BUFFER", 500))
+JOB_DETACH_GRACE = float(os.getenv("JOB_DETACH_GRACE", 30))
+JOB_TTL = float(os.getenv("JOB_TTL", 600))
+
+# 事件中表示任务结束的取值（生成动画流用 step，开发者工具流用 type）
+FINAL_EVENTS = {"complete", "error"}
+
+
+def _event_kind(payload):
+    return payload.get("step") or payload.get("type")
+
+
+class Job:
+    def __init__(self, job_id, user, kind, key=None, buffer=JOB_EVENT_BUFFER, grace=JOB_DETACH_GRACE,
+                 on_cancel=None):
+        self.id = job_id
+        self.user = user
+        self.kind = kind
+        self.key = key
+        self.state = "running"  # running / complete / error / cancelled
+        self.created_at = time.time()
+        self.finished_at = None
+        self.progress = 0
+        self.result = None  # 最后一个事件
+        self.last_seq = 0
+        self.subscribers = 0
+        self.task = None
+        self._events = deque(maxlen=buffer)
+        self._grace = grace
+        self._on_cancel = on_cancel
+        self._waiter = None
+        self._detach_handle = None
+
+    @property
+    def done(self):
+        return self.state != "running"
+
+    def publish(self, payload):
+        self.last_seq += 1
+        self._events.append((self.last_seq, payload))
+        if payload.get("progress"):
+            self.progress = payload["progress"]
+        if _event_kind(payload) in FINAL_EVENTS:
+            self.result = payload
+        self._notify()
+        return self.last_seq
+
+    def finish(self, state=None):
+        if self.done:
+            return
+        if state is None:
+            state = _event_kind(self.result) if self.result else "error"
+        self.state = state
+        self.finished_at = time.time()
+        self._cancel_detach_timer()
+        self._notify()
+
+    def cancel(self):
+        """取消仍在运行的任务：CancelledError 沿事件生成器的 finally 释放渲染槽并结束渲染进程。"""
+        if not self.done and self.task is not None:
+            self.task.cancel()
+
+    def _notify(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def _wait(self):
+        if self._waiter is None:
+            self._waiter = asyncio.get_running_loop().create_future()
+        # shield：某个订阅者被取消不影响其他订阅者
+        await asyncio.shield(self._waiter)
+
+    def _cancel_detach_timer(self):
+        if self._detach_handle is not None:
+            self._detach_handle.cancel()
+            self._detach_handle = None
+
+    def _detach_expired(self):
+        self._detach_handle = None
+        if self.subscribers == 0 and not self.done:
+            logger.info(f"Job {self.id} has no subscribers for {self._grace}s, cancelling")
+            self.cancel()
+
+    async def events(self, last_id=0):
+        """订阅事件：先补发序号大于 last_id 的缓冲事件，再持续产出新事件，任务结束后返回。产出 (序号, 事件)。"""
+        self.subscribers += 1
+        self._cancel_detach_timer()
+        try:
+            while True:
+                for seq, payload in list(self._events):
+                    if seq > last_id:
+                        last_id = seq
+                        yield seq, payload
+                if self.done and last_id >= self.last_seq:
+                    return
+                if last_id >= self.last_seq:
+                    await self._wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self._detach_handle = asyncio.get_running_loop().call_later(self._grace, self._detach_expired)
+
+    def snapshot(self):
+        return {
+            "task_id": self.id,
+            "kind": self.kind,
+            "state": self.state,
+            "progress": self.progress,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "last_event_id": self.last_seq,
+            "subscribers": self.subscribers,
+            "result": self.result,
+        }
+
+
+class JobRegistry:
+    def __init__(self, ttl=JOB_TTL):
+        self.ttl = ttl
+        self._jobs = {}
+
+    def start(self, job_id, agen, user, kind, key=None, on_cancel=None):
+        """在后台任务中运行事件生成器 agen（产出事件 dict），返回 Job。"""
+        self._prune()
+        job = Job(job_id, user, kind, key=key, on_cancel=on_cancel)
+        self._jobs[job_id] = job
+        job.task = asyncio.ensure_future(self._run(job, agen))
+        return job
+
+    async def _run(self, job, agen):
+        try:
+            async for payload in agen:
+                job.publish(payload)
+            job.finish()
+        except asyncio.CancelledError:
+            job.finish("cancelled")
+            if job._on_cancel:
+                try:
+                    job._on_cancel()
+                except Exception as e:
+                    logger.error(f"Job {job.id} cancel cleanup error: {e}")
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {e}", exc_info=True)
+            # 订阅者需要一个结束事件，否则会当作断线而不断重连；同时带 step 与 type，两种流的前端都能识别
+            job.publish({"step": "error", "type": "error", "message": f"任务异常结束: {e}"})
+            job.finish("error")
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def find_active(self, user, key):
+        """同一用户相同请求仍在进行时返回该任务，供重复提交直接挂接。"""
+        if key is None:
+            return None
+        for job in self._jobs.values():
+            if not job.done and job.user == user and job.key == key:
+                return job
+        return None
+
+    def _prune(self):
+        now = time.time()
+        expired = [jid for jid, job in self._jobs.items()
+                   if job.done and job.subscribers == 0 and now - job.finished_at > self.ttl]
+        for jid in expired:
+            del self._jobs[jid]
+
+    def cancel_all(self):
+        for job in self._jobs.values():
+            job.cancel()
+
+    def stats(self):
+        running = sum(1 for job in self._jobs.values() if not job.done)
+        return {"jobs": len(self._jobs), "running": running}
+
+
+registry = JobRegistry()
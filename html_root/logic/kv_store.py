@@ -0,0 +1,196 @@
+# logic/kv_store.py
+"""
+带过期时间的键值存储，用于登录 Session 与验证码。
+
+- STORE_BACKEND=memory（默认）：进程内 LRU + TTL，超过容量淘汰最久未访问的键，过期键读取时失效
+- STORE_BACKEND=sqlite：共享 SQLite 文件（STORE_SQLITE_PATH，WAL 模式），多个 uvicorn worker 看到同一份数据，
+  在一个 worker 登录、另一个 worker 也能识别；过期与超量条目在写入时定期清理
+
+两种后端都按主键查找，get 为 O(1)/O(log n)，不扫描全表。
+update(key, fn) 为原子的读-改-写（限流令牌桶使用）：内存后端持锁执行，SQLite 后端在 BEGIN IMMEDIATE 事务中执行，多个 worker 之间同样原子。
+SQLite 后端等待写锁的时间由 busy_timeout 控制（默认 5 秒），超时按数据库出错处理。
+"""
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+STORE_BACKEND = os.getenv("STORE_BACKEND", "memory").lower()
+STORE_SQLITE_PATH = os.getenv("STORE_SQLITE_PATH", "kv_store.sqlite3")
+# SQLite 后端每写入多少次做一次过期/超量清理
+STORE_PRUNE_EVERY = int(os.getenv("STORE_PRUNE_EVERY", 200))
+
+
+class MemoryStore:
+    def __init__(self, namespace, max_entries, ttl):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (value, expires_at)
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[1] <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return item[0]
+
+    def _set_locked(self, key, value, ttl, now):
+        self._entries[key] = (value, now + (ttl or self.ttl))
+        self._entries.move_to_end(key)
+        # 队首是最久未访问的键：先清掉其中已过期的，再按容量淘汰
+        while self._entries:
+            oldest_key, (_, expires_at) = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[oldest_key]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._set_locked(key, value, ttl, time.time())
+
+    def update(self, key, fn, ttl=None):
+        """fn(旧值或 None) -> (新值, 返回值)，整个过程持锁；返回 fn 的返回值。"""
+        now = time.time()
+        with self._lock:
+            item = self._entries.get(key)
+            value, result = fn(item[0] if item and item[1] > now else None)
+            self._set_locked(key, value, ttl, now)
+            return result
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "memory", "entries": len(self._entries), "max_entries": self.max_entries}
+
+
+class SQLiteStore:
+    """每个线程一个连接；所有 worker 进程共用同一个数据库文件，按 namespace 区分用途。"""
+
+    def __init__(self, namespace, max_entries, ttl, path=STORE_SQLITE_PATH, busy_timeout=5):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._writes = 0
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv_store ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires_at REAL NOT NULL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_kv_store_expires ON kv_store (namespace, expires_at)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("PRAGMA mmap_size = 67108864")  # 读路径走内存映射
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        try:
+            row = self._conn().execute(
+                "SELECT value FROM kv_store WHERE namespace = ? AND key = ? AND expires_at > ?",
+                (self.namespace, key, time.time())
+            ).fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.error(f"KV store ({self.namespace}) read error: {e}")
+            return None
+
+    def set(self, key, value, ttl=None):
+        try:
+            with self._conn() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO kv_store (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                    (self.namespace, key, value, time.time() + (ttl or self.ttl))
+                )
+        except sqlite3.Error as e:
+            logger.error(f"KV store ({self.namespace}) write error: {e}")
+            return
+        self._writes += 1
+        if self._writes % STORE_PRUNE_EVERY == 0:
+            self._prune()
+
+    def update(self, key, fn, ttl=None):
+        """fn(旧值或 None) -> (新值, 返回值)，在写事务中执行；数据库出错时按无旧值计算、不写入。"""
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = conn.execute(
+                    "SELECT value FROM kv_store WHERE namespace = ? AND key = ? AND expires_at > ?",
+                    (self.namespace, key, now)
+                ).fetchone()
+                value, result = fn(row[0] if row else None)
+                conn.execute(
+                    "INSERT OR REPLACE INTO kv_store (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+                    (self.namespace, key, value, now + (ttl or self.ttl))
+                )
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        except sqlite3.Error as e:
+            logger.error(f"KV store ({self.namespace}) update error: {e}")
+            return fn(None)[1]
+        self._writes += 1
+        if self._writes % STORE_PRUNE_EVERY == 0:
+            self._prune()
+        return result
+
+    def delete(self, key):
+        try:
+            with self._conn() as conn:
+                conn.execute("DELETE FROM kv_store WHERE namespace = ? AND key = ?", (self.namespace, key))
+        except sqlite3.Error as e:
+            logger.error(f"KV store ({self.namespace}) delete error: {e}")
+
+    def _prune(self):
+        """删除过期条目；仍超过容量时删除最早过期的条目。"""
+        try:
+            with self._conn() as conn:
+                conn.execute("DELETE FROM kv_store WHERE namespace = ? AND expires_at <= ?",
+                             (self.namespace, time.time()))
+                conn.execute(
+                    "DELETE FROM kv_store WHERE namespace = ? AND key IN ("
+                    "SELECT key FROM kv_store WHERE namespace = ? ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                    (self.namespace, self.namespace, self.max_entries)
+                )
+        except sqlite3.Error as e:
+            logger.error(f"KV store ({self.namespace}) prune error: {e}")
+
+    def stats(self):
+        try:
+            (count,) = self._conn().execute(
+                "SELECT COUNT(*) FROM kv_store WHERE namespace = ?", (self.namespace,)).fetchone()
+        except sqlite3.Error:
+            count = None
+        return {"backend": "sqlite", "entries": count, "max_entries": self.max_entries, "path": self.path}
+
+
+def create_store(namespace, max_entries, ttl, backend=STORE_BACKEND, busy_timeout=5):
+    if backend == "sqlite":
+        return SQLiteStore(namespace, max_entries, ttl, busy_timeout=busy_timeout)
+    return MemoryStore(namespace, max_entries, ttl)
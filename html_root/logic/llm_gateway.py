@@ -0,0 +1,163 @@
+# logic/llm_gateway.py
+"""
+异步大模型网关：所有 OpenAI 兼容接口（DashScope）调用统一经过这里，不再在 async 路由里阻塞事件循环。
+
+- 共享一个带连接池的 httpx.AsyncClient
+- 每个模型一个并发信号量（LLM_CONCURRENCY，可用 LLM_MODEL_CONCURRENCY="qwen-vl-max=2,qwen-plus=8" 单独覆盖）
+- 请求超时 LLM_TIMEOUT；超时/连接错误/429/5xx 按指数退避 + 随机抖动重试 LLM_MAX_RETRIES 次
+- 每个模型记录耗时直方图，stats() 导出（流式调用记录的是首个响应的耗时）
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import contextlib
+
+import httpx
+import openai
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1")
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 120))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 2))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 32))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 8))
+LLM_MODEL_CONCURRENCY = os.getenv("LLM_MODEL_CONCURRENCY", "")
+
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+
+_RETRYABLE = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+def _parse_model_concurrency(spec):
+    limits = {}
+    for part in spec.split(","):
+        if "=" in part:
+            name, n = part.split("=", 1)
+            limits[name.strip()] = int(n)
+    return limits
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.sum += seconds
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def snapshot(self):
+        cumulative, total = {}, 0
+        for bound, n in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += n
+            cumulative[str(bound)] = total
+        return {"buckets": cumulative, "sum": round(self.sum, 3), "count": self.count}
+
+
+class LLMGateway:
+    def __init__(self, api_key=None, base_url=LLM_BASE_URL):
+        self.api_key = api_key
+        self.base_url = base_url
+        self._client = None
+        self._semaphores = {}
+        self._limits = _parse_model_concurrency(LLM_MODEL_CONCURRENCY)
+        self.latency = {}
+        self.errors = {}
+        self.retries = {}
+
+    @property
+    def client(self):
+        if self._client is None:
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS,
+                                    max_keepalive_connections=LLM_MAX_CONNECTIONS),
+                timeout=httpx.Timeout(LLM_TIMEOUT, connect=10.0),
+            )
+            self._client = AsyncOpenAI(
+                base_url=self.base_url,
+                api_key=self.api_key or os.getenv("ALIYUN_KEY") or "sk-mock-key",
+                http_client=http_client,
+                max_retries=0,  # 重试由网关统一处理
+            )
+        return self._client
+
+    def _semaphore(self, model):
+        sem = self._semaphores.get(model)
+        if sem is None:
+            sem = self._semaphores[model] = asyncio.Semaphore(self._limits.get(model, LLM_CONCURRENCY))
+        return sem
+
+    async def _with_retries(self, model, call, acquire=True):
+        attempt = 0
+        while True:
+            async with (self._semaphore(model) if acquire else contextlib.nullcontext()):
+                start = time.perf_counter()
+                try:
+                    result = await call()
+                    self.latency.setdefault(model, LatencyHistogram()).observe(time.perf_counter() - start)
+                    return result
+                except _RETRYABLE as e:
+                    if attempt >= LLM_MAX_RETRIES:
+                        self.errors[model] = self.errors.get(model, 0) + 1
+                        raise
+                    logger.warning(f"LLM {model} attempt {attempt + 1} failed: {e!r}, retrying")
+                except Exception:
+                    self.errors[model] = self.errors.get(model, 0) + 1
+                    raise
+            # 释放信号量后再退避：full jitter
+            attempt += 1
+            self.retries[model] = self.retries.get(model, 0) + 1
+            await asyncio.sleep(random.uniform(0, min(8.0, 0.5 * 2 ** attempt)))
+
+    async def chat(self, model, messages, **kwargs):
+        """返回首个候选的文本内容。"""
+        completion = await self._with_retries(
+            model, lambda: self.client.chat.completions.create(model=model, messages=messages, **kwargs))
+        return completion.choices[0].message.content or ""
+
+    async def chat_stream(self, model, messages, **kwargs):
+        """流式调用，逐段产出文本增量。整个流期间占用该模型的并发名额；只在建立连接阶段重试。
+        提前结束时请用 contextlib.aclosing 包裹，以便及时断开上游连接。"""
+        async with self._semaphore(model):
+            stream = await self._with_retries(
+                model,
+                lambda: self.client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs),
+                acquire=False)
+            try:
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                await stream.close()
+
+    def stats(self):
+        models = set(self.latency) | set(self.errors) | set(self.retries)
+        return {
+            model: {"latency": self.latency.get(model, LatencyHistogram()).snapshot(),
+                    "errors": self.errors.get(model, 0), "retries": self.retries.get(model, 0)}
+            for model in models
+        }
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+gateway = LLMGateway()
@@ -1,14 +1,15 @@
 # logic/manim_generator.py
 import os
-import subprocess
 import re
-import sys
 import numpy as np
-import shutil
+
+from logic import render_pool, render_cache
 
 # 获取项目根目录 (假设此文件在 logic/ 目录下，根目录是上一级)
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-STATIC_VIDEO_DIR = os.path.join(BASE_DIR, "static", "videos")
+STATIC_VIDEO_DIR = render_cache.STATIC_VIDEO_DIR
+# 矩阵动画的临时脚本与 manim 中间产物目录
+MANIM_MEDIA_DIR = os.path.abspath(os.getenv("MANIM_MEDIA_DIR") or os.path.join(BASE_DIR, "manim_media"))
 
 
 def parse_latex_to_list(latex_str):
@@ -51,9 +52,10 @@ def parse_latex_to_list(latex_str):
         return [[1, 0], [0, 1]]
 
 
-def render_matrix_animation(matA_latex, matB_latex, operation, task_id):
+def render_matrix_animation(matA_latex, matB_latex, operation, task_id, cancel=None):
     """
     生成 Manim 脚本并执行，使用纯 Manim Community 实现
+    cancel 为 threading.Event，置位时结束渲染（调用方释放渲染槽时）
     """
     matA = parse_latex_to_list(matA_latex)
     matB = parse_latex_to_list(matB_latex)
@@ -190,7 +192,8 @@ class {scene_name}(Scene):
 """
     # 写入临时文件
     py_filename = f"temp_{task_id}.py"
-    py_path = os.path.join(BASE_DIR, py_filename)
+    os.makedirs(MANIM_MEDIA_DIR, exist_ok=True)
+    py_path = os.path.join(MANIM_MEDIA_DIR, py_filename)
 
     with open(py_path, "w", encoding="utf-8") as f:
         f.write(script_content)
@@ -203,38 +206,28 @@ class {scene_name}(Scene):
     # Manim 默认会输出到 media/videos/temp_xxx/480p15/GenScene.mp4
     # 我们可以通过 --media_dir 指定输出根目录
 
-    # 使用当前解释器 -m manim，保证与主项目环境一致；-ql 为最快渲染预设（480p15）
-    cmd = [
-        sys.executable, "-m", "manim",
-        "-ql",
-        py_path,
-        scene_name,
-        "--media_dir", os.path.join(BASE_DIR, "manim_media")  # 临时输出目录，避免污染 static
-    ]
+    # 由常驻渲染 worker 执行（已预先 import manim）；-ql 为最快渲染预设（480p15）
+    # 临时输出目录 MANIM_MEDIA_DIR，避免污染 static
+    job = render_pool.make_job(py_path, scene_name, "-ql", MANIM_MEDIA_DIR, cwd=BASE_DIR)
 
     try:
-        subprocess.run(cmd, check=True, cwd=BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-        # 寻找生成的文件并移动
-        # 路径通常是: BASE_DIR/manim_media/videos/temp_{task_id}/480p15/GenScene.mp4
-        src_dir = os.path.join(BASE_DIR, "manim_media", "videos", f"temp_{task_id}", "480p15")
-        src_file = os.path.join(src_dir, f"{scene_name}.mp4")
+        returncode, stderr_text, manifest = render_pool.run_render(job, cancel=cancel)
+        if returncode != 0:
+            print(f"Manim Failed: {stderr_text[-2000:]}")
+            return None
 
+        # 按渲染返回的 manifest 直接移动输出文件
         target_file = os.path.join(STATIC_VIDEO_DIR, output_filename)
 
-        if os.path.exists(src_file):
-            shutil.move(src_file, target_file)
+        if render_pool.publish_output(manifest, target_file):
             # 清理临时文件 (可选: 清理 py 文件和 media 文件夹)
             if os.path.exists(py_path):
                 os.remove(py_path)
             return target_file
         else:
-            print(f"Video file not found at {src_file}")
+            print(f"Video file not found, manifest: {manifest}")
             return None
 
-    except subprocess.CalledProcessError as e:
-        print(f"Manim Failed: {e}")
-        return None
     except Exception as e:
         print(f"General Error: {e}")
         return None
\ No newline at end of file
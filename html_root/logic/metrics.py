@@ -0,0 +1,220 @@
+# logic/metrics.py
+"""
+流水线指标与 Prometheus 文本导出 (/metrics)。
+
+- registry.observe / registry.inc：带标签的直方图 (复用 llm_gateway.LatencyHistogram) 与计数器
+- StageTimer：一个任务的分阶段计时 (queue_wait、llm、file_write、preflight、preview_frame、render、
+  manim_load/construct/combine (取自渲染 manifest)、publish、post_process ...)，修正重试时同一阶段累加；
+  每段结束即记入 <前缀>_stage_seconds{pipeline, stage}
+- track()：包装流式事件生成器，给 complete 事件附带本任务的分阶段耗时 (metrics 字段)，
+  并按结果记录 <前缀>_job_seconds / <前缀>_jobs_total{pipeline, outcome}
+- register()：把各模块已有的 stats() 一并导出，数值为 gauge，LatencyHistogram.snapshot() 为 histogram
+- monitor_loop_lag()：后台每 METRICS_LOOP_LAG_INTERVAL 秒测一次事件循环的调度延迟，记入 <前缀>_event_loop_lag_seconds
+  （有同步调用阻塞事件循环时明显升高，压测 loadtest/driver.py 据此判断）
+"""
+import os
+import re
+import time
+import asyncio
+import logging
+import threading
+import contextlib
+
+from logic.llm_gateway import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+METRICS_PREFIX = os.getenv("METRICS_PREFIX", "wiscomper")
+
+METRICS_LOOP_LAG_INTERVAL = float(os.getenv("METRICS_LOOP_LAG_INTERVAL", 0.5))
+
+LOOP_LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+STAGE_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+FINAL_EVENTS = ("complete", "error")
+
+_NAME_RE = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _name(*parts):
+    return _NAME_RE.sub("_", "_".join(str(p) for p in parts if p != ""))
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                    for k, v in labels)
+    return "{" + body + "}"
+
+
+def _histogram_lines(name, labels, snapshot):
+    lines = []
+    for bound, count in snapshot["buckets"].items():
+        lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {count}")
+    lines.append(f"{name}_sum{_labels(labels)} {snapshot['sum']}")
+    lines.append(f"{name}_count{_labels(labels)} {snapshot['count']}")
+    return lines
+
+
+class MetricsRegistry:
+    def __init__(self, prefix=METRICS_PREFIX):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._histograms = {}  # 名称 -> {标签元组: LatencyHistogram}
+        self._counters = {}  # 名称 -> {标签元组: 数值}
+        self._help = {}
+        self._collectors = []  # (组件名, stats 函数, 第一层键对应的标签名)
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def observe(self, name, seconds, buckets=STAGE_BUCKETS, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = LatencyHistogram(buckets)
+            hist.observe(seconds)
+
+    def inc(self, name, n=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + n
+
+    def register(self, component, stats_fn, label=None):
+        """导出 stats_fn() 的结果；label 不为空时第一层键作为该标签的取值（如 LLM 按模型）。"""
+        self._collectors.append((component, stats_fn, label))
+
+    def _collect(self, name, value, labels, out):
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, (int, float)):
+            out.setdefault(name, ("gauge", []))[1].append(f"{name}{_labels(labels)} {value}")
+        elif isinstance(value, dict) and "buckets" in value:
+            out.setdefault(name, ("histogram", []))[1].extend(_histogram_lines(name, labels, value))
+        elif isinstance(value, dict):
+            for key, sub in value.items():
+                self._collect(_name(name, key), sub, labels, out)
+
+    def render(self):
+        """Prometheus 文本格式 (0.0.4)。"""
+        lines = []
+        with self._lock:
+            histograms = {name: {k: h.snapshot() for k, h in series.items()}
+                          for name, series in self._histograms.items()}
+            counters = {name: dict(series) for name, series in self._counters.items()}
+        for name, series in sorted(counters.items()):
+            full = _name(self.prefix, name)
+            if name in self._help:
+                lines.append(f"# HELP {full} {self._help[name]}")
+            lines.append(f"# TYPE {full} counter")
+            lines.extend(f"{full}{_labels(k)} {v}" for k, v in sorted(series.items()))
+        for name, series in sorted(histograms.items()):
+            full = _name(self.prefix, name)
+            if name in self._help:
+                lines.append(f"# HELP {full} {self._help[name]}")
+            lines.append(f"# TYPE {full} histogram")
+            for k, snapshot in sorted(series.items()):
+                lines.extend(_histogram_lines(full, k, snapshot))
+
+        collected = {}
+        for component, stats_fn, label in self._collectors:
+            try:
+                stats = stats_fn()
+            except Exception as e:
+                logger.error(f"Metrics collector {component} failed: {e}")
+                continue
+            base = _name(self.prefix, component)
+            if label:
+                for key, value in (stats or {}).items():
+                    self._collect(base, value, ((label, key),), collected)
+            else:
+                self._collect(base, stats, (), collected)
+        for name, (kind, series) in collected.items():
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(series)
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+registry.describe("stage_seconds", "Time spent in each pipeline stage")
+registry.describe("job_seconds", "Time from request to the final complete/error event")
+registry.describe("jobs_total", "Finished pipeline jobs by outcome")
+registry.describe("retries_total", "Fix-and-retry rounds after a failed render")
+registry.describe("cache_lookups_total", "Code / render cache lookups by result")
+registry.describe("event_loop_lag_seconds", "Delay between a scheduled wake-up and the event loop running it")
+
+
+class StageTimer:
+    def __init__(self, pipeline, metrics=registry):
+        self.pipeline = pipeline
+        self.metrics = metrics
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.attempts = 0
+        self.outcome = None
+
+    def record(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.metrics.observe("stage_seconds", seconds, pipeline=self.pipeline, stage=stage)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record_manifest(self, manifest):
+        """渲染 manifest 中 worker 记录的各阶段耗时 (import 脚本、construct 逐帧渲染、ffmpeg 合并)。"""
+        for key, seconds in ((manifest or {}).get("timings") or {}).items():
+            if key != "total" and isinstance(seconds, (int, float)):
+                self.record(f"manim_{key}", seconds)
+
+    def cache_lookup(self, cache, hit):
+        self.metrics.inc("cache_lookups_total", pipeline=self.pipeline, cache=cache, result="hit" if hit else "miss")
+
+    def retry(self):
+        self.metrics.inc("retries_total", pipeline=self.pipeline)
+
+    def summary(self):
+        return {
+            "stages": {k: round(v, 3) for k, v in self.stages.items()},
+            "attempts": self.attempts,
+            "total": round(time.perf_counter() - self.started, 3),
+        }
+
+    def finish(self, outcome):
+        if self.outcome is not None:
+            return
+        self.outcome = outcome
+        self.metrics.observe("job_seconds", time.perf_counter() - self.started, pipeline=self.pipeline, outcome=outcome)
+        self.metrics.inc("jobs_total", pipeline=self.pipeline, outcome=outcome)
+
+
+async def track(timer, agen):
+    """透传事件生成器：第一个 complete/error 事件时记录任务结果，complete 事件附带 metrics 字段。"""
+    try:
+        async with contextlib.aclosing(agen) as events:
+            async for event in events:
+                kind = event.get("step") or event.get("type")
+                if kind in FINAL_EVENTS and timer.outcome is None:
+                    timer.finish("cached" if event.get("cached") else kind)
+                    if kind == "complete":
+                        event = dict(event, metrics=timer.summary())
+                yield event
+    finally:
+        timer.finish("cancelled")
+
+
+async def monitor_loop_lag(interval=METRICS_LOOP_LAG_INTERVAL, metrics=registry):
+    """后台任务：sleep(interval) 实际醒来的时间比预期晚多少，就是这段时间里事件循环被阻塞的时长。"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        metrics.observe("event_loop_lag_seconds", max(loop.time() - expected, 0.0), buckets=LOOP_LAG_BUCKETS)
@@ -0,0 +1,92 @@
+# logic/password_hasher.py
+"""
+密码哈希：bcrypt 每次计算要几百毫秒 CPU，直接在 async 路由里调用会卡住所有并发的 SSE 流。
+这里把 hashpw/checkpw 放进专用线程池（bcrypt 计算期间释放 GIL，线程即可并行），
+
+- BCRYPT_ROUNDS          注册时的工作因子（校验时按哈希中记录的因子计算，调整后旧密码仍可登录）
+- PASSWORD_HASH_WORKERS  线程数，即同时进行的哈希计算上限，其余 CPU 留给渲染和流式接口
+- PASSWORD_HASH_MAX_PENDING  排队 + 计算中的请求上限，超过直接抛出 HasherBusy（接口返回 503），登录风暴不会无限堆积
+- stats() 导出排队等待与计算耗时直方图
+"""
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from logic.llm_gateway import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", 64))
+
+HASH_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5)
+
+
+class HasherBusy(Exception):
+    """等待哈希的请求已达 PASSWORD_HASH_MAX_PENDING。"""
+
+
+class PasswordHasher:
+    def __init__(self, workers=PASSWORD_HASH_WORKERS, max_pending=PASSWORD_HASH_MAX_PENDING,
+                 rounds=BCRYPT_ROUNDS):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.rounds = rounds
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.pending = 0
+        self.rejected = 0
+        self.queue_wait = LatencyHistogram(HASH_BUCKETS)
+        self.compute = LatencyHistogram(HASH_BUCKETS)
+
+    async def _submit(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HasherBusy(f"{self.pending} password hashes pending")
+        self.pending += 1
+        submitted = time.perf_counter()
+
+        def timed():
+            started = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                # 直方图只在工作线程里更新，各线程间的 += 竞争对统计用途可以接受
+                self.queue_wait.observe(started - submitted)
+                self.compute.observe(time.perf_counter() - started)
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, timed)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password):
+        """返回 bcrypt 哈希字符串。"""
+        def fn():
+            return bcrypt.hashpw(password.encode(), bcrypt.gensalt(self.rounds)).decode()
+        return await self._submit(fn)
+
+    async def verify(self, password, hashed):
+        def fn():
+            return bcrypt.checkpw(password.encode(), hashed.encode())
+        return await self._submit(fn)
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "rounds": self.rounds,
+            "pending": self.pending,
+            "rejected": self.rejected,
+            "queue_wait": self.queue_wait.snapshot(),
+            "compute": self.compute.snapshot(),
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+hasher = PasswordHasher()
@@ -1,3 +1,12 @@
+import hashlib
+
+
+def prompt_version(op_desc):
+    """提示词模板版本：对带占位符的模板取哈希，修改模板后旧的代码缓存自动失效。"""
+    template = return_prompt(op_desc, "{latex_a}", "{latex_b}") or ""
+    return hashlib.sha1(template.encode("utf-8")).hexdigest()[:12]
+
+
 def return_prompt(
         op_desc,
         latex_a,
@@ -501,3 +510,19 @@ self.play(Create(box))
 - 图像不遮挡、不替换、不覆盖公式
 - 未输出任何非代码内容
 """
+
+
+# --------
+# 推测式多候选生成：第 i 个候选在原提示词末尾追加 CANDIDATE_VARIANTS[i % n]（第 0 个候选即原提示词），
+# 不同写法出错的位置往往不同，多份候选中至少一份一次渲染成功的概率更高
+
+CANDIDATE_VARIANTS = (
+    "",
+    "\n\n补充要求：优先保证代码能一次运行成功。只使用最常见、最稳定的 Manim API，减少对象数量与动画步骤。",
+    "\n\n补充要求：每个 MathTex 只放一个完整的公式，不要按索引拆分或取子对象，"
+    "公式之间的变化用 ReplacementTransform 或 FadeIn/FadeOut 完成。",
+)
+
+
+def candidate_prompt(prompt, index):
+    return prompt + CANDIDATE_VARIANTS[index % len(CANDIDATE_VARIANTS)]
@@ -0,0 +1,170 @@
+# logic/rate_limit.py
+"""
+按用户的令牌桶限流（ASGI 中间件）：同一客户端不能并发刷 /api/animate/stream、/api/agent/execute 等接口，
+挤占付费的大模型调用与渲染 CPU，拖慢其他用户。
+
+- 用户标识与渲染调度一致：已登录用用户名，否则用客户端 IP（key_fn 由 main.py 传入）
+- 按路由类别分桶（ROUTE_CLASSES）：llm（调用大模型）、render（自定义代码渲染）、crud（账号、公式、脚本读写）；
+  RATE_LIMITS="llm=10/60" 表示桶容量 10、60 秒补满（每 6 秒 1 个令牌），容量 0 表示该类别不限流
+- 桶状态存放在与 Session 相同的 kv_store（STORE_BACKEND=sqlite 时多个 worker 共享），取令牌为原子的读-改-写
+- SQLite 后端的取令牌在专用线程池中执行，key_fn 解析用户标识（查 Session）也在同一次调用中完成，不阻塞事件循环；等待写锁超过 RATE_LIMIT_BUSY_TIMEOUT 秒时放行（fail open），
+  多 worker 写竞争不会拖慢请求
+- 超限返回 429 与 Retry-After（下一个令牌到账的秒数）；放行的响应带 X-RateLimit-Limit / X-RateLimit-Remaining
+- 纯 ASGI 实现，不缓冲响应体，SSE 流不受影响
+- stats() 按类别统计放行 / 拒绝次数，由 /metrics 导出
+"""
+import os
+import math
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.datastructures import MutableHeaders
+
+from logic import kv_store
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMITS = os.getenv("RATE_LIMITS", "llm=10/60,render=20/60,crud=120/60")
+RATE_LIMIT_MAX_ENTRIES = int(os.getenv("RATE_LIMIT_MAX_ENTRIES", 100000))
+RATE_LIMIT_BUSY_TIMEOUT = float(os.getenv("RATE_LIMIT_BUSY_TIMEOUT", 0.1))
+RATE_LIMIT_WORKERS = int(os.getenv("RATE_LIMIT_WORKERS", 4))
+
+# 路径前缀 -> 类别，按顺序匹配第一个；未列出的路径（静态资源、/api/jobs 断线重连、/metrics）不限流
+ROUTE_CLASSES = (
+    ("/api/animate", "llm"),  # /api/animate 与 /api/animate/stream
+    ("/api/agent/", "llm"),
+    ("/api/detect", "llm"),
+    ("/api/devtools/run_manim", "render"),  # run_manim 与 run_manim_stream
+    ("/api/formulas/", "crud"),
+    ("/api/animation_scripts/", "crud"),
+    ("/api/user/", "crud"),
+    ("/api/register", "crud"),
+    ("/api/login", "crud"),
+    ("/api/logout", "crud"),
+    ("/api/captcha", "crud"),
+)
+
+
+def _parse_limits(spec):
+    """"llm=10/60,render=20/60" -> {"llm": (10, 60.0), ...}"""
+    limits = {}
+    for part in spec.split(","):
+        if "=" not in part:
+            continue
+        name, rule = part.split("=", 1)
+        capacity, _, period = rule.partition("/")
+        limits[name.strip()] = (int(capacity), float(period or 60))
+    return limits
+
+
+def classify(path):
+    for prefix, route_class in ROUTE_CLASSES:
+        if path.startswith(prefix):
+            return route_class
+    return None
+
+
+class RateLimiter:
+    def __init__(self, limits=None, store=None, enabled=RATE_LIMIT_ENABLED):
+        self.limits = _parse_limits(RATE_LIMITS) if limits is None else limits
+        self.enabled = enabled
+        # TTL 取最长的补满时间：过期的桶与满桶等价，可以直接丢弃
+        ttl = max([period for _, period in self.limits.values()] + [60])
+        self.store = store or kv_store.create_store("rate_limit", RATE_LIMIT_MAX_ENTRIES, math.ceil(ttl) + 1,
+                                                    busy_timeout=RATE_LIMIT_BUSY_TIMEOUT)
+        # 内存后端持锁即可完成，直接在事件循环中执行；SQLite 后端放到专用线程池（不与渲染共用默认线程池）
+        self._executor = ThreadPoolExecutor(max_workers=RATE_LIMIT_WORKERS, thread_name_prefix="rate-limit") \
+            if isinstance(self.store, kv_store.SQLiteStore) else None
+        self._lock = threading.Lock()
+        self._counts = {name: {"allowed": 0, "limited": 0} for name in self.limits}
+
+    def take(self, route_class, user_key):
+        """取一个令牌，返回 (是否放行, 剩余令牌数, 需等待秒数)；该类别不限流时返回 None。"""
+        capacity, period = self.limits.get(route_class, (0, 0))
+        if capacity <= 0 or period <= 0:
+            return None
+        rate = capacity / period
+
+        def refill(value):
+            now = time.time()
+            tokens = capacity
+            if value:
+                try:
+                    saved_tokens, saved_at = value.split(":", 1)
+                    tokens = min(capacity, float(saved_tokens) + (now - float(saved_at)) * rate)
+                except ValueError:
+                    pass
+            if tokens >= 1:
+                tokens -= 1
+                decision = (True, int(tokens), 0.0)
+            else:
+                decision = (False, 0, (1 - tokens) / rate)
+            return f"{tokens:.4f}:{now:.3f}", decision
+
+        decision = self.store.update(f"{route_class}:{user_key}", refill, ttl=math.ceil(period) + 1)
+        with self._lock:
+            counts = self._counts.setdefault(route_class, {"allowed": 0, "limited": 0})
+            counts["allowed" if decision[0] else "limited"] += 1
+        return decision
+
+    def _take_for(self, route_class, key_fn, request):
+        return self.take(route_class, key_fn(request))
+
+    async def take_async(self, route_class, key_fn, request):
+        """用 key_fn(request) 得到用户标识后取令牌；SQLite 后端时两步都在线程池中执行。"""
+        if self._executor is None:
+            return self._take_for(route_class, key_fn, request)
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._take_for, route_class, key_fn, request)
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(counts, capacity=self.limits.get(name, (0, 0))[0],
+                               period=self.limits.get(name, (0, 0))[1])
+                    for name, counts in self._counts.items()}
+
+
+limiter = RateLimiter()
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, key_fn, limiter=limiter):
+        self.app = app
+        self.key_fn = key_fn
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.limiter.enabled or scope.get("method") == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+        route_class = classify(scope["path"])
+        decision = await self.limiter.take_async(route_class, self.key_fn, Request(scope)) if route_class else None
+        if decision is None:
+            await self.app(scope, receive, send)
+            return
+
+        allowed, remaining, retry_after = decision
+        capacity = self.limiter.limits[route_class][0]
+        if not allowed:
+            wait = max(1, math.ceil(retry_after))
+            response = JSONResponse(
+                status_code=429,
+                headers={"Retry-After": str(wait), "X-RateLimit-Limit": str(capacity), "X-RateLimit-Remaining": "0"},
+                content={"status": "error", "message": f"请求过于频繁，请 {wait} 秒后再试"})
+            await response(scope, receive, send)
+            return
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers["X-RateLimit-Limit"] = str(capacity)
+                headers["X-RateLimit-Remaining"] = str(remaining)
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
@@ -0,0 +1,229 @@
+# logic/render_cache.py
+"""
+渲染结果缓存：相同的场景代码 + 场景名 + 质量 + Manim 版本只渲染一次。
+
+- 键为规范化源码的 sha256：能解析时取 ast.dump（忽略空白、注释差异），否则按行去除尾随空白
+- Manim 版本取实际渲染所用的 manim 包（可导入的 manim，否则为仓库内置的 yty_math/manim，可用 RENDER_CACHE_MANIM_DIR 指定）：
+  版本号 + 包内源码文件的内容哈希，内置 Manim 有任何修改都会使旧缓存失效
+- 索引持久化到视频目录 (VIDEO_DIR，默认 static/videos) 下的 .render_cache.json，服务重启后仍然有效；修改后由定时器线程在
+  RENDER_CACHE_SAVE_DELAY 秒内合并写盘，不在事件循环中同步写文件，关闭服务时 flush()
+- 每个视频文件带引用计数：缓存条目本身持有一个引用，其他模块可 retain/release 额外引用；
+  本模块从不删除文件，视频清理任务 (video_gc.py) 通过 release_for_gc 移除条目、引用归零后才删除
+"""
+import os
+import ast
+import json
+import time
+import hashlib
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+VENDORED_MANIM_DIR = os.path.abspath(os.path.join(BASE_DIR, "..", "yty_math", "manim"))
+# 渲染输出与缓存视频所在目录，/videos 路由即挂载此目录；压测等场景可指向临时目录，不写入仓库
+STATIC_VIDEO_DIR = os.path.abspath(os.getenv("VIDEO_DIR") or os.path.join(BASE_DIR, "static", "videos"))
+INDEX_PATH = os.path.join(STATIC_VIDEO_DIR, ".render_cache.json")
+RENDER_CACHE_SAVE_DELAY = float(os.getenv("RENDER_CACHE_SAVE_DELAY", 1))
+
+
+def _manim_dir():
+    """渲染所用 manim 包的目录（只查找、不 import）。"""
+    configured = os.getenv("RENDER_CACHE_MANIM_DIR")
+    if configured:
+        return configured
+    try:
+        from importlib.util import find_spec
+        spec = find_spec("manim")
+        if spec and spec.origin:
+            return os.path.dirname(spec.origin)
+    except (ImportError, ValueError):
+        pass
+    return VENDORED_MANIM_DIR if os.path.isdir(VENDORED_MANIM_DIR) else None
+
+
+def _source_digest(root):
+    """包内文件（不含 __pycache__）按相对路径排序后的内容哈希。"""
+    h = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d != "__pycache__")
+        for name in sorted(filenames):
+            if name.endswith((".pyc", ".pyo")):
+                continue
+            path = os.path.join(dirpath, name)
+            h.update(os.path.relpath(path, root).replace(os.sep, "/").encode("utf-8") + b"\0")
+            with open(path, "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def _manim_version():
+    try:
+        from importlib.metadata import version
+        label = version("manim")
+    except Exception:
+        label = "unknown"
+    root = _manim_dir()
+    if not root:
+        return label
+    try:
+        return f"{label}+{_source_digest(root)}"
+    except OSError as e:
+        logger.error(f"Manim source hash error ({root}): {e}")
+        return label
+
+
+MANIM_VERSION = _manim_version()
+
+
+def normalize_source(code):
+    try:
+        return ast.dump(ast.parse(code))
+    except SyntaxError:
+        lines = [line.rstrip() for line in code.replace("\r\n", "\n").split("\n")]
+        return "\n".join(lines).strip()
+
+
+def make_key(code, scene_name="GenScene", quality="-ql"):
+    raw = "\0".join([normalize_source(code), scene_name, quality, MANIM_VERSION])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class RenderCache:
+    def __init__(self, index_path=INDEX_PATH, video_dir=STATIC_VIDEO_DIR, save_delay=RENDER_CACHE_SAVE_DELAY):
+        self.index_path = index_path
+        self.video_dir = video_dir
+        self.save_delay = save_delay
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # 串行化写盘，不占用 _lock
+        self._timer = None
+        # key -> {"filename", "created_at", "hits", "last_hit"}
+        self._entries = {}
+        # filename -> 引用计数
+        self._refs = {}
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self._entries = data.get("entries", {})
+            self._refs = data.get("refs", {})
+        except Exception as e:
+            logger.error(f"Render cache index load error: {e}")
+
+    def _save(self):
+        """标记索引已修改，save_delay 秒后由定时器线程写盘；期间的多次修改只写一次。调用方持有 _lock。"""
+        self._dirty = True
+        if self._timer is None:
+            self._timer = threading.Timer(self.save_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return
+                data = json.dumps({"entries": self._entries, "refs": self._refs})
+                self._dirty = False
+            try:
+                os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+                tmp_path = self.index_path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(data)
+                os.replace(tmp_path, self.index_path)
+            except OSError as e:
+                logger.error(f"Render cache index save error: {e}")
+                with self._lock:
+                    self._dirty = True
+
+    def lookup(self, key):
+        """命中且文件仍存在时返回视频文件名，否则返回 None（并清掉失效条目）。"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            if not os.path.exists(os.path.join(self.video_dir, entry["filename"])):
+                self._drop(key)
+                self._save()
+                return None
+            entry["hits"] = entry.get("hits", 0) + 1
+            entry["last_hit"] = time.time()
+            self._dirty = True
+            return entry["filename"]
+
+    def store(self, key, filename):
+        with self._lock:
+            old = self._entries.get(key)
+            if old and old["filename"] == filename:
+                return
+            if old:
+                self._drop(key)
+            self._entries[key] = {"filename": filename, "created_at": time.time(), "hits": 0, "last_hit": None}
+            self._refs[filename] = self._refs.get(filename, 0) + 1
+            self._save()
+
+    def retain(self, filename):
+        with self._lock:
+            self._refs[filename] = self._refs.get(filename, 0) + 1
+            self._save()
+
+    def release(self, filename):
+        with self._lock:
+            self._release(filename)
+            self._save()
+
+    def evict(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+                self._save()
+
+    def is_pinned(self, filename):
+        with self._lock:
+            return self._refs.get(filename, 0) > 0
+
+    def pinned_files(self):
+        with self._lock:
+            return {f for f, n in self._refs.items() if n > 0}
+
+    def release_for_gc(self, filename, protected_keys=None):
+        """视频清理任务调用：文件没有缓存条目以外的引用（retain），且其条目都不在 protected_keys 中时，
+        移除这些条目并返回 True，之后即可删除文件。protected_keys 为 None 表示无法确认，缓存中的文件一律保留。"""
+        with self._lock:
+            keys = [k for k, e in self._entries.items() if e["filename"] == filename]
+            if keys and (protected_keys is None or any(k in protected_keys for k in keys)):
+                return False
+            if self._refs.get(filename, 0) > len(keys):
+                return False
+            for key in keys:
+                self._drop(key)
+            if keys:
+                self._save()
+            return True
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self._release(entry["filename"])
+
+    def _release(self, filename):
+        n = self._refs.get(filename, 0) - 1
+        if n > 0:
+            self._refs[filename] = n
+        else:
+            self._refs.pop(filename, None)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "pinned_files": len(self._refs)}
+
+
+cache = RenderCache()
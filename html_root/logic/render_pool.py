@@ -0,0 +1,437 @@
+# logic/render_pool.py
+"""
+Manim 渲染进程池：维护若干已预先 import manim 的常驻 worker（见 render_worker.py），
+通过 stdin/stdout 管道下发 (脚本, 场景名, 质量) 任务并逐行回传日志。
+
+- worker 执行满 RENDER_POOL_MAX_JOBS 个任务后回收重建，避免内存/全局状态累积
+- worker 崩溃（管道 EOF）时本次任务返回失败，并自动补充新 worker
+- RENDER_POOL_SIZE=0 或 worker 无法 import manim 时，回退为每次 `python -m manim` 子进程
+- 调用方可传入 cancel (threading.Event)：置位后结束整个进程组（manim 及其 ffmpeg/latex 子进程），
+  被取消的 worker 直接丢弃并补充新的
+- job["limits"]（见 render_sandbox.py）：常驻 worker fork 子进程、子进程回退路径在 exec 前施加 rlimit 与 nice
+- RENDER_BACKEND=fake：不启动 manim，每个任务休眠 RENDER_FAKE_SECONDS 并输出合成的进度日志、写出占位文件，
+  用于没有 LaTeX/ffmpeg 的机器上压测（见 loadtest/）
+
+回调约定：put_fn(("log", text)) / put_fn(("done", returncode, stderr_full, manifest))
+manifest 记录输出视频的确切路径、时长、帧数、大小与各阶段耗时（见 render_worker.py），失败时为 None；
+调用方用 publish_output 一次 os.replace 取走视频，不再搜索目录
+"""
+import os
+import sys
+import json
+import time
+import errno
+import shutil
+import queue
+import signal
+import logging
+import threading
+import subprocess
+
+from logic import render_sandbox
+
+logger = logging.getLogger(__name__)
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "render_worker.py")
+
+RENDER_POOL_SIZE = int(os.getenv("RENDER_POOL_SIZE", 2))
+RENDER_POOL_MAX_JOBS = int(os.getenv("RENDER_POOL_MAX_JOBS", 20))
+RENDER_BACKEND = os.getenv("RENDER_BACKEND", "manim").lower()
+RENDER_FAKE_SECONDS = float(os.getenv("RENDER_FAKE_SECONDS", 2))
+
+# 命令行质量参数 -> manim config.quality
+QUALITY_FLAGS = {
+    "-ql": "low_quality",
+    "-qm": "medium_quality",
+    "-qh": "high_quality",
+    "-qp": "production_quality",
+    "-qk": "fourk_quality",
+}
+
+# manim config.quality -> 输出子目录 (分辨率 + 帧率)，子进程回退路径据此得到确切输出位置
+QUALITY_DIRS = {
+    "low_quality": "480p15",
+    "medium_quality": "720p30",
+    "high_quality": "1080p60",
+    "production_quality": "1440p60",
+    "fourk_quality": "2160p60",
+}
+
+
+def make_job(py_path, scene_name="GenScene", quality="-ql", media_dir=None, output_file=None, cwd=None,
+             dry_run=False, save_last_frame=False, limits=None):
+    """构造一次渲染任务，字段即 worker 协议中的字段。dry_run=True 时只执行 construct，不写出任何文件；
+    save_last_frame=True 时 (-s) 只输出最后一帧 PNG；limits 为 render_sandbox.limits_for() 的结果，None 不限制。"""
+    return {
+        "py_path": os.path.abspath(py_path),
+        "scene_name": scene_name,
+        "quality": QUALITY_FLAGS.get(quality, quality),
+        "media_dir": os.path.abspath(media_dir) if media_dir else os.path.dirname(os.path.abspath(py_path)),
+        "output_file": output_file or "",
+        "cwd": cwd,
+        "dry_run": dry_run,
+        "save_last_frame": save_last_frame,
+        "limits": limits,
+    }
+
+
+def build_manim_cmd(job):
+    """回退路径使用的等价 `python -m manim` 命令。"""
+    flag = next((f for f, q in QUALITY_FLAGS.items() if q == job["quality"]), "-ql")
+    cmd = [sys.executable, "-m", "manim", flag, "--media_dir", job["media_dir"]]
+    if job.get("output_file"):
+        cmd += ["-o", job["output_file"]]
+    if job.get("dry_run"):
+        cmd += ["--dry_run", "-s"]
+    elif job.get("save_last_frame"):
+        cmd += ["-s"]
+    cmd += [job["py_path"], job["scene_name"]]
+    return cmd
+
+
+def expected_movie_path(job):
+    """按 manim 默认目录规则推算输出路径：media_dir/videos/<脚本名>/<质量目录>/<输出文件名>。"""
+    module_name = os.path.splitext(os.path.basename(job["py_path"]))[0]
+    output_name = job.get("output_file") or job["scene_name"] + ".mp4"
+    return os.path.join(job["media_dir"], "videos", module_name,
+                        QUALITY_DIRS.get(job["quality"], "480p15"), output_name)
+
+
+def expected_image_path(job):
+    """-s 输出路径：media_dir/images/<脚本名>/<输出文件名>。"""
+    module_name = os.path.splitext(os.path.basename(job["py_path"]))[0]
+    output_name = job.get("output_file") or job["scene_name"] + ".png"
+    return os.path.join(job["media_dir"], "images", module_name, output_name)
+
+
+def _file_manifest(job, timings):
+    """子进程回退路径拿不到 SceneFileWriter，只能按确定的输出路径生成简化的 manifest。"""
+    if job.get("save_last_frame"):
+        path = expected_image_path(job)
+        if not os.path.exists(path):
+            return None
+        return {"movie_file_path": None, "image_file_path": path, "duration": None, "frame_rate": None,
+                "frames": None, "size": os.path.getsize(path), "timings": timings}
+    path = expected_movie_path(job)
+    if not os.path.exists(path):
+        return None
+    return {"movie_file_path": path, "duration": None, "frame_rate": None, "frames": None,
+            "size": os.path.getsize(path), "timings": timings}
+
+
+def publish_output(manifest, dest_path, field="movie_file_path"):
+    """把渲染输出移动到 dest_path（同一文件系统内 os.replace，O(1)；跨设备时退回复制），成功返回 True。
+    field 为 manifest 中的输出路径字段，预览帧用 "image_file_path"。"""
+    src = (manifest or {}).get(field)
+    if not src:
+        return False
+    try:
+        try:
+            os.replace(src, dest_path)
+        except OSError as ex:
+            if ex.errno != errno.EXDEV:
+                raise
+            shutil.move(src, dest_path)
+    except OSError as ex:
+        logger.error(f"Publish render output failed: {src} -> {dest_path}: {ex}")
+        return False
+    manifest[field] = os.path.abspath(dest_path)
+    return True
+
+
+def _noop(_item):
+    pass
+
+
+class RenderCancelled(Exception):
+    """调用方取消了渲染（例如 SSE 客户端已断开）。"""
+
+
+# POSIX 下每个渲染进程单独成组，结束时连同 ffmpeg/latex 子进程一起结束
+_NEW_SESSION = os.name == "posix"
+
+
+def _kill_process_tree(proc):
+    try:
+        if _NEW_SESSION:
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except OSError:
+        pass
+
+
+class _Watchdog:
+    """超时或 cancel 置位时调用 kill；reason 记录触发原因 ("timeout" / "cancelled")。"""
+
+    def __init__(self, kill, timeout=None, cancel=None):
+        self.reason = None
+        self._kill = kill
+        self._deadline = time.monotonic() + timeout if timeout else None
+        self._cancel = cancel
+        self._stopped = threading.Event()
+        if timeout or cancel is not None:
+            threading.Thread(target=self._watch, daemon=True).start()
+
+    def _watch(self):
+        while not self._stopped.wait(0.2):
+            if self._cancel is not None and self._cancel.is_set():
+                self.reason = "cancelled"
+            elif self._deadline and time.monotonic() >= self._deadline:
+                self.reason = "timeout"
+            else:
+                continue
+            self._kill()
+            return
+
+    def stop(self):
+        self._stopped.set()
+
+    def raise_if_fired(self, cmd, timeout):
+        if self.reason == "timeout":
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        if self.reason == "cancelled":
+            raise RenderCancelled()
+
+
+def run_manim_subprocess(job, put_fn=None, timeout=None, cancel=None):
+    """冷启动子进程渲染（回退路径），返回 (returncode, stderr_full, manifest)。
+    超时抛出 subprocess.TimeoutExpired，cancel 置位时抛出 RenderCancelled。"""
+    put_fn = put_fn or _noop
+    cmd = build_manim_cmd(job)
+    start = time.perf_counter()
+    limits = job.get("limits")
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, cwd=job.get("cwd"),
+                            start_new_session=_NEW_SESSION,
+                            preexec_fn=(lambda: render_sandbox.apply(limits)) if limits and _NEW_SESSION else None)
+    watchdog = _Watchdog(lambda: _kill_process_tree(proc), timeout, cancel)
+    stderr_chunks = []
+    try:
+        for raw in iter(proc.stderr.readline, b""):
+            stderr_chunks.append(raw)
+            text = raw.decode("utf-8", errors="replace").rstrip()
+            if text:
+                put_fn(("log", text))
+        proc.wait()
+    finally:
+        watchdog.stop()
+    watchdog.raise_if_fired(cmd, timeout)
+    err_full = b"".join(stderr_chunks).decode("utf-8", errors="replace")
+    manifest = None
+    if proc.returncode == 0 and not job.get("dry_run"):
+        manifest = _file_manifest(job, {"total": round(time.perf_counter() - start, 3)})
+    put_fn(("done", proc.returncode, err_full, manifest))
+    return proc.returncode, err_full, manifest
+
+
+# 占位视频：ftyp + moov + mdat 三个顶层 box，moov 已在前面，后处理不会再调用 ffmpeg
+_FAKE_MP4 = (b"\x00\x00\x00\x10ftypisom\x00\x00\x02\x00" b"\x00\x00\x00\x08moov"
+             b"\x00\x00\x00\x10mdat" + b"\x00" * 8)
+_FAKE_PNG = b"\x89PNG\r\n\x1a\n"
+
+
+def run_fake_render(job, put_fn=None, timeout=None, cancel=None):
+    """RENDER_BACKEND=fake 的渲染：按 RENDER_FAKE_SECONDS 休眠（预检/预览帧为其 1/10，高质量为 2 倍），
+    期间输出与 manim 相同格式的进度行，最后在真实渲染的输出位置写出占位文件。超时、取消的行为与真实渲染一致。"""
+    put_fn = put_fn or _noop
+    cancel = cancel or threading.Event()
+    start = time.perf_counter()
+    if job.get("dry_run") or job.get("save_last_frame"):
+        seconds = RENDER_FAKE_SECONDS / 10
+    elif job["quality"] != "low_quality":
+        seconds = RENDER_FAKE_SECONDS * 2
+    else:
+        seconds = RENDER_FAKE_SECONDS
+    steps = 10
+    lines = []
+    for i in range(1, steps + 1):
+        if cancel.wait(seconds / steps):
+            raise RenderCancelled()
+        if timeout and time.perf_counter() - start > timeout:
+            raise subprocess.TimeoutExpired(job["py_path"], timeout)
+        line = f"Animation 0: FakeScene: {i * 100 // steps}%| {i}/{steps} [{time.perf_counter() - start:.2f}s]"
+        lines.append(line)
+        put_fn(("log", line))
+    manifest = None
+    if not job.get("dry_run"):
+        image = job.get("save_last_frame")
+        path = expected_image_path(job) if image else expected_movie_path(job)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(_FAKE_PNG if image else _FAKE_MP4)
+        elapsed = round(time.perf_counter() - start, 3)
+        manifest = {"movie_file_path": None if image else path, "image_file_path": path if image else None,
+                    "duration": None, "frame_rate": None, "frames": None, "size": os.path.getsize(path),
+                    "timings": {"load": 0.0, "construct": elapsed, "combine": 0.0, "total": elapsed}}
+    err_full = "\n".join(lines) + "\n"
+    put_fn(("done", 0, err_full, manifest))
+    return 0, err_full, manifest
+
+
+class WorkerUnavailable(Exception):
+    """worker 无法启动（通常是当前环境 import manim 失败）。"""
+
+
+class _RenderWorker:
+    def __init__(self):
+        self.jobs = 0
+        self.ready = False
+        self.proc = subprocess.Popen(
+            [sys.executable, WORKER_SCRIPT],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=None,
+            start_new_session=_NEW_SESSION,
+        )
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def _read(self):
+        raw = self.proc.stdout.readline()
+        if not raw:
+            return None
+        try:
+            return json.loads(raw.decode("utf-8", errors="replace"))
+        except ValueError:
+            return {"type": "log", "text": raw.decode("utf-8", errors="replace").rstrip()}
+
+    def wait_ready(self):
+        while not self.ready:
+            msg = self._read()
+            if msg is None:
+                raise WorkerUnavailable("render worker exited during startup")
+            if msg.get("type") == "fatal":
+                raise WorkerUnavailable(msg.get("message", "render worker failed to import manim"))
+            if msg.get("type") == "ready":
+                self.ready = True
+
+    def run(self, job, put_fn, timeout=None, cancel=None):
+        """执行一个任务，返回 (returncode, stderr_full, manifest, healthy)。超时/取消时进程组被结束并抛出对应异常。"""
+        self.jobs += 1
+        watchdog = _Watchdog(self.kill, timeout, cancel)
+        try:
+            self.proc.stdin.write((json.dumps(job, ensure_ascii=False) + "\n").encode("utf-8"))
+            self.proc.stdin.flush()
+            while True:
+                msg = self._read()
+                if msg is None:
+                    break
+                if msg.get("type") == "log":
+                    put_fn(("log", msg.get("text", "")))
+                elif msg.get("type") == "done":
+                    return msg.get("returncode", 1), msg.get("stderr", ""), msg.get("manifest"), True
+        except (BrokenPipeError, OSError) as ex:
+            logger.error(f"Render worker pipe error: {ex}")
+        finally:
+            watchdog.stop()
+        watchdog.raise_if_fired(job["py_path"], timeout)
+        return -1, "Render worker crashed (exit code %s)" % self.proc.poll(), None, False
+
+    def kill(self):
+        _kill_process_tree(self.proc)
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except Exception:
+            self.kill()
+
+
+class RenderWorkerPool:
+    def __init__(self, size=RENDER_POOL_SIZE, max_jobs=RENDER_POOL_MAX_JOBS):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.disabled = size <= 0
+        self._idle = queue.Queue()
+        self._started = False
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._started or self.disabled:
+                return
+            self._started = True
+            for _ in range(self.size):
+                self._idle.put(_RenderWorker())
+        logger.info(f"Render worker pool started: size={self.size}, max_jobs={self.max_jobs}")
+
+    def _replace(self, worker):
+        worker.kill()
+        if not self.disabled:
+            self._idle.put(_RenderWorker())
+
+    def run(self, job, put_fn=None, timeout=None, cancel=None):
+        """阻塞执行一个渲染任务（应在线程池中调用），返回 (returncode, stderr_full, manifest)。"""
+        put_fn = put_fn or _noop
+        if not self.disabled:
+            self.start()
+        worker = None
+        while worker is None:
+            if cancel is not None and cancel.is_set():
+                raise RenderCancelled()
+            if self.disabled:
+                return run_manim_subprocess(job, put_fn, timeout, cancel)
+            try:
+                worker = self._idle.get(timeout=1.0)
+            except queue.Empty:
+                continue
+        try:
+            if not worker.alive():
+                worker.kill()
+                worker = _RenderWorker()
+            worker.wait_ready()
+        except WorkerUnavailable as ex:
+            logger.warning(f"Render worker unavailable, falling back to subprocess: {ex}")
+            self.disabled = True
+            worker.kill()
+            return run_manim_subprocess(job, put_fn, timeout, cancel)
+
+        healthy = False
+        try:
+            returncode, err_full, manifest, healthy = worker.run(job, put_fn, timeout, cancel)
+        finally:
+            if healthy and worker.jobs < self.max_jobs:
+                self._idle.put(worker)
+            else:
+                self._replace(worker)
+        put_fn(("done", returncode, err_full, manifest))
+        return returncode, err_full, manifest
+
+    def shutdown(self):
+        self.disabled = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_POOL = None
+
+
+def get_pool():
+    global _POOL
+    if _POOL is None:
+        _POOL = RenderWorkerPool(size=0 if RENDER_BACKEND == "fake" else RENDER_POOL_SIZE)
+    return _POOL
+
+
+def run_render(job, put_fn=None, timeout=None, cancel=None):
+    """渲染入口。除超时外的异常都转换为 ("done", -1, 错误信息)，保证流式调用方不会一直等待。"""
+    try:
+        if RENDER_BACKEND == "fake":
+            return run_fake_render(job, put_fn, timeout, cancel)
+        return get_pool().run(job, put_fn, timeout, cancel)
+    except subprocess.TimeoutExpired:
+        raise
+    except RenderCancelled:
+        logger.info(f"Render job cancelled: {job['py_path']}")
+        (put_fn or _noop)(("done", -1, "渲染已取消", None))
+        return -1, "渲染已取消", None
+    except Exception as ex:
+        logger.error(f"Render job failed: {ex}", exc_info=True)
+        err = str(ex) or repr(ex)
+        (put_fn or _noop)(("done", -1, err, None))
+        return -1, err, None
@@ -0,0 +1,131 @@
+# logic/render_sandbox.py
+"""
+渲染资源限制：用户提交的 Manim 代码（/api/devtools/run_manim*、大模型生成的场景）在 rlimit 约束下执行，
+死循环或超大的 NumberPlane 不会吃满整台机器的 CPU 与内存、拖慢其他用户的渲染。
+
+- 限制项：cpu (CPU 秒，RLIMIT_CPU)、memory_mb (地址空间，RLIMIT_AS)、nofile (打开文件数)、
+  fsize_mb (单个输出文件大小，RLIMIT_FSIZE)、nice (调度优先级增量)；0 表示不限制
+- 默认值 RENDER_LIMIT_*；RENDER_LIMITS 按接口与用户等级覆盖，如 "devtools=cpu:120;devtools/guest=cpu:60,memory_mb:3072"
+  接口：animate / devtools / upgrade；等级：user（已登录）/ guest（未登录）；<接口>/<等级> 在 <接口> 之后应用
+- 常驻 worker 为每个受限任务 fork 一个子进程执行（继承已 import 的 manim），限制只作用于该子进程及其 ffmpeg/latex 子进程；
+  子进程回退路径在 exec 前设置。两者都在渲染进程自己的进程组中，超时/取消时整组结束
+- exceeded() 根据退出信号与 stderr 判断触发了哪一项限制，SSE error 事件的 limit 字段即其结果
+- 仅 POSIX 生效。render_worker.py 以脚本目录直接 import 本模块，因此不依赖 logic 包中的其他模块
+"""
+import os
+import signal
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+LIMIT_KEYS = ("cpu", "memory_mb", "nofile", "fsize_mb", "nice")
+
+DEFAULT_LIMITS = {
+    "cpu": int(os.getenv("RENDER_LIMIT_CPU", 300)),
+    "memory_mb": int(os.getenv("RENDER_LIMIT_MEMORY_MB", 4096)),
+    "nofile": int(os.getenv("RENDER_LIMIT_NOFILE", 1024)),
+    "fsize_mb": int(os.getenv("RENDER_LIMIT_FSIZE_MB", 1024)),
+    "nice": int(os.getenv("RENDER_LIMIT_NICE", 5)),
+}
+RENDER_LIMITS = os.getenv("RENDER_LIMITS", "devtools/guest=cpu:120,memory_mb:3072")
+
+# 软限制到期先收到 SIGXCPU（可识别），硬限制再多给几秒后 SIGKILL
+CPU_GRACE = 5
+
+LIMIT_LABELS = {
+    "cpu": ("CPU 时间", "秒"),
+    "memory_mb": ("内存", "MB"),
+    "nofile": ("打开文件数", ""),
+    "fsize_mb": ("输出文件大小", "MB"),
+}
+
+# 触发限制后 Python / ffmpeg 留在 stderr 中的特征
+_MARKERS = (
+    ("memory_mb", ("MemoryError", "Cannot allocate memory", "std::bad_alloc")),
+    ("nofile", ("Too many open files",)),
+    ("fsize_mb", ("File too large",)),
+)
+
+
+def _parse_overrides(spec):
+    """"devtools=cpu:120;devtools/guest=cpu:60,memory_mb:3072" -> {"devtools": {"cpu": 120}, ...}"""
+    profiles = {}
+    for group in spec.split(";"):
+        if "=" not in group:
+            continue
+        name, items = group.split("=", 1)
+        values = profiles.setdefault(name.strip(), {})
+        for item in items.split(","):
+            if ":" in item:
+                key, n = item.split(":", 1)
+                if key.strip() in LIMIT_KEYS:
+                    values[key.strip()] = int(n)
+    return profiles
+
+
+_PROFILES = _parse_overrides(RENDER_LIMITS)
+
+
+def tier_of(user_key):
+    """用户等级：render_scheduler 使用的用户标识为 user:<用户名> 或 ip:<地址>。"""
+    return "user" if user_key and user_key.startswith("user:") else "guest"
+
+
+def limits_for(endpoint, tier="guest"):
+    """按接口与用户等级得到本次渲染的限制；非 POSIX 平台返回 None（不限制）。"""
+    if resource is None:
+        return None
+    limits = dict(DEFAULT_LIMITS)
+    limits.update(_PROFILES.get(endpoint, {}))
+    limits.update(_PROFILES.get(f"{endpoint}/{tier}", {}))
+    return limits
+
+
+def _set(res, soft, hard=None):
+    """设置 rlimit，不超过当前硬限制（非特权进程不能调高）。"""
+    hard = soft if hard is None else hard
+    _, cur_hard = resource.getrlimit(res)
+    if cur_hard != resource.RLIM_INFINITY:
+        soft, hard = min(soft, cur_hard), min(hard, cur_hard)
+    resource.setrlimit(res, (soft, hard))
+
+
+def apply(limits):
+    """在渲染进程（fork 的子进程或 exec 之前）中施加限制。"""
+    if not limits or resource is None:
+        return
+    if limits.get("cpu"):
+        _set(resource.RLIMIT_CPU, limits["cpu"], limits["cpu"] + CPU_GRACE)
+    if limits.get("memory_mb"):
+        _set(resource.RLIMIT_AS, limits["memory_mb"] * 1024 * 1024)
+    if limits.get("nofile"):
+        _set(resource.RLIMIT_NOFILE, limits["nofile"])
+    if limits.get("fsize_mb"):
+        _set(resource.RLIMIT_FSIZE, limits["fsize_mb"] * 1024 * 1024)
+    if limits.get("nice"):
+        os.nice(limits["nice"])
+
+
+def exceeded(returncode, stderr_text, limits):
+    """触发的限制项 (cpu / memory_mb / nofile / fsize_mb)，未触发或无法判断时返回 None。"""
+    if not limits or returncode == 0:
+        return None
+    # 超时/取消同样以 SIGKILL 结束进程组，因此只认软限制的 SIGXCPU；Python 忽略 SIGXFSZ，超限时写入抛出 EFBIG
+    if resource is not None and limits.get("cpu") and returncode == -signal.SIGXCPU:
+        return "cpu"
+    tail = (stderr_text or "")[-4000:]
+    for key, markers in _MARKERS:
+        if limits.get(key) and any(m in tail for m in markers):
+            return key
+    return None
+
+
+def describe(limit, limits):
+    """SSE 错误提示，如 "超出资源限制：CPU 时间 (120 秒)"。"""
+    label, unit = LIMIT_LABELS.get(limit, (limit, ""))
+    value = (limits or {}).get(limit)
+    if not value:
+        return f"超出资源限制：{label}"
+    return f"超出资源限制：{label} ({value}{' ' + unit if unit else ''})"
@@ -0,0 +1,188 @@
+# logic/render_scheduler.py
+"""
+渲染任务调度器：限制同时进行的 Manim 渲染数量，多出的任务进入有界队列排队。
+
+- 同时渲染数 RENDER_MAX_CONCURRENT（默认与渲染进程池大小一致）
+- 排队上限 RENDER_MAX_QUEUE，队列满时 submit 直接抛出 QueueFull，由接口返回 429
+- 每个用户一个 FIFO 队列，用户之间轮转出队，避免单个用户的批量任务挤占他人
+- wait() 在排名变化时产出当前位置 (1 表示下一个执行)，供 SSE 推送 "排队中" 事件
+- 后台任务 (submit(user, background=True)，如高质量升级渲染) 单独排队：只有没有交互任务排队、且有空闲渲染槽时才分配，
+  同时运行的后台任务不超过 RENDER_BACKGROUND_CONCURRENT；交互任务到来而没有空闲槽时抢占最近开始的后台任务
+  （置位 ticket.cancel 并标记 preempted，持有者结束渲染、释放渲染槽后自行重新排队）
+
+用法：
+    ticket = scheduler.submit(user_key)
+    async for position in scheduler.wait(ticket):
+        yield ...  # 推送排队位置
+    try:
+        ... 渲染 ...
+    finally:
+        scheduler.release(ticket)
+"""
+import os
+import asyncio
+import itertools
+import threading
+from collections import deque, OrderedDict
+
+from logic.render_pool import RENDER_POOL_SIZE
+
+RENDER_MAX_CONCURRENT = int(os.getenv("RENDER_MAX_CONCURRENT", max(RENDER_POOL_SIZE, 1)))
+RENDER_MAX_QUEUE = int(os.getenv("RENDER_MAX_QUEUE", 20))
+RENDER_BACKGROUND_CONCURRENT = int(os.getenv("RENDER_BACKGROUND_CONCURRENT", 1))
+RENDER_BACKGROUND_QUEUE = int(os.getenv("RENDER_BACKGROUND_QUEUE", 20))
+
+
+class QueueFull(Exception):
+    """排队人数已达上限。"""
+
+
+class RenderTicket:
+    _ids = itertools.count(1)
+
+    def __init__(self, user, background=False):
+        self.id = next(self._ids)
+        self.user = user
+        self.background = background
+        self.position = 0
+        self.granted = False
+        self.released = False
+        self.preempted = False
+        self.changed = asyncio.Event()
+        # 传给 render_pool 的 cancel：后台任务被抢占时置位，结束渲染进程组
+        self.cancel = threading.Event()
+
+
+class RenderScheduler:
+    def __init__(self, max_concurrent=RENDER_MAX_CONCURRENT, max_queue=RENDER_MAX_QUEUE,
+                 background_concurrent=RENDER_BACKGROUND_CONCURRENT, background_queue=RENDER_BACKGROUND_QUEUE):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.background_concurrent = background_concurrent
+        self.background_queue = background_queue
+        self.running = 0
+        self.preemptions = 0
+        self._background = deque()
+        self._background_running = []
+        # user -> deque[RenderTicket]
+        self._queues = OrderedDict()
+        # user -> 最近一次出队的序号；最久未被服务的用户优先，即轮转
+        self._last_served = {}
+        self._serve_seq = itertools.count(1)
+
+    @property
+    def pending(self):
+        return sum(len(q) for q in self._queues.values())
+
+    def is_full(self):
+        """新任务既拿不到空闲渲染槽、也进不了队列时为 True。"""
+        return self.running >= self.max_concurrent and self.pending >= self.max_queue
+
+    def submit(self, user, background=False):
+        if background:
+            if len(self._background) >= self.background_queue:
+                raise QueueFull()
+            ticket = RenderTicket(user, background=True)
+            self._background.append(ticket)
+            self._dispatch()
+            return ticket
+        if self.is_full():
+            raise QueueFull()
+        ticket = RenderTicket(user)
+        self._queues.setdefault(user, deque()).append(ticket)
+        self._dispatch()
+        if not ticket.granted:
+            self._preempt()
+        return ticket
+
+    def _preempt(self):
+        """交互任务在排队：抢占一个仍在运行的后台任务，它释放渲染槽后交互任务即可出队。"""
+        for ticket in reversed(self._background_running):
+            if not ticket.preempted:
+                ticket.preempted = True
+                ticket.cancel.set()
+                self.preemptions += 1
+                return
+
+    @staticmethod
+    def _next_user(queues, last_served):
+        return min((u for u, q in queues.items() if q), key=lambda u: last_served.get(u, 0))
+
+    def _dispatch_order(self):
+        """按轮转规则模拟当前所有排队任务的出队顺序。"""
+        queues = OrderedDict((u, deque(q)) for u, q in self._queues.items())
+        last_served = dict(self._last_served)
+        order = []
+        while any(queues.values()):
+            user = self._next_user(queues, last_served)
+            order.append(queues[user].popleft())
+            last_served[user] = max(last_served.values(), default=0) + 1
+        return order
+
+    def _dispatch(self):
+        while self.running < self.max_concurrent and self._queues:
+            user = self._next_user(self._queues, self._last_served)
+            q = self._queues[user]
+            ticket = q.popleft()
+            if not q:
+                del self._queues[user]
+            self._last_served[user] = next(self._serve_seq)
+            self.running += 1
+            ticket.granted = True
+            ticket.position = 0
+            ticket.changed.set()
+        # 后台任务只用交互任务用不上的空闲槽
+        while (not self._queues and self._background and self.running < self.max_concurrent
+               and len(self._background_running) < self.background_concurrent):
+            ticket = self._background.popleft()
+            self.running += 1
+            self._background_running.append(ticket)
+            ticket.granted = True
+            ticket.changed.set()
+        if not self._queues and self.running == 0:
+            # 完全空闲时轮转状态可以安全清空，防止字典随用户数增长
+            self._last_served.clear()
+        for pos, ticket in enumerate(self._dispatch_order(), 1):
+            if ticket.position != pos:
+                ticket.position = pos
+                ticket.changed.set()
+
+    async def wait(self, ticket):
+        """等待渲染槽；排名变化时产出当前位置。被取消时自动退出队列。"""
+        try:
+            while not ticket.granted:
+                ticket.changed.clear()
+                yield ticket.position
+                if not ticket.granted:
+                    await ticket.changed.wait()
+        except BaseException:
+            self.release(ticket)
+            raise
+
+    def release(self, ticket):
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.granted:
+            self.running -= 1
+            if ticket.background:
+                self._background_running.remove(ticket)
+        elif ticket.background:
+            if ticket in self._background:
+                self._background.remove(ticket)
+        else:
+            q = self._queues.get(ticket.user)
+            if q and ticket in q:
+                q.remove(ticket)
+                if not q:
+                    del self._queues[ticket.user]
+        self._dispatch()
+
+    def stats(self):
+        return {"running": self.running, "pending": self.pending,
+                "max_concurrent": self.max_concurrent, "max_queue": self.max_queue,
+                "background_running": len(self._background_running),
+                "background_pending": len(self._background), "preemptions": self.preemptions}
+
+
+scheduler = RenderScheduler()
@@ -0,0 +1,163 @@
+# logic/render_upgrade.py
+"""
+渐进式交付的最后一步：480p 视频交付后，在后台以更高质量重新渲染同一份场景代码。
+
+- 质量由 RENDER_UPGRADE_QUALITY 指定（-qm 720p30 / -qh 1080p60），默认留空关闭
+- start() 创建独立的后台任务，不占用生成动画的 SSE 流与任务记录（complete 之后流即结束）；
+  客户端轮询 GET /api/jobs/<task_id>/upgrade，status() 返回 rendering / ready（带地址）/ skipped，
+  结果保留 RENDER_UPGRADE_RESULT_TTL 秒
+- 先按 (代码, 质量) 查渲染缓存，命中直接返回；渲染结果同样写入渲染缓存
+- 以后台任务向 render_scheduler 申请渲染槽：只有没有交互任务排队、且有空闲槽时才开始；交互任务到来时被抢占
+  （结束进程组）后重新排队。重试沿用同一脚本名，manim 在 videos/<脚本名>/<质量>/partial_movie_files 中
+  已完成的片段直接复用，被抢占前的工作不会白做；Tex 公式缓存与低质量渲染共用
+- 等待渲染槽累计超过 RENDER_UPGRADE_WAIT 秒、或被抢占超过 RENDER_UPGRADE_MAX_PREEMPTIONS 次时放弃
+"""
+import os
+import time
+import shutil
+import asyncio
+import logging
+import subprocess
+
+from logic import render_pool, render_scheduler, render_cache, render_sandbox, video_post
+
+logger = logging.getLogger(__name__)
+
+RENDER_UPGRADE_QUALITY = os.getenv("RENDER_UPGRADE_QUALITY", "")
+RENDER_UPGRADE_WAIT = float(os.getenv("RENDER_UPGRADE_WAIT", 300))
+RENDER_UPGRADE_TIMEOUT = float(os.getenv("RENDER_UPGRADE_TIMEOUT", 600))
+RENDER_UPGRADE_MAX_PREEMPTIONS = int(os.getenv("RENDER_UPGRADE_MAX_PREEMPTIONS", 5))
+RENDER_UPGRADE_RESULT_TTL = float(os.getenv("RENDER_UPGRADE_RESULT_TTL", 600))
+
+
+class RenderUpgrader:
+    def __init__(self, quality=RENDER_UPGRADE_QUALITY, media_dir=render_cache.STATIC_VIDEO_DIR,
+                 scheduler=render_scheduler.scheduler, cache=render_cache.cache):
+        self.quality = quality
+        self.media_dir = os.path.abspath(media_dir)
+        self.scheduler = scheduler
+        self.cache = cache
+        self.label = render_pool.QUALITY_DIRS.get(render_pool.QUALITY_FLAGS.get(quality, quality), "")
+        self._tasks = {}  # task_id -> 进行中的 asyncio.Task
+        self._results = {}  # task_id -> (结束时间, 结果)
+        self.completed = 0
+        self.cached = 0
+        self.preempted = 0
+        self.skipped = 0
+
+    @property
+    def enabled(self):
+        return bool(self.quality)
+
+    async def _acquire(self, ticket):
+        async for _ in self.scheduler.wait(ticket):
+            pass
+
+    def _cleanup(self, py_path):
+        try:
+            os.remove(py_path)
+        except OSError:
+            pass
+        module = os.path.splitext(os.path.basename(py_path))[0]
+        shutil.rmtree(os.path.join(self.media_dir, "videos", module), ignore_errors=True)
+
+    async def upgrade(self, code, user_key, task_id):
+        """渲染高质量版本。成功返回 {"quality", "video_url", "preview_url"?}，放弃或失败返回 None。"""
+        if not self.enabled:
+            return None
+        key = render_cache.make_key(code, quality=self.quality)
+        cached_file = self.cache.lookup(key)
+        if cached_file:
+            self.cached += 1
+            urls = await asyncio.get_running_loop().run_in_executor(
+                None, video_post.video_urls, os.path.join(self.media_dir, cached_file))
+            return {"quality": self.label, **urls}
+
+        py_path = os.path.join(self.media_dir, f"hq_{task_id}.py")
+        output_file = f"{task_id}_{self.label}.mp4"
+        job = render_pool.make_job(py_path, "GenScene", self.quality, self.media_dir, output_file,
+                                   cwd=self.media_dir,
+                                   limits=render_sandbox.limits_for("upgrade", render_sandbox.tier_of(user_key)))
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + RENDER_UPGRADE_WAIT
+        try:
+            with open(py_path, "w", encoding="utf-8") as f:
+                f.write(code)
+            for _ in range(RENDER_UPGRADE_MAX_PREEMPTIONS + 1):
+                try:
+                    ticket = self.scheduler.submit(user_key, background=True)
+                except render_scheduler.QueueFull:
+                    break
+                try:
+                    # 等待超时时 wait() 被取消，自动退出队列
+                    await asyncio.wait_for(self._acquire(ticket), max(deadline - time.monotonic(), 0))
+                    returncode, stderr_text, manifest = await loop.run_in_executor(
+                        None, render_pool.run_render, job, None, RENDER_UPGRADE_TIMEOUT, ticket.cancel)
+                except (asyncio.TimeoutError, subprocess.TimeoutExpired):
+                    break
+                finally:
+                    # 客户端断开 (CancelledError) 时同样结束渲染进程组
+                    ticket.cancel.set()
+                    self.scheduler.release(ticket)
+                if ticket.preempted and returncode != 0:
+                    self.preempted += 1
+                    continue
+                if returncode != 0:
+                    logger.warning(f"Upgrade render failed for {task_id}: {stderr_text[-500:]}")
+                    break
+                final_path = os.path.join(self.media_dir, output_file)
+                if not render_pool.publish_output(manifest, final_path):
+                    break
+                urls = await loop.run_in_executor(None, video_post.finalize, final_path)
+                self.cache.store(key, output_file)
+                self.completed += 1
+                return {"quality": self.label, **urls}
+        finally:
+            self._cleanup(py_path)
+        self.skipped += 1
+        return None
+
+    def start(self, code, user_key, task_id):
+        """在独立的后台任务中渲染高质量版本，结果通过 status(task_id) 查询。"""
+        if not self.enabled or task_id in self._tasks:
+            return
+        self._prune()
+        self._tasks[task_id] = asyncio.ensure_future(self._run(code, user_key, task_id))
+
+    async def _run(self, code, user_key, task_id):
+        try:
+            result = await self.upgrade(code, user_key, task_id)
+        except asyncio.CancelledError:
+            result = None
+            raise
+        except Exception as e:
+            logger.error(f"Upgrade {task_id} failed: {e}", exc_info=True)
+            result = None
+        finally:
+            self._tasks.pop(task_id, None)
+            self._results[task_id] = (time.monotonic(), result)
+
+    def status(self, task_id):
+        """{"state": "rendering"} / {"state": "ready", "quality", "video_url", ...} / {"state": "skipped"}；未知任务返回 None。"""
+        if task_id in self._tasks:
+            return {"state": "rendering"}
+        if task_id not in self._results:
+            return None
+        result = self._results[task_id][1]
+        return {"state": "ready", **result} if result else {"state": "skipped"}
+
+    def _prune(self):
+        now = time.monotonic()
+        for task_id in [t for t, (at, _) in self._results.items() if now - at > RENDER_UPGRADE_RESULT_TTL]:
+            del self._results[task_id]
+
+    def cancel_all(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+
+    def stats(self):
+        return {"quality": self.label or None, "running": len(self._tasks), "completed": self.completed,
+                "cached": self.cached, "preempted": self.preempted, "skipped": self.skipped}
+
+
+upgrader = RenderUpgrader()
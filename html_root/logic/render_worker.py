@@ -0,0 +1,237 @@
+# logic/render_worker.py
+"""
+常驻 Manim 渲染进程（由 logic/render_pool.py 启动，不要直接 import）。
+
+启动时一次性完成 `import manim`、配置解析与 LaTeX 模板初始化，之后循环从 stdin 读取
+JSON 任务，在同一进程内渲染，省去每次 `python -m manim` 的冷启动开销。
+
+通信协议（每行一个 JSON）：
+    stdin  <- {"py_path", "scene_name", "quality", "media_dir", "output_file", "cwd", "dry_run", "save_last_frame", "limits"}
+    stdout -> {"type": "ready"} / {"type": "fatal", "message"}
+              {"type": "log", "text"}            # 与原子进程 stderr 的逐行输出一致
+              {"type": "done", "returncode", "stderr", "manifest"}
+
+manifest 取自 SceneFileWriter 记录的实际输出路径，调用方据此直接移动文件，无需搜索目录：
+    {"movie_file_path", "duration", "frame_rate", "frames", "size",
+     "timings": {"load", "construct", "combine", "total"}}   # 秒
+save_last_frame 任务 (-s) 跳过动画、只输出最后一帧 PNG，manifest 中为 "image_file_path"，movie_file_path 为空
+带 limits 的任务在 fork 出的子进程中按 render_sandbox.apply 施加 rlimit 后执行（manim 已 import，无需冷启动），
+子进程被信号结束时由本进程补发 done，returncode 为 -信号值（与子进程回退路径一致）
+"""
+import os
+import sys
+import json
+import time
+import logging
+import traceback
+import importlib.util
+
+import render_sandbox  # 与本脚本同目录
+
+
+class _LineStream:
+    """替代 sys.stderr：按行转发给父进程，同时保留完整文本用于报错修正。"""
+
+    def __init__(self, send):
+        self._send = send
+        self._buf = ""
+        self.chunks = []
+
+    def write(self, s):
+        if not s:
+            return 0
+        self.chunks.append(s)
+        self._buf += s
+        while "\n" in self._buf:
+            line, self._buf = self._buf.split("\n", 1)
+            line = line.rstrip()
+            if line:
+                self._send(type="log", text=line)
+        return len(s)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def close_line(self):
+        if self._buf.strip():
+            self._send(type="log", text=self._buf.rstrip())
+        self._buf = ""
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+
+class _StreamHandler(logging.Handler):
+    """把 manim logger 的 WARNING 及以上写入当前任务的 stderr 流。"""
+
+    def __init__(self, stream):
+        super().__init__(level=logging.WARNING)
+        self.stream = stream
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + "\n")
+        except Exception:
+            pass
+
+
+def _load_scene_class(py_path, scene_name):
+    module_name = os.path.splitext(os.path.basename(py_path))[0]
+    spec = importlib.util.spec_from_file_location(module_name, py_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    scene_cls = getattr(module, scene_name, None)
+    if scene_cls is None:
+        raise AttributeError(f"{scene_name} is not in the script")
+    return module_name, scene_cls
+
+
+def _timed_finish(writer, timings):
+    """记录 SceneFileWriter.finish（合并分段视频）的耗时。"""
+    finish = writer.finish
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return finish(*args, **kwargs)
+        finally:
+            timings["combine"] = round(time.perf_counter() - start, 3)
+
+    writer.finish = wrapper
+
+
+def _build_manifest(scene, config, timings):
+    writer = getattr(scene.renderer, "file_writer", None)
+    movie = getattr(writer, "movie_file_path", None)
+    path = os.path.abspath(str(movie)) if movie else None
+    if path and not os.path.exists(path):
+        path = None
+    image = getattr(writer, "image_file_path", None) if config.save_last_frame else None
+    image_path = os.path.abspath(str(image)) if image and os.path.exists(str(image)) else None
+    duration = float(getattr(scene.renderer, "time", 0) or 0)
+    frame_rate = float(config.frame_rate)
+    return {
+        "movie_file_path": path,
+        "image_file_path": image_path,
+        "duration": round(duration, 3),
+        "frame_rate": frame_rate,
+        "frames": int(round(duration * frame_rate)),
+        "size": os.path.getsize(path) if path else 0,
+        "timings": timings,
+    }
+
+
+def _run_job(job, send, config, tempconfig):
+    stream = _LineStream(send)
+    handler = _StreamHandler(stream)
+    manim_logger = logging.getLogger("manim")
+    old_stderr = sys.stderr
+    old_cwd = os.getcwd()
+    module_name = None
+    returncode = 0
+    manifest = None
+    timings = {}
+    job_start = time.perf_counter()
+    sys.stderr = stream
+    manim_logger.addHandler(handler)
+    try:
+        if job.get("cwd"):
+            os.chdir(job["cwd"])
+        opts = {
+            "media_dir": job["media_dir"],
+            "quality": job.get("quality", "low_quality"),
+            "input_file": job["py_path"],
+            "scene_names": [job["scene_name"]],
+            "output_file": job.get("output_file") or "",
+        }
+        if job.get("dry_run"):
+            # 预检：完整执行 construct（LaTeX 编译、属性错误等都会暴露），但跳过逐帧渲染且不写出文件
+            opts.update({"dry_run": True, "save_last_frame": True})
+        elif job.get("save_last_frame"):
+            # 预览帧：同样完整执行 construct 但跳过动画，只写出最后一帧
+            opts.update({"save_last_frame": True, "write_to_movie": False})
+        with tempconfig(opts):
+            start = time.perf_counter()
+            module_name, scene_cls = _load_scene_class(job["py_path"], job["scene_name"])
+            scene = scene_cls()
+            timings["load"] = round(time.perf_counter() - start, 3)
+            if getattr(scene.renderer, "file_writer", None) is not None:
+                _timed_finish(scene.renderer.file_writer, timings)
+            start = time.perf_counter()
+            scene.render()
+            timings["construct"] = round(time.perf_counter() - start - timings.get("combine", 0), 3)
+            timings["total"] = round(time.perf_counter() - job_start, 3)
+            manifest = _build_manifest(scene, config, timings)
+    except BaseException:
+        stream.write(traceback.format_exc())
+        returncode = 1
+    finally:
+        stream.close_line()
+        manim_logger.removeHandler(handler)
+        sys.stderr = old_stderr
+        os.chdir(old_cwd)
+        if module_name:
+            sys.modules.pop(module_name, None)
+    send(type="done", returncode=returncode, stderr=stream.getvalue(), manifest=manifest)
+
+
+def _run_limited(job, send, config, tempconfig):
+    """fork 子进程施加资源限制后执行任务。子进程发出 done 后以 0 退出；否则（被信号结束、限制设置失败）由父进程发出 done。"""
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            render_sandbox.apply(job["limits"])
+            _run_job(job, send, config, tempconfig)
+            code = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(code)
+    _, status, usage = os.wait4(pid, 0)
+    if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+        return
+    returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status) or 1
+    cpu = usage.ru_utime + usage.ru_stime
+    send(type="done", returncode=returncode, manifest=None,
+         stderr=f"Render process terminated (exit code {returncode}, CPU time {cpu:.1f}s)")
+
+
+def main():
+    # 协议通道独占原 stdout；manim 的 console 输出与原子进程一样丢弃 (stdout=DEVNULL)
+    proto = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8", buffering=1)
+    devnull_fd = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull_fd, sys.stdout.fileno())
+    sys.stdout = open(os.devnull, "w", encoding="utf-8")
+
+    def send(**msg):
+        proto.write(json.dumps(msg, ensure_ascii=False) + "\n")
+        proto.flush()
+
+    try:
+        import manim  # noqa: F401  预热：生成脚本中的 `from manim import *` 将直接命中 sys.modules
+        from manim import config, tempconfig
+        _ = config.tex_template
+    except Exception as ex:
+        send(type="fatal", message=str(ex) or repr(ex))
+        return 1
+
+    send(type="ready")
+    for raw in sys.stdin:
+        raw = raw.strip()
+        if not raw:
+            continue
+        job = json.loads(raw)
+        if job.get("limits") and hasattr(os, "fork"):
+            _run_limited(job, send, config, tempconfig)
+        else:
+            _run_job(job, send, config, tempconfig)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
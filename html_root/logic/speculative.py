@@ -0,0 +1,197 @@
+# logic/speculative.py
+"""
+推测式多候选生成：服务器空闲时，同一请求并发向大模型要 K 份场景代码（不同温度 + prompt.CANDIDATE_VARIANTS 中的提示词变体），
+各自预检、并行渲染，采用最先渲染成功的一份，其余立即取消。第一份失败后"修正 → 再渲染一遍"的串行往返因此常常可以省掉。
+
+- K 随渲染负载自适应（candidate_count）：有任务排队时为 1（不推测，走原流程）；否则为 1 + 可用的后台渲染槽数，
+  不超过 SPECULATIVE_CANDIDATES。SPECULATIVE_CANDIDATES<=1 关闭
+- 第 0 个候选（原提示词）以交互任务排队；其余以后台任务排队，只用空闲渲染槽，交互任务到来时被抢占（直接放弃），
+  推测不会拖慢繁忙的服务器
+- 候选代码命中渲染缓存时直接胜出；未通过静态预检的候选不排队
+- 全部候选都失败时返回序号最小的失败候选（代码与报错），调用方照旧进入"修正后重试"流程；
+  该候选未真正渲染（被抢占）时 returncode 为 None，调用方按原流程渲染；没有任何候选代码时 code 为 None
+- run() 为异步生成器，产出 ("generated", i, code) / ("rejected", i, 报错) / ("dropped", i, 原因) / ("log", i, 日志行)，
+  最后是 ("winner", i, code, manifest, cached_file) 或 ("failed", code, returncode, stderr)；
+  关闭时结束落选候选的渲染进程组并删除其脚本与中间目录（胜出者的输出由调用方 publish_output 取走）
+"""
+import os
+import shutil
+import asyncio
+import logging
+
+from logic import render_pool, render_scheduler, render_cache
+from logic.llm_gateway import gateway
+from logic.prompt import candidate_prompt
+from logic.code_validator import strip_code_fences, preflight, format_preflight_errors
+
+logger = logging.getLogger(__name__)
+
+SPECULATIVE_CANDIDATES = int(os.getenv("SPECULATIVE_CANDIDATES", 1))
+SPECULATIVE_TEMPERATURES = [float(t) for t in os.getenv("SPECULATIVE_TEMPERATURES", "0.7,0.3,1.0").split(",") if t]
+SPECULATIVE_MODEL = os.getenv("SPECULATIVE_MODEL", "qwen-plus")
+
+
+class Speculator:
+    def __init__(self, max_candidates=SPECULATIVE_CANDIDATES, temperatures=SPECULATIVE_TEMPERATURES,
+                 model=SPECULATIVE_MODEL, scheduler=render_scheduler.scheduler, cache=render_cache.cache, llm=gateway):
+        self.max_candidates = max_candidates
+        self.temperatures = temperatures or [0.7]
+        self.model = model
+        self.scheduler = scheduler
+        self.cache = cache
+        self.llm = llm
+        self.runs = 0
+        self.candidates = 0
+        self.wins = {}  # 候选序号 -> 胜出次数
+        self.rejected = 0
+        self.dropped = 0
+        self.no_winner = 0
+
+    @property
+    def enabled(self):
+        return self.max_candidates > 1
+
+    def candidate_count(self):
+        """按当前负载决定候选数：有交互或后台任务排队时不推测；额外候选数不超过空闲渲染槽（扣除第 0 个候选占用的一个）。"""
+        if not self.enabled:
+            return 1
+        stats = self.scheduler.stats()
+        if stats["pending"] or stats["background_pending"]:
+            return 1
+        free = stats["max_concurrent"] - stats["running"]
+        background_free = self.scheduler.background_concurrent - stats["background_running"]
+        return 1 + max(0, min(self.max_candidates - 1, free - 1, background_free))
+
+    def _script_path(self, media_dir, task_id, index):
+        return os.path.join(media_dir, f"gen_{task_id}_c{index}.py")
+
+    def _cleanup(self, media_dir, task_id, index, keep_output=False):
+        py_path = self._script_path(media_dir, task_id, index)
+        try:
+            os.remove(py_path)
+        except OSError:
+            pass
+        if not keep_output:
+            module = os.path.splitext(os.path.basename(py_path))[0]
+            shutil.rmtree(os.path.join(media_dir, "videos", module), ignore_errors=True)
+
+    async def _candidate(self, index, prompt, user_key, task_id, media_dir, limits, events):
+        """生成、预检并渲染一个候选，结果以 ("result", i, 状态, code, 详情) 放入 events。"""
+        def result(status, code=None, detail=None):
+            events.put_nowait(("result", index, status, code, detail))
+
+        try:
+            raw = await self.llm.chat(model=self.model, messages=[{"role": "user", "content": candidate_prompt(prompt, index)}],
+                                      temperature=self.temperatures[index % len(self.temperatures)])
+        except Exception as e:
+            logger.warning(f"Speculative candidate {index} LLM error: {e}")
+            result("dropped", detail=f"生成失败: {e}")
+            return
+        code = strip_code_fences(raw).strip()
+        events.put_nowait(("generated", index, code))
+
+        # 每个候选恰好放入一个 result：run() 按 result 计数，漏掉会一直等待
+        try:
+            await self._render(index, code, user_key, task_id, media_dir, limits, events, result)
+        except Exception as e:
+            logger.warning(f"Speculative candidate {index} render error: {e}")
+            result("dropped", code, f"渲染异常: {e}")
+
+    async def _render(self, index, code, user_key, task_id, media_dir, limits, events, result):
+        cached_file = self.cache.lookup(render_cache.make_key(code))
+        if cached_file:
+            result("cached", code, cached_file)
+            return
+        errors = preflight(code)
+        if errors:
+            result("rejected", code, format_preflight_errors(errors))
+            return
+
+        background = index > 0
+        try:
+            ticket = self.scheduler.submit(user_key, background=background)
+        except render_scheduler.QueueFull:
+            result("dropped", code, "渲染队列已满")
+            return
+        try:
+            async for _ in self.scheduler.wait(ticket):
+                pass
+            py_path = self._script_path(media_dir, task_id, index)
+            with open(py_path, "w", encoding="utf-8") as f:
+                f.write(code)
+            job = render_pool.make_job(py_path, "GenScene", "-ql", media_dir, f"{task_id}_c{index}.mp4",
+                                       cwd=media_dir, limits=limits)
+            loop = asyncio.get_running_loop()
+
+            def put(item):
+                if item[0] == "log":
+                    loop.call_soon_threadsafe(events.put_nowait, ("log", index, item[1]))
+
+            returncode, stderr_text, manifest = await loop.run_in_executor(
+                None, render_pool.run_render, job, put, None, ticket.cancel)
+        finally:
+            # 被取消（已有候选胜出、客户端断开）时同样结束渲染进程组
+            ticket.cancel.set()
+            self.scheduler.release(ticket)
+        if returncode == 0 and manifest:
+            result("success", code, manifest)
+        elif ticket.preempted:
+            result("dropped", code, "被交互任务抢占")
+        else:
+            result("failed", code, (returncode, stderr_text))
+
+    async def run(self, prompt, k, user_key, task_id, media_dir, limits=None):
+        self.runs += 1
+        self.candidates += k
+        events = asyncio.Queue()
+        tasks = [asyncio.ensure_future(self._candidate(i, prompt, user_key, task_id, media_dir, limits, events))
+                 for i in range(k)]
+        winner = None
+        failures = {}  # 候选序号 -> (code, returncode, stderr)
+        try:
+            remaining = k
+            while remaining:
+                item = await events.get()
+                if item[0] != "result":
+                    yield item
+                    continue
+                remaining -= 1
+                _, index, status, code, detail = item
+                if status in ("success", "cached"):
+                    winner = index
+                    self.wins[index] = self.wins.get(index, 0) + 1
+                    manifest, cached_file = (detail, None) if status == "success" else (None, detail)
+                    yield ("winner", index, code, manifest, cached_file)
+                    return
+                if status == "rejected":
+                    self.rejected += 1
+                    failures[index] = (code, 1, detail)
+                    yield ("rejected", index, detail)
+                elif status == "failed":
+                    failures[index] = (code, detail[0], detail[1])
+                    yield ("dropped", index, "渲染失败")
+                else:
+                    self.dropped += 1
+                    if code:
+                        failures.setdefault(index, (code, None, None))
+                    yield ("dropped", index, detail)
+            self.no_winner += 1
+            if failures:
+                code, returncode, stderr_text = failures[min(failures)]
+                yield ("failed", code, returncode, stderr_text)
+            else:
+                yield ("failed", None, None, None)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for i in range(k):
+                self._cleanup(media_dir, task_id, i, keep_output=(i == winner))
+
+    def stats(self):
+        return {"enabled": self.enabled, "max_candidates": self.max_candidates, "runs": self.runs,
+                "candidates": self.candidates, "rejected": self.rejected, "dropped": self.dropped,
+                "no_winner": self.no_winner, "wins": {str(i): n for i, n in sorted(self.wins.items())}}
+
+
+speculator = Speculator()
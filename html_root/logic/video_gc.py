@@ -0,0 +1,229 @@
+# logic/video_gc.py
+"""
+static/videos 清理任务：每次渲染都会留下 <uuid>.mp4，失败或取消的渲染还会留下 videos/gen_*、dev_* 中间目录、
+partial_movie_files、Tex 缓存和临时 .py。后台定期清理，磁盘占用不再无限增长。
+
+每轮依次：
+  1. 清理孤立中间产物：超过 VIDEO_GC_ORPHAN_AGE 未修改的 videos/<脚本名>/ 目录、顶层 .py/.tmp 文件、没有对应视频的预览帧
+     （阈值远大于渲染超时，不会删到正在渲染的任务）
+  2. Tex/texts/images 缓存中超过 VIDEO_GC_MAX_AGE 未修改的文件
+  3. 超过 VIDEO_GC_MAX_AGE 未被访问的视频
+  4. 总占用仍超过 VIDEO_GC_QUOTA_MB 时，按最近访问时间从旧到新淘汰视频，直到降到配额的 VIDEO_GC_LOW_WATERMARK
+
+视频的最近访问时间由 touch() 记录（/videos 静态路由每次读取时调用），保存在 .access_index.json。
+删除视频时一并删除其预览图 (<名称>.preview.webp/gif)。删除视频前先经 render_cache.release_for_gc：被其他模块 retain 的、或对应已保存动画脚本（protected_keys）的视频不会删除。
+"""
+import os
+import json
+import time
+import shutil
+import asyncio
+import logging
+import threading
+
+from logic import render_cache, video_post
+
+logger = logging.getLogger(__name__)
+
+VIDEO_GC_QUOTA_MB = float(os.getenv("VIDEO_GC_QUOTA_MB", 2048))
+VIDEO_GC_MAX_AGE = float(os.getenv("VIDEO_GC_MAX_AGE", 7 * 86400))
+VIDEO_GC_ORPHAN_AGE = float(os.getenv("VIDEO_GC_ORPHAN_AGE", 3600))
+VIDEO_GC_INTERVAL = float(os.getenv("VIDEO_GC_INTERVAL", 600))
+VIDEO_GC_LOW_WATERMARK = float(os.getenv("VIDEO_GC_LOW_WATERMARK", 0.9))
+
+# manim 在 media_dir 下的可复用缓存目录（按内容哈希命名，按最大保留时间清理）
+CACHE_SUBDIRS = ("Tex", "texts", "images")
+# manim 每个脚本一个中间目录：videos/<脚本名>/<质量>/partial_movie_files ...
+INTERMEDIATE_SUBDIR = "videos"
+
+
+def _tree_stats(path):
+    """返回目录树的 (总字节数, 最新修改时间)。"""
+    total, newest = 0, 0.0
+    for root, _, files in os.walk(path):
+        try:
+            newest = max(newest, os.stat(root).st_mtime)
+        except OSError:
+            pass
+        for name in files:
+            try:
+                st = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            total += st.st_size
+            newest = max(newest, st.st_mtime)
+    return total, newest
+
+
+class VideoGC:
+    def __init__(self, video_dir=render_cache.STATIC_VIDEO_DIR, cache=render_cache.cache):
+        self.video_dir = video_dir
+        self.cache = cache
+        self.index_path = os.path.join(video_dir, ".access_index.json")
+        self._lock = threading.Lock()
+        self._access = self._load_index()  # 文件名 -> 最近访问时间
+        self._dirty = False
+        self.last_report = None
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = dict(self._access)
+            self._dirty = False
+        try:
+            os.makedirs(self.video_dir, exist_ok=True)
+            tmp = self.index_path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.index_path)
+        except OSError as e:
+            logger.error(f"Video GC index write error: {e}")
+
+    def touch(self, filename):
+        if not filename.endswith(".mp4"):
+            return
+        with self._lock:
+            self._access[filename] = time.time()
+            self._dirty = True
+
+    def _remove(self, path):
+        try:
+            if os.path.isdir(path):
+                size, _ = _tree_stats(path)
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                size = os.path.getsize(path)
+                os.remove(path)
+            return size
+        except OSError as e:
+            logger.warning(f"Video GC could not remove {path}: {e}")
+            return 0
+
+    def _purge_intermediates(self, now, report):
+        inter_dir = os.path.join(self.video_dir, INTERMEDIATE_SUBDIR)
+        if os.path.isdir(inter_dir):
+            for entry in os.scandir(inter_dir):
+                if not entry.is_dir():
+                    continue
+                _, newest = _tree_stats(entry.path)
+                if now - newest > VIDEO_GC_ORPHAN_AGE:
+                    report["bytes_freed"] += self._remove(entry.path)
+                    report["orphans"] += 1
+
+        for entry in os.scandir(self.video_dir):
+            if not entry.is_file() or entry.name.startswith("."):
+                continue
+            # 渲染失败时，先行交付的预览帧没有对应的视频
+            orphan_frame = entry.name.endswith(".frame.png") and not os.path.exists(
+                os.path.join(self.video_dir, entry.name[:-len(".frame.png")] + ".mp4"))
+            if entry.name.endswith((".py", ".tmp")) or orphan_frame:
+                if now - entry.stat().st_mtime > VIDEO_GC_ORPHAN_AGE:
+                    report["bytes_freed"] += self._remove(entry.path)
+                    report["orphans"] += 1
+
+        for sub in CACHE_SUBDIRS:
+            for root, _, files in os.walk(os.path.join(self.video_dir, sub)):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        if now - os.stat(path).st_mtime > VIDEO_GC_MAX_AGE:
+                            report["bytes_freed"] += self._remove(path)
+                            report["cache_files"] += 1
+                    except OSError:
+                        continue
+
+    def _videos(self):
+        """顶层视频列表 [(最近访问时间, 文件名, 字节数)]，最久未访问的在前。"""
+        with self._lock:
+            access = dict(self._access)
+        videos = []
+        for entry in os.scandir(self.video_dir):
+            if entry.is_file() and entry.name.endswith(".mp4"):
+                st = entry.stat()
+                videos.append((max(access.get(entry.name, 0), st.st_mtime), entry.name, st.st_size))
+        videos.sort()
+        return videos
+
+    def _evict(self, filename, protected_keys, report, pinned):
+        """删除一个视频，返回释放的字节数；被引用而不能删除时返回 None。"""
+        if filename in pinned or not self.cache.release_for_gc(filename, protected_keys):
+            pinned.add(filename)
+            return None
+        path = os.path.join(self.video_dir, filename)
+        freed = self._remove(path)
+        video_post.forget(path)
+        # 预览图随视频一起删除
+        for preview in video_post.preview_paths(path):
+            if os.path.exists(preview):
+                freed += self._remove(preview)
+        with self._lock:
+            if self._access.pop(filename, None) is not None:
+                self._dirty = True
+        report["bytes_freed"] += freed
+        return freed
+
+    def run_once(self, protected_keys=None):
+        """执行一轮清理，返回统计。protected_keys：已保存动画脚本对应的渲染缓存键，None 表示未知（缓存中的视频一律保留）。"""
+        now = time.time()
+        report = {"orphans": 0, "cache_files": 0, "expired": 0, "evicted": 0, "pinned": 0, "bytes_freed": 0}
+        if not os.path.isdir(self.video_dir):
+            return report
+
+        self._purge_intermediates(now, report)
+
+        pinned = set()
+        remaining = []
+        for last_access, name, _ in self._videos():
+            if now - last_access > VIDEO_GC_MAX_AGE and self._evict(name, protected_keys, report, pinned) is not None:
+                report["expired"] += 1
+            else:
+                remaining.append(name)
+
+        total, _ = _tree_stats(self.video_dir)
+        quota = VIDEO_GC_QUOTA_MB * 1024 * 1024
+        if total > quota:
+            target = quota * VIDEO_GC_LOW_WATERMARK
+            for name in remaining:
+                if total <= target:
+                    break
+                freed = self._evict(name, protected_keys, report, pinned)
+                if freed is not None:
+                    total -= freed
+                    report["evicted"] += 1
+        report["pinned"] = len(pinned)
+        report["total_bytes"] = total
+        report["finished_at"] = now
+        self.flush()
+        self.last_report = report
+        if report["bytes_freed"]:
+            logger.info(f"Video GC: {report}")
+        return report
+
+    async def run_forever(self, protected_keys_fn=None, interval=VIDEO_GC_INTERVAL):
+        """后台循环；protected_keys_fn 为返回受保护缓存键集合（或 None）的协程函数。"""
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                protected = await protected_keys_fn() if protected_keys_fn else None
+                await loop.run_in_executor(None, self.run_once, protected)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Video GC error: {e}", exc_info=True)
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        with self._lock:
+            tracked = len(self._access)
+        return {"tracked_videos": tracked, "last_run": self.last_report}
+
+
+gc = VideoGC()
@@ -0,0 +1,182 @@
+# logic/video_post.py
+"""
+渲染产物后处理与缓存友好的视频地址。
+
+- faststart：manim 输出的 mp4 把 moov 放在文件末尾，浏览器要下载大部分文件才能开始播放。
+  发布后检查顶层 box 顺序，moov 不在 mdat 之前时用 ffmpeg -c copy -movflags +faststart 重新封装（不重新编码）
+- VIDEO_PREVIEW_FORMAT=webp|gif 时额外生成前 VIDEO_PREVIEW_SECONDS 秒的小尺寸循环预览 <名称>.preview.<格式>，
+  前端用作视频的 poster；默认不生成。没有动图预览时以渐进式渲染的预览帧 <名称>.frame.png 作为 preview_url
+- video_urls() 返回带内容哈希的地址 /videos/<文件名>?v=<哈希>，/videos 路由对带 v 参数的请求返回一年期 immutable
+  缓存头（文件内容变化哈希就变），浏览器与代理可直接复用；Range 请求由 Starlette 的 FileResponse 处理
+- 没有 ffmpeg 时跳过重新封装与预览，只计算哈希
+"""
+import os
+import shutil
+import hashlib
+import logging
+import threading
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+VIDEO_PREVIEW_FORMAT = os.getenv("VIDEO_PREVIEW_FORMAT", "").lower()
+VIDEO_PREVIEW_SECONDS = float(os.getenv("VIDEO_PREVIEW_SECONDS", 3))
+VIDEO_PREVIEW_WIDTH = int(os.getenv("VIDEO_PREVIEW_WIDTH", 320))
+VIDEO_PREVIEW_FPS = int(os.getenv("VIDEO_PREVIEW_FPS", 10))
+
+PREVIEW_FORMATS = ("webp", "gif")
+VIDEO_URL_PREFIX = "/videos"
+HASH_LENGTH = 16
+
+FFMPEG = shutil.which("ffmpeg")
+
+_hash_lock = threading.Lock()
+_hashes = {}  # 文件路径 -> (size, mtime_ns, 哈希)
+
+
+def _top_level_boxes(path):
+    """依次返回 mp4 顶层 box 的类型。"""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return
+            size = int.from_bytes(header[:4], "big")
+            box_type = header[4:8].decode("latin-1")
+            yield box_type
+            if size == 1:  # 64 位长度
+                size = int.from_bytes(f.read(8), "big")
+                offset = size - 16
+            elif size == 0:  # 延伸到文件末尾
+                return
+            else:
+                offset = size - 8
+            if offset < 0:
+                return
+            f.seek(offset, os.SEEK_CUR)
+
+
+def needs_faststart(path):
+    for box_type in _top_level_boxes(path):
+        if box_type == "moov":
+            return False
+        if box_type == "mdat":
+            return True
+    return False
+
+
+def _run_ffmpeg(args, label):
+    try:
+        proc = subprocess.run([FFMPEG, "-hide_banner", "-v", "error", "-y"] + args,
+                              capture_output=True, text=True, timeout=120)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.error(f"ffmpeg {label} failed: {e}")
+        return False
+    if proc.returncode != 0:
+        logger.error(f"ffmpeg {label} failed: {proc.stderr[-500:]}")
+        return False
+    return True
+
+
+def faststart(path):
+    """把 moov 移到文件开头；已经在开头或没有 ffmpeg 时不做任何事。返回是否重新封装。"""
+    try:
+        if not FFMPEG or not needs_faststart(path):
+            return False
+    except OSError:
+        return False
+    tmp = path + ".faststart.tmp"
+    # 显式指定 -f mp4：临时文件的扩展名不是 .mp4
+    if _run_ffmpeg(["-i", path, "-map", "0", "-c", "copy", "-movflags", "+faststart", "-f", "mp4", tmp], "faststart") \
+            and os.path.exists(tmp):
+        os.replace(tmp, path)
+        return True
+    try:
+        os.remove(tmp)
+    except OSError:
+        pass
+    return False
+
+
+def preview_path(path, fmt=VIDEO_PREVIEW_FORMAT):
+    return os.path.splitext(path)[0] + f".preview.{fmt}"
+
+
+def frame_path(path):
+    """渐进式渲染先行交付的最后一帧 (manim -s)。"""
+    return os.path.splitext(path)[0] + ".frame.png"
+
+
+def preview_paths(path):
+    """所有可能存在的预览文件，按作为 preview_url 的优先级排列（删除视频时一并删除）。"""
+    return [preview_path(path, fmt) for fmt in PREVIEW_FORMATS] + [frame_path(path)]
+
+
+def make_preview(path):
+    """按 VIDEO_PREVIEW_FORMAT 生成循环预览，返回预览文件路径；未启用或失败时返回 None。"""
+    if VIDEO_PREVIEW_FORMAT not in PREVIEW_FORMATS or not FFMPEG:
+        return None
+    dest = preview_path(path)
+    vf = f"fps={VIDEO_PREVIEW_FPS},scale={VIDEO_PREVIEW_WIDTH}:-2"
+    if VIDEO_PREVIEW_FORMAT == "gif":
+        # 先生成调色板再映射，避免默认 256 色抖动
+        vf += ",split[a][b];[a]palettegen=stats_mode=diff[p];[b][p]paletteuse"
+        codec = []
+    else:
+        codec = ["-c:v", "libwebp", "-quality", "60", "-an"]
+    tmp = dest + ".tmp"
+    if _run_ffmpeg(["-t", str(VIDEO_PREVIEW_SECONDS), "-i", path, "-vf", vf] + codec
+                   + ["-loop", "0", "-f", VIDEO_PREVIEW_FORMAT, tmp], "preview") and os.path.exists(tmp):
+        os.replace(tmp, dest)
+        return dest
+    try:
+        os.remove(tmp)
+    except OSError:
+        pass
+    return None
+
+
+def content_hash(path):
+    """文件内容哈希（前 HASH_LENGTH 位），按 (大小, mtime) 记忆，文件不变时不重复读取。"""
+    st = os.stat(path)
+    with _hash_lock:
+        memo = _hashes.get(path)
+        if memo and memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+            return memo[2]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    digest = h.hexdigest()[:HASH_LENGTH]
+    with _hash_lock:
+        _hashes[path] = (st.st_size, st.st_mtime_ns, digest)
+    return digest
+
+
+def video_urls(path):
+    """返回 {"video_url", "preview_url"?}，地址带内容哈希；文件不存在时退回不带哈希的地址。"""
+    name = os.path.basename(path)
+    try:
+        urls = {"video_url": f"{VIDEO_URL_PREFIX}/{name}?v={content_hash(path)}"}
+    except OSError:
+        return {"video_url": f"{VIDEO_URL_PREFIX}/{name}"}
+    for candidate in preview_paths(path):
+        if os.path.exists(candidate):
+            try:
+                urls["preview_url"] = f"{VIDEO_URL_PREFIX}/{os.path.basename(candidate)}?v={content_hash(candidate)}"
+            except OSError:
+                pass
+            break
+    return urls
+
+
+def finalize(path):
+    """发布后的后处理：faststart 重新封装、生成预览，返回 video_urls()。在线程池中调用。"""
+    faststart(path)
+    make_preview(path)
+    return video_urls(path)
+
+
+def forget(path):
+    with _hash_lock:
+        _hashes.pop(path, None)
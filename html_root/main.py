@@ -1,26 +1,32 @@
 # main.py
 import os
+import time
 import uuid
+import hmac
+import hashlib
 import base64
 import logging
 import traceback
-import bcrypt
 import json
 import asyncio
+import contextlib
+import threading
 import sys
 import subprocess  # 引入 subprocess 用于同步调用
 from fastapi import FastAPI, UploadFile, File, HTTPException, Response, Request, Cookie, Query
 from typing import Optional # 新增
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import QueryParams
 from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from openai import OpenAI
 import uvicorn
-import mysql.connector
 import json # 确保引入
 from typing import List
 
+# 先加载 .env：logic 下各模块在 import 时读取环境变量
+load_dotenv()
+
 # 引入生成器
 from logic.manim_generator import render_matrix_animation
 
@@ -32,52 +38,37 @@ if sys.platform == "win32":
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-load_dotenv()
-
 app = FastAPI()
 
 # --- 配置部分 ---
 
-# MySQL 配置
-MYSQL_HOST = os.getenv("MYSQL_HOST", "localhost")
-MYSQL_USER = os.getenv("MYSQL_USER", "root")
-MYSQL_PASSWORD = os.getenv("MYSQL_PASSWORD", "password")
-MYSQL_DB = os.getenv("MYSQL_DB", "visdom_db")
-MYSQL_PORT = int(os.getenv("MYSQL_PORT", 3306))
-
-# 创建 MySQL 连接池
-try:
-    db_pool = mysql.connector.pooling.MySQLConnectionPool(
-        pool_name="mypool",
-        pool_size=5,
-        host=MYSQL_HOST,
-        user=MYSQL_USER,
-        password=MYSQL_PASSWORD,
-        database=MYSQL_DB,
-        port=MYSQL_PORT
-    )
-    logger.info("MySQL connection pool created successfully")
-except Exception as e:
-    logger.error(f"Error creating MySQL pool: {e}")
-    db_pool = None
+# 数据库：异步 DAO (logic/dao.py)，DB_BACKEND=mysql 使用 aiomysql 连接池，DB_BACKEND=sqlite 使用本地文件
+from logic import dao
+from logic.dao import database as db
+
+# 验证码与 Session：带 TTL 与容量上限的键值存储 (logic/kv_store.py)
+# STORE_BACKEND=sqlite 时多个 uvicorn worker 共享同一份登录状态
+from logic import kv_store
+# 密码哈希：bcrypt 在专用线程池中计算 (logic/password_hasher.py)
+from logic.password_hasher import hasher, HasherBusy
+
+SESSION_TTL = int(os.getenv("SESSION_TTL", 86400))  # 与 Cookie 有效期一致
+CAPTCHA_TTL = int(os.getenv("CAPTCHA_TTL", 300))
 
-# 简单内存存储验证码
-CAPTCHA_STORE = {}
+# { "captcha_id": "验证码文本(大写)" }
+CAPTCHA_STORE = kv_store.create_store("captcha", int(os.getenv("CAPTCHA_MAX_ENTRIES", 10000)), CAPTCHA_TTL)
 
-# 简单的内存 Session 存储 { "session_id": "username" }
-# 注意：重启服务器会导致所有用户登出。生产环境请使用 Redis。
-SESSION_STORE = {}
+# { "session_id": "username" }
+SESSION_STORE = kv_store.create_store("session", int(os.getenv("SESSION_MAX_ENTRIES", 100000)), SESSION_TTL)
 
-# 1. 挂载静态文件目录
-os.makedirs("static/videos", exist_ok=True)
+# 1. 挂载静态文件目录；渲染输出目录 VIDEO_DIR 默认为 static/videos (logic/render_cache.py)
+from logic.render_cache import STATIC_VIDEO_DIR as VIDEO_DIR
+os.makedirs(VIDEO_DIR, exist_ok=True)
 # 这里先不挂载 /videos，放在最后统一处理，避免路由冲突
 
-# 2. 阿里云/OpenAI 客户端
+# 2. 阿里云/OpenAI 兼容接口：统一经异步网关调用 (logic/llm_gateway.py)，不阻塞事件循环
 api_key = os.getenv("ALIYUN_KEY")
-client = OpenAI(
-    base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-    api_key=api_key or "sk-mock-key"
-)
+from logic.llm_gateway import gateway as llm
 
 
 # --- 数据模型 ---
@@ -119,6 +110,31 @@ class AnimationScriptUpdateModel(BaseModel):
     code: str
 
 
+class FormulaItem(BaseModel):
+    latex: str
+    note: str = ""
+
+
+class FormulaBulkModel(BaseModel):
+    username: str
+    items: List[FormulaItem]
+
+
+class AnimationScriptItem(BaseModel):
+    note: str = ""
+    code: str
+
+
+class AnimationScriptBulkModel(BaseModel):
+    username: str
+    items: List[AnimationScriptItem]
+
+
+class BulkDeleteModel(BaseModel):
+    username: str
+    ids: List[int]
+
+
 # 定义响应模型
 class ExampleVideo(BaseModel):
     filename: str
@@ -126,74 +142,84 @@ class ExampleVideo(BaseModel):
     description: str
     url: str
     poster: str = ""  # 可选
+    duration: Optional[float] = None  # 秒，封面生成后才有
+
+
+from logic import gallery
 
 
 @app.get("/api/examples")
 async def get_examples():
-    storage_dir = "static/assets/storage"
-    metadata_path = os.path.join(storage_dir, "metadata.json")
+    # 内存索引：目录与 metadata.json 未变化时不重新扫描；封面由 ffmpeg 在后台生成 (logic/gallery.py)
+    return {"status": "success", "data": gallery.index.list_videos()}
 
-    videos = []
 
-    # 读取配置文件
-    meta_dict = {}
-    if os.path.exists(metadata_path):
-        try:
-            with open(metadata_path, "r", encoding="utf-8") as f:
-                meta_list = json.load(f)
-                # 转为字典方便查找
-                for item in meta_list:
-                    meta_dict[item["filename"]] = item
-        except Exception as e:
-            logger.error(f"Metadata load error: {e}")
-
-    # 扫描目录下所有 mp4 文件
-    if os.path.exists(storage_dir):
-        for file in os.listdir(storage_dir):
-            if file.endswith(".mp4"):
-                # 如果有元数据就用，没有就用默认值
-                meta = meta_dict.get(file, {
-                    "title": file,
-                    "description": "暂无简介",
-                    "poster": ""
-                })
-
-                videos.append({
-                    "filename": file,
-                    "title": meta.get("title", file),
-                    "description": meta.get("description", "暂无简介"),
-                    "url": f"/assets/storage/{file}",
-                    "poster": meta.get("poster", "")  # 封面图路径，如果为空，前端处理
-                })
-
-    return {"status": "success", "data": videos}
+# --- 辅助函数：数据库操作 ---
+def _db_error(e: Exception, **extra):
+    """数据库异常转为 JSON 响应：连接池繁忙 503，其余 500。"""
+    if isinstance(e, dao.DatabaseBusy):
+        return JSONResponse(status_code=503, headers={"Retry-After": "2"},
+                            content={"status": "error", "message": "数据库繁忙，请稍后再试", **extra})
+    return JSONResponse(status_code=500, content={"status": "error", "message": str(e), **extra})
+
+
+def _list_response(request: Request, rows, next_cursor):
+    """分页列表响应：ETag 为响应体摘要，If-None-Match 命中时返回 304，前端复用本地数据。"""
+    body = json.dumps({"status": "success", "data": rows, "next_cursor": next_cursor},
+                      ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    etag = f'W/"{hashlib.sha1(body).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+def _invalid_cursor():
+    return JSONResponse(status_code=400, content={"status": "error", "message": "分页游标无效"})
+
+
+def _bulk_too_large(n):
+    if n > dao.BULK_MAX_ITEMS:
+        return JSONResponse(status_code=400, content={
+            "status": "error", "message": f"单次最多 {dao.BULK_MAX_ITEMS} 条，当前 {n} 条"})
+    return None
 
 
-# --- 辅助函数：数据库操作 ---
-def get_db_connection():
-    if not db_pool:
-        raise Exception("Database connection not initialized")
-    return db_pool.get_connection()
+async def _bulk_save(save_many, username, pairs):
+    """空内容逐项标记为 error，其余在一个事务内批量写入；结果按原顺序返回。"""
+    results = [{"index": i, "status": "error", "message": "内容不能为空"} for i in range(len(pairs))]
+    valid = [i for i, (content, _) in enumerate(pairs) if content.strip()]
+    for r in await save_many(username, [pairs[i] for i in valid]):
+        results[valid[r["index"]]] = {**r, "index": valid[r["index"]]}
+    return {"status": "success", "results": results,
+            "created": sum(r["status"] == "created" for r in results),
+            "duplicates": sum(r["status"] == "duplicate" for r in results)}
+
+
+def _duplicate_content(what):
+    return JSONResponse(status_code=409, content={"status": "error", "message": f"已存在相同的{what}"})
+
+
+def _hasher_busy():
+    return JSONResponse(status_code=503, headers={"Retry-After": "2"},
+                        content={"status": "error", "message": "登录请求过多，请稍后再试"})
 
 
 # --- 辅助函数：生成验证码  ---
-from logic.captcha import generate_captcha_image_bytes
+# 验证码由后台线程预先绘制，请求只从队列中取出 (logic/captcha.py)
+from logic import captcha
 
 # --- API 路由 (Auth & CRUD) ---
 
 @app.get("/api/captcha")
 async def get_captcha():
-    text, img_buf = generate_captcha_image_bytes()
+    text, png = captcha.pool.get()
     captcha_id = str(uuid.uuid4())
-    CAPTCHA_STORE[captcha_id] = text.upper()
-
-    # 清理过期验证码 (简单实现：如果太多就清空一半)
-    if len(CAPTCHA_STORE) > 1000:
-        keys = list(CAPTCHA_STORE.keys())
-        for k in keys[:500]:
-            del CAPTCHA_STORE[k]
+    CAPTCHA_STORE.set(captcha_id, text.upper())
 
-    return StreamingResponse(img_buf, media_type="image/png", headers={"X-Captcha-ID": captcha_id})
+    return Response(content=png, media_type="image/png",
+                    headers={"X-Captcha-ID": captcha_id, "Cache-Control": "no-store"})
 
 
 @app.post("/api/register")
@@ -206,27 +232,20 @@ async def register(data: AuthModel):
 
     if stored_code != data.captcha.upper():
         return JSONResponse(status_code=400, content={"status": "error", "message": "验证码错误"})
-    del CAPTCHA_STORE[data.captcha_id]
+    CAPTCHA_STORE.delete(data.captcha_id)
 
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT id FROM users WHERE username = %s", (data.username,))
-        if cursor.fetchone():
+        if await db.user_exists(data.username):
             return JSONResponse(status_code=400, content={"status": "error", "message": "用户名已存在"})
 
-        # 加密密码
-        hashed_pw = bcrypt.hashpw(data.password.encode(), bcrypt.gensalt()).decode()
-        cursor.execute("INSERT INTO users (username, hashed_password) VALUES (%s, %s)", (data.username, hashed_pw))
-        conn.commit()
+        # 加密密码：在专用线程池中计算，不阻塞事件循环
+        hashed_pw = await hasher.hash(data.password)
+        await db.create_user(data.username, hashed_pw)
         return {"status": "success", "message": "注册成功"}
+    except HasherBusy:
+        return _hasher_busy()
     except Exception as e:
-        return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
+        return _db_error(e)
 
 
 @app.post("/api/login")
@@ -235,37 +254,31 @@ async def login(data: AuthModel, response: Response):  # 注入 Response 对象
     stored_code = CAPTCHA_STORE.get(data.captcha_id)
     if not stored_code or stored_code != data.captcha.upper():
         return JSONResponse(status_code=400, content={"status": "error", "message": "验证码错误"})
-    del CAPTCHA_STORE[data.captcha_id]
+    CAPTCHA_STORE.delete(data.captcha_id)
 
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM users WHERE username = %s", (data.username,))
-        user = cursor.fetchone()
+        user = await db.get_user(data.username)
 
-        if user and bcrypt.checkpw(data.password.encode(), user["hashed_password"].encode()):
+        if user and await hasher.verify(data.password, user["hashed_password"]):
             # --- 核心修改：生成 Session 并设置 Cookie ---
             session_id = str(uuid.uuid4())
-            SESSION_STORE[session_id] = user["username"]
+            SESSION_STORE.set(session_id, user["username"])
 
             # 设置 Cookie：key="auth_session", 有效期 1天 (86400秒), httponly 防止 XSS
             response.set_cookie(
                 key="auth_session",
                 value=session_id,
-                max_age=86400,
+                max_age=SESSION_TTL,
                 httponly=True,
                 samesite="lax"
             )
             return {"status": "success", "username": user["username"]}
         else:
             return JSONResponse(status_code=401, content={"status": "error", "message": "用户名或密码错误"})
+    except HasherBusy:
+        return _hasher_busy()
     except Exception as e:
-        return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
+        return _db_error(e)
 
 
 # --- 新增：检查登录状态接口 (用于自动登录) ---
@@ -288,28 +301,17 @@ async def check_username(username: str = Query(..., max_length=64)):
     raw = username.strip()
     if not raw:
         return {"available": False}
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT id FROM users WHERE username = %s", (raw,))
-        exists = cursor.fetchone() is not None
-        return {"available": not exists}
+        return {"available": not await db.user_exists(raw)}
     except Exception as e:
-        return JSONResponse(status_code=500, content={"available": False, "message": str(e)})
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+        return _db_error(e, available=False)
 
 
 # --- 新增：登出接口 ---
 @app.post("/api/logout")
 async def logout(response: Response, auth_session: Optional[str] = Cookie(None)):
-    if auth_session and auth_session in SESSION_STORE:
-        del SESSION_STORE[auth_session]
+    if auth_session:
+        SESSION_STORE.delete(auth_session)
 
     # 删除 Cookie
     response.delete_cookie(key="auth_session")
@@ -319,192 +321,151 @@ async def logout(response: Response, auth_session: Optional[str] = Cookie(None))
 # --- 新增：我的算式功能 (MySQL版) ---
 @app.post("/api/formulas/save")
 async def save_formula(data: FormulaModel):
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
         # 简单检查用户存在（可选，通常依赖前端状态或Token）
-        # 这里直接插入，利用外键约束报错
-        cursor.execute(
-            "INSERT INTO formulas (user_id, latex, note) VALUES (%s, %s, %s)",
-            (data.username, data.latex, data.note)
-        )
-        conn.commit()
-        return {"status": "success", "message": "保存成功"}
+        # 这里直接插入，利用外键约束报错；相同 LaTeX 不重复保存
+        formula_id, created = await db.add_formula(data.username, data.latex, data.note)
+        return {"status": "success", "message": "保存成功" if created else "已保存过相同算式", "id": formula_id}
     except Exception as e:
-        return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
+        return _db_error(e)
+
+
+@app.post("/api/formulas/bulk_save")
+async def bulk_save_formulas(data: FormulaBulkModel):
+    too_large = _bulk_too_large(len(data.items))
+    if too_large is not None:
+        return too_large
+    try:
+        return await _bulk_save(db.bulk_add_formulas, data.username, [(f.latex, f.note) for f in data.items])
+    except Exception as e:
+        return _db_error(e)
+
+
+@app.post("/api/formulas/bulk_delete")
+async def bulk_delete_formulas(data: BulkDeleteModel):
+    too_large = _bulk_too_large(len(data.ids))
+    if too_large is not None:
+        return too_large
+    try:
+        results = await db.bulk_delete_formulas(data.username, data.ids)
+        return {"status": "success", "results": results,
+                "deleted": sum(r["status"] == "deleted" for r in results)}
+    except Exception as e:
+        return _db_error(e)
 
 
 @app.get("/api/formulas/list")
-async def list_formulas(username: str):
-    conn = None
-    cursor = None
+async def list_formulas(request: Request, username: str,
+                        limit: int = Query(dao.LIST_PAGE_SIZE, ge=1, le=dao.LIST_PAGE_MAX),
+                        cursor: Optional[str] = None):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM formulas WHERE user_id = %s ORDER BY created_at DESC", (username,))
-        formulas = cursor.fetchall()
-        # 处理 datetime 不可序列化问题 (如果有)
-        for f in formulas:
-            f['created_at'] = f['created_at'].isoformat()
-
-        return {"status": "success", "data": formulas}
+        formulas, next_cursor = await db.list_formulas(username, limit, cursor)
+        return _list_response(request, formulas, next_cursor)
+    except dao.InvalidCursor:
+        return _invalid_cursor()
     except Exception as e:
-        return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
+        return _db_error(e)
 
 
 @app.delete("/api/formulas/delete")
 async def delete_formula(id: int, username: str):
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM formulas WHERE id = %s AND user_id = %s", (id, username))
-        conn.commit()
+        await db.delete_formula(id, username)
         return {"status": "success"}
     except Exception as e:
-        return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
+        return _db_error(e)
 
 
 @app.put("/api/formulas/update")
 async def update_formula(data: FormulaUpdateModel):
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
         # 更新逻辑：必须同时匹配 id 和 username，防止越权修改
-        cursor.execute(
-            "UPDATE formulas SET latex = %s, note = %s WHERE id = %s AND user_id = %s",
-            (data.latex, data.note, data.id, data.username)
-        )
-        conn.commit()
-        if cursor.rowcount == 0: return JSONResponse(status_code=404,
-                                                     content={"status": "error", "message": "未找到算式或无权修改"})
+        if await db.update_formula(data.id, data.username, data.latex, data.note) == 0:
+            return JSONResponse(status_code=404, content={"status": "error", "message": "未找到算式或无权修改"})
         return {"status": "success", "message": "更新成功"}
+    except dao.DuplicateContent:
+        return _duplicate_content("算式")
     except Exception as e:
-        return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
+        return _db_error(e)
 
 
 # --- 动画脚本库 (Manim 代码保存与编辑) ---
 @app.post("/api/animation_scripts/save")
 async def save_animation_script(data: AnimationScriptModel):
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO animation_scripts (user_id, note, code) VALUES (%s, %s, %s)",
-            (data.username, data.note or "", data.code)
-        )
-        conn.commit()
-        return {"status": "success", "message": "保存成功", "id": cursor.lastrowid}
+        script_id, created = await db.add_script(data.username, data.note or "", data.code)
+        return {"status": "success", "message": "保存成功" if created else "已保存过相同脚本", "id": script_id}
     except Exception as e:
-        return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
+        return _db_error(e)
+
+
+@app.post("/api/animation_scripts/bulk_save")
+async def bulk_save_animation_scripts(data: AnimationScriptBulkModel):
+    too_large = _bulk_too_large(len(data.items))
+    if too_large is not None:
+        return too_large
+    try:
+        return await _bulk_save(db.bulk_add_scripts, data.username, [(s.code, s.note or "") for s in data.items])
+    except Exception as e:
+        return _db_error(e)
+
+
+@app.post("/api/animation_scripts/bulk_delete")
+async def bulk_delete_animation_scripts(data: BulkDeleteModel):
+    too_large = _bulk_too_large(len(data.ids))
+    if too_large is not None:
+        return too_large
+    try:
+        results = await db.bulk_delete_scripts(data.username, data.ids)
+        return {"status": "success", "results": results,
+                "deleted": sum(r["status"] == "deleted" for r in results)}
+    except Exception as e:
+        return _db_error(e)
 
 
 @app.get("/api/animation_scripts/list")
-async def list_animation_scripts(username: str):
-    conn = None
-    cursor = None
+async def list_animation_scripts(request: Request, username: str,
+                                 limit: int = Query(dao.LIST_PAGE_SIZE, ge=1, le=dao.LIST_PAGE_MAX),
+                                 cursor: Optional[str] = None):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute(
-            "SELECT id, user_id, note, LEFT(code, 400) AS code_preview, created_at FROM animation_scripts WHERE user_id = %s ORDER BY created_at DESC",
-            (username,)
-        )
-        rows = cursor.fetchall()
-        for r in rows:
-            r["created_at"] = r["created_at"].isoformat()
-        return {"status": "success", "data": rows}
+        rows, next_cursor = await db.list_scripts(username, limit, cursor)
+        return _list_response(request, rows, next_cursor)
+    except dao.InvalidCursor:
+        return _invalid_cursor()
     except Exception as e:
-        return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
+        return _db_error(e)
 
 
 @app.get("/api/animation_scripts/get")
 async def get_animation_script(id: int, username: str):
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute(
-            "SELECT id, note, code, created_at FROM animation_scripts WHERE id = %s AND user_id = %s",
-            (id, username)
-        )
-        row = cursor.fetchone()
+        row = await db.get_script(id, username)
         if not row:
             return JSONResponse(status_code=404, content={"status": "error", "message": "未找到脚本"})
-        row["created_at"] = row["created_at"].isoformat()
         return {"status": "success", "data": row}
     except Exception as e:
-        return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
+        return _db_error(e)
 
 
 @app.delete("/api/animation_scripts/delete")
 async def delete_animation_script(id: int, username: str):
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM animation_scripts WHERE id = %s AND user_id = %s", (id, username))
-        conn.commit()
+        await db.delete_script(id, username)
         return {"status": "success"}
     except Exception as e:
-        return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
+        return _db_error(e)
 
 
 @app.put("/api/animation_scripts/update")
 async def update_animation_script(data: AnimationScriptUpdateModel):
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE animation_scripts SET note = %s, code = %s WHERE id = %s AND user_id = %s",
-            (data.note or "", data.code, data.id, data.username)
-        )
-        conn.commit()
-        if cursor.rowcount == 0:
+        if await db.update_script(data.id, data.username, data.note or "", data.code) == 0:
             return JSONResponse(status_code=404, content={"status": "error", "message": "未找到脚本或无权修改"})
         return {"status": "success", "message": "更新成功"}
+    except dao.DuplicateContent:
+        return _duplicate_content("脚本")
     except Exception as e:
-        return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
-    finally:
-        if cursor: cursor.close()
-        if conn: conn.close()
+        return _db_error(e)
 
 
 @app.post("/api/detect")
@@ -513,7 +474,7 @@ async def detect_image(file: UploadFile = File(...)):
         image_content = await file.read()
         base64_image = base64.b64encode(image_content).decode("utf-8")
         if not api_key: return {"status": "success", "latex": r"E = mc^2"}
-        completion = client.chat.completions.create(
+        latex = await llm.chat(
             model="qwen-vl-max",
             messages=[{
                 "role": "user",
@@ -523,7 +484,7 @@ async def detect_image(file: UploadFile = File(...)):
                 ]
             }]
         )
-        latex = completion.choices[0].message.content.strip()
+        latex = latex.strip()
         latex = latex.replace("```latex", "").replace("```", "").replace("\\[", "").replace("\\]", "").strip()
         return {"status": "success", "latex": latex}
     except Exception as e:
@@ -531,163 +492,409 @@ async def detect_image(file: UploadFile = File(...)):
 
 
 @app.post("/api/animate")
-async def generate_animation(data: CalcModel):
+async def generate_animation(data: CalcModel, request: Request, auth_session: Optional[str] = Cookie(None)):
+    # 与流式接口共用渲染调度：按用户轮转、并发有上限，队列满返回 429
     try:
+        ticket = render_scheduler.scheduler.submit(_client_key(request, auth_session))
+    except render_scheduler.QueueFull:
+        return _render_busy_response()
+    try:
+        async for _ in render_scheduler.scheduler.wait(ticket):
+            pass
         task_id = str(uuid.uuid4())
-        video_path = render_matrix_animation(data.matrixA, data.matrixB, data.operation, task_id)
+        # 渲染为同步阻塞调用（等待常驻 worker），放到线程池，不阻塞事件循环
+        video_path = await asyncio.get_running_loop().run_in_executor(
+            None, render_matrix_animation, data.matrixA, data.matrixB, data.operation, task_id, ticket.cancel)
         if video_path and os.path.exists(video_path):
-            filename = os.path.basename(video_path)
-            return {"status": "success", "video_url": f"/videos/{filename}"}
+            return {"status": "success", **await _finalize_video(video_path)}
         raise HTTPException(status_code=500, detail="Failed")
     except Exception as e:
         return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
+    finally:
+        # 请求被取消（客户端断开）时同样结束渲染
+        ticket.cancel.set()
+        render_scheduler.scheduler.release(ticket)
 
 
 # --- SSE Stream ---
 
 from logic.prompt import return_prompt
+from logic import render_pool, render_scheduler, render_cache, code_cache, job_registry, video_gc, video_post, render_upgrade, metrics, render_sandbox, rate_limit, speculative
+from logic.code_validator import StreamingSceneValidator, preflight, format_preflight_errors, PREFLIGHT_DRY_RUN
+
+# 渐进式交付：拿到渲染槽后先用 -s 只渲染最后一帧并推送 (preview_frame)，同时代替 dry_run 预检
+RENDER_PREVIEW_FRAME = os.getenv("RENDER_PREVIEW_FRAME", "1") == "1"
+
+
+OPERATION_DESC = {
+    "formular": "公式推演",
+    "visualization": "可视化演示",
+    "normal": "通用演示",
+}
+
+
+def generate_manim_prompt(latex_a, latex_b, operation):
+    op_desc = OPERATION_DESC.get(operation, "数学展示")
+    return return_prompt(op_desc, latex_a, latex_b)
+
+
+def _client_key(request: Request, auth_session: Optional[str] = None) -> str:
+    """调度/限流使用的用户标识：已登录用用户名，否则用客户端 IP。"""
+    username = SESSION_STORE.get(auth_session) if auth_session else None
+    if username:
+        return f"user:{username}"
+    return f"ip:{request.client.host if request.client else 'unknown'}"
 
 
-def _run_manim_subprocess_sync(cmd_list, cwd, put_fn):
-    """在线程中运行 Manim 子进程，逐行通过 put_fn(('log', text)) 送出 stderr，最后 put_fn(('done', returncode, stderr_full))。兼容 Windows。"""
+# 按用户的令牌桶限流（llm / render / crud 分桶，状态与 Session 存放在同一 kv_store）
+app.add_middleware(rate_limit.RateLimitMiddleware,
+                   key_fn=lambda request: _client_key(request, request.cookies.get("auth_session")))
+
+
+def _render_busy_response():
+    return JSONResponse(status_code=429, headers={"Retry-After": "10"},
+                        content={"status": "error", "message": "渲染队列已满，请稍后再试"})
+
+
+async def _finalize_video(path: str):
+    """发布后的后处理（faststart 重新封装、预览图）放到线程池，返回带内容哈希的 video_url / preview_url。"""
+    return await asyncio.get_running_loop().run_in_executor(None, video_post.finalize, path)
+
+
+async def _cached_video(filename: str):
+    """缓存命中的视频地址；首次计算内容哈希需要读完整个文件，放到线程池。"""
+    return await asyncio.get_running_loop().run_in_executor(
+        None, video_post.video_urls, os.path.join(VIDEO_DIR, filename))
+
+
+def _cleanup_render_files(py_path: str, media_dir: str):
+    """删除临时脚本及 Manim 为其生成的中间目录（取消渲染、丢弃获胜候选的输出时调用）。"""
+    py_base = os.path.splitext(os.path.basename(py_path))[0]
     try:
-        proc = subprocess.Popen(
-            cmd_list,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.PIPE,
-            cwd=cwd,
-        )
-        stderr_chunks = []
-        for raw in iter(proc.stderr.readline, b""):
-            stderr_chunks.append(raw)
+        os.remove(py_path)
+    except OSError:
+        pass
+    import shutil
+    shutil.rmtree(os.path.join(media_dir, "videos", py_base), ignore_errors=True)
+
+
+async def _stream_until_disconnect(request: Request, agen, interval: float = 1.0):
+    """转发 SSE 事件，同时每 interval 秒检查客户端是否断开；断开（或响应被提前关闭）时取消 agen。"""
+    pending = None
+    try:
+        while True:
+            pending = asyncio.ensure_future(agen.__anext__())
+            while not pending.done():
+                await asyncio.wait({pending}, timeout=interval)
+                if not pending.done() and await request.is_disconnected():
+                    logger.info(f"SSE client disconnected: {request.url.path}")
+                    return
+            try:
+                chunk = pending.result()
+            except StopAsyncIteration:
+                return
+            pending = None
+            yield chunk
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
             try:
-                text = raw.decode("utf-8", errors="replace").rstrip()
-                if text:
-                    put_fn(("log", text))
-            except Exception:
+                await pending
+            except BaseException:
                 pass
-        proc.wait()
-        err_full = b"".join(stderr_chunks).decode("utf-8", errors="replace")
-        put_fn(("done", proc.returncode, err_full))
-    except Exception as ex:
-        logger.error(f"Manim subprocess: {ex}", exc_info=True)
-        put_fn(("done", -1, str(ex) or repr(ex)))
+        else:
+            await agen.aclose()
 
-def generate_manim_prompt(latex_a, latex_b, operation):
-    op_desc = {
-        "formular": "公式推演",
-        "visualization": "可视化演示",
-        "normal": "通用演示",
-    }.get(operation,"数学展示")
-    return return_prompt(op_desc, latex_a, latex_b)
+
+def _last_event_id(request: Request) -> int:
+    """断线重连时补发的起点：EventSource 自动带 Last-Event-ID 头，fetch 客户端也可用 ?last_event_id=。"""
+    raw = request.headers.get("last-event-id") or request.query_params.get("last_event_id") or "0"
+    try:
+        return int(raw)
+    except ValueError:
+        return 0
+
+
+async def _job_events(job, last_id: int = 0):
+    async for seq, payload in job.events(last_id):
+        yield f"id: {seq}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def _job_response(request: Request, job, last_id: int = 0):
+    """订阅任务事件的 SSE 响应。客户端断开只是取消订阅，任务本身继续运行（无人订阅超时后才取消）。"""
+    return StreamingResponse(_stream_until_disconnect(request, _job_events(job, last_id)),
+                             media_type="text/event-stream", headers={"X-Job-Id": job.id})
 
 
 @app.post("/api/animate/stream")
-async def generate_animation_stream(data: CalcModel):
+async def generate_animation_stream(data: CalcModel, request: Request, auth_session: Optional[str] = Cookie(None)):
+    user_key = _client_key(request, auth_session)
+    # 同一用户重复提交相同请求（如断线后重新点击生成）：挂接到进行中的任务，不重复调用大模型和渲染
+    request_key = code_cache.make_key(data.matrixA, data.matrixB, data.operation,
+                                      OPERATION_DESC.get(data.operation, "数学展示"))
+    running = job_registry.registry.find_active(user_key, request_key)
+    if running:
+        return _job_response(request, running)
+    # 队列已满时直接 429，避免先调用大模型再排不上队
+    if render_scheduler.scheduler.is_full():
+        return _render_busy_response()
+    task_id = str(uuid.uuid4())
+    # 分阶段计时：每段结束记入 /metrics，complete 事件附带本任务的各阶段耗时
+    timer = metrics.StageTimer("animate")
+
     async def event_generator():
-        task_id = str(uuid.uuid4())
-        yield f"data: {json.dumps({'step': 'generating_code', 'message': 'AI 正在构思 Manim 代码...', 'progress': 10})}\n\n"
+        yield {'step': 'generating_code', 'message': 'AI 正在构思 Manim 代码...', 'progress': 10}
 
         prompt = generate_manim_prompt(data.matrixA, data.matrixB, data.operation)
-        code = ""
+        # 同一 (公式, 运算, 提示词版本) 已有渲染成功的代码时跳过大模型调用
+        code_key = request_key
+        code = code_cache.cache.get(code_key) or ""
+        timer.cache_lookup("code", bool(code))
+        # 生成的代码同样不可信：按用户等级施加 CPU / 内存 / 文件数 / 输出大小限制
+        limits = render_sandbox.limits_for("animate", render_sandbox.tier_of(user_key))
+        media_dir = VIDEO_DIR
+        output_file = f"{task_id}.mp4"
+
+        # 推测式多候选：渲染槽空闲时并发生成 K 份候选、并行渲染，采用最先成功的一份；繁忙时 K=1，走下面的原流程
+        speculated = None  # ("winner", 序号, code, manifest, cached_file) 或 ("failed", code, returncode, stderr)
+        candidates = 1 if code else speculative.speculator.candidate_count()
+        if candidates > 1:
+            timer.attempts += 1
+            yield {'step': 'speculating', 'message': f'渲染资源空闲，并行生成 {candidates} 份候选代码，采用最先渲染成功的一份...',
+                   'candidates': candidates, 'progress': 15}
+            with timer.stage("speculative"):
+                async with contextlib.aclosing(speculative.speculator.run(
+                        prompt, candidates, user_key, task_id, media_dir, limits)) as events:
+                    async for item in events:
+                        if item[0] == "generated":
+                            yield {'step': 'candidate_generated', 'message': f'候选 {item[1] + 1} 已生成，预检并渲染中...',
+                                   'candidate': item[1], 'progress': 30}
+                        elif item[0] in ("rejected", "dropped"):
+                            reason = '未通过预检' if item[0] == "rejected" else f'已放弃：{item[2]}'
+                            yield {'step': 'candidate_dropped', 'message': f'候选 {item[1] + 1} {reason}',
+                                   'candidate': item[1], 'progress': 35}
+                        elif item[0] == "log":
+                            yield {'step': 'rendering', 'message': f'[候选 {item[1] + 1}] {item[2]}', 'progress': 40}
+                        else:
+                            speculated = item
+                            break
+            if speculated and speculated[0] == "winner":
+                code = speculated[2]
+            elif speculated and speculated[1]:
+                code = speculated[1]
+            else:
+                # 没有任何候选代码：退回流式生成
+                speculated = None
         try:
-            completion = client.chat.completions.create(
-                model="qwen-plus",
-                messages=[{"role": "user", "content": prompt}]
-            )
-            code = completion.choices[0].message.content.strip()
-            code = code.replace("```python", "").replace("```", "").strip()
-            yield f"data: {json.dumps({'step': 'code_generated', 'message': '代码生成完毕，准备渲染...', 'code': code, 'progress': 30})}\n\n"
+            if speculated and speculated[0] == "winner":
+                yield {'step': 'code_generated', 'message': f'候选 {speculated[1] + 1} 最先渲染成功', 'code': code,
+                       'candidate': speculated[1], 'progress': 85}
+            elif speculated:
+                yield {'step': 'code_generated', 'message': '候选代码均未渲染成功，按原流程继续...', 'code': code, 'progress': 30}
+            elif code:
+                yield {'step': 'code_generated', 'message': '命中代码缓存，准备渲染...', 'code': code, 'cached': True, 'progress': 30}
+            else:
+                # 流式生成：边生成边推送 code_delta，GenScene.construct 写完整后提前结束
+                validator = StreamingSceneValidator()
+                with timer.stage("llm"):
+                    async with contextlib.aclosing(
+                            llm.chat_stream(model="qwen-plus", messages=[{"role": "user", "content": prompt}])) as deltas:
+                        async for delta in deltas:
+                            yield {'step': 'code_delta', 'delta': delta}
+                            if validator.feed(delta):
+                                break
+                code = validator.result()
+                message = '代码结构已完整，提前结束生成，准备渲染...' if validator.complete else '代码生成完毕，准备渲染...'
+                yield {'step': 'code_generated', 'message': message, 'code': code, 'progress': 30}
         except Exception as e:
             logger.error(f"LLM Error: {e}")
-            yield f"data: {json.dumps({'step': 'error', 'message': f'生成失败: {str(e)}'})}\n\n"
+            yield {'step': 'error', 'message': f'生成失败: {str(e)}'}
+            return
+
+        # 480p 视频交付之后：渲染槽空闲时在独立的后台任务中渲染高质量版本，客户端轮询 /api/jobs/<task_id>/upgrade
+        upgrade = render_upgrade.upgrader.enabled
+
+        # 相同场景代码已渲染过：直接返回已有视频，不再启动渲染
+        cache_key = render_cache.make_key(code)
+        cached_file = render_cache.cache.lookup(cache_key)
+        timer.cache_lookup("render", bool(cached_file))
+        if cached_file:
+            if speculated and speculated[0] == "winner" and speculated[3]:
+                # 候选渲染期间同样的代码已被其他请求写入缓存：改用缓存视频，丢弃获胜候选自己的输出
+                await asyncio.get_running_loop().run_in_executor(
+                    None, _cleanup_render_files, os.path.join(media_dir, f"gen_{task_id}_c{speculated[1]}.py"), media_dir)
+            code_cache.cache.put(code_key, code)
+            yield {'step': 'complete', 'message': '命中渲染缓存，渲染完成！', **(await _cached_video(cached_file)), 'cached': True, 'upgrade': upgrade, 'progress': 100}
+            if upgrade:
+                render_upgrade.upgrader.start(code, user_key, task_id)
             return
 
         py_filename = f"gen_{task_id}.py"
-        py_path = os.path.join("static/videos", py_filename)
-        os.makedirs("static/videos", exist_ok=True)
+        py_path = os.path.join(VIDEO_DIR, py_filename)
+        os.makedirs(VIDEO_DIR, exist_ok=True)
         try:
-            with open(py_path, "w", encoding="utf-8") as f:
+            with timer.stage("file_write"), open(py_path, "w", encoding="utf-8") as f:
                 f.write(code)
         except Exception as e:
             logger.error(f"File Write Error: {e}")
-            yield f"data: {json.dumps({'step': 'error', 'message': '写入代码文件失败'})}\n\n"
+            yield {'step': 'error', 'message': '写入代码文件失败'}
             return
 
-        media_dir = os.path.abspath("static/videos")
-        output_file = f"{task_id}.mp4"
         py_abs_path = os.path.abspath(py_path)
 
-        # Manim 命令（渲染速度优化：-ql 为最低质量预设 480p15，渲染最快）
-        cmd = [sys.executable, "-m", "manim", "-ql", "--media_dir", media_dir, "-o", output_file, py_abs_path,
-               "GenScene"]
-        logger.info(f"Executing command: {' '.join(cmd)}")
-        yield f"data: {json.dumps({'step': 'rendering', 'message': 'Manim 引擎启动中...', 'progress': 40})}\n\n"
-
-        async def run_manim_stream_logs(cmd_list):
-            """运行 Manim 并逐行 yield stderr，最后 yield (returncode, stderr_full)。使用线程内同步子进程，兼容 Windows。"""
-            loop = asyncio.get_event_loop()
-            queue = asyncio.Queue()
-            def put(item):
-                loop.call_soon_threadsafe(queue.put_nowait, item)
-            loop.run_in_executor(None, _run_manim_subprocess_sync, cmd_list, os.path.dirname(py_abs_path), put)
-            while True:
-                item = await queue.get()
-                yield item
-                if item[0] == "done":
-                    break
-
-        def locate_and_yield_complete():
-            base_search_path = os.path.join(media_dir, "videos", py_filename.replace(".py", ""), "480p15")
-            expected_file = os.path.join(base_search_path, output_file)
-            if not os.path.exists(expected_file):
-                if os.path.exists(os.path.join(media_dir, output_file)):
-                    expected_file = os.path.join(media_dir, output_file)
-                else:
-                    target_dir = os.path.join(media_dir, "videos", py_filename.replace(".py", ""), "480p15")
-                    if os.path.exists(target_dir):
-                        for f in os.listdir(target_dir):
-                            if f.endswith(".mp4"):
-                                expected_file = os.path.join(target_dir, f)
-                                break
-            if os.path.exists(expected_file):
-                final_path = os.path.join("static/videos", output_file)
-                import shutil
-                shutil.move(expected_file, final_path)
-                final_url = f"/videos/{output_file}"
+        # 渲染任务（渲染速度优化：-ql 为最低质量预设 480p15，渲染最快；由常驻 worker 执行，免去冷启动）
+        job = render_pool.make_job(py_abs_path, "GenScene", "-ql", media_dir, output_file,
+                                   cwd=os.path.dirname(py_abs_path), limits=limits)
+        logger.info(f"Render job: {job}")
+        if not speculated:
+            yield {'step': 'rendering', 'message': 'Manim 引擎启动中...', 'progress': 40}
+
+        async def run_manim_stream_logs(render_job, source):
+            """排队获取渲染槽后运行 Manim：排队中 yield ("queued", 位置)，渲染中逐行 yield stderr，
+            最后 yield ("done", returncode, stderr_full, manifest)；队列已满 yield ("busy", 提示)。在线程中等待渲染 worker，兼容 Windows。
+            渲染前先预检：静态检查不通过时不排队，直接 yield ("done", 1, 错误信息)；开启 PREFLIGHT_DRY_RUN 时，
+            拿到渲染槽后先 dry_run 一遍，失败同样直接 yield ("done", ...)，不再正式渲染。"""
+            timer.attempts += 1
+            with timer.stage("preflight"):
+                errors = preflight(source)
+            if errors:
+                yield ("done", 1, format_preflight_errors(errors), None)
+                return
+            try:
+                ticket = render_scheduler.scheduler.submit(user_key)
+            except render_scheduler.QueueFull:
+                yield ("busy", "渲染队列已满，请稍后再试")
+                return
+            cancel = threading.Event()
+            try:
+                # 阶段在产出 done 之前显式记录：调用方拿到 done 后不再迭代本生成器
+                started = time.perf_counter()
+                async for position in render_scheduler.scheduler.wait(ticket):
+                    yield ("queued", position)
+                timer.record("queue_wait", time.perf_counter() - started)
+                loop = asyncio.get_event_loop()
+                queue = asyncio.Queue()
+                def put(item):
+                    loop.call_soon_threadsafe(queue.put_nowait, item)
+                if RENDER_PREVIEW_FRAME or PREFLIGHT_DRY_RUN:
+                    # -s 与 dry_run 一样完整执行 construct、跳过动画，只多写出最后一帧
+                    if RENDER_PREVIEW_FRAME:
+                        frame_file = os.path.basename(video_post.frame_path(render_job["output_file"]))
+                        check_job = dict(render_job, save_last_frame=True, output_file=frame_file)
+                    else:
+                        check_job = dict(render_job, dry_run=True)
+                    yield ("preflight",)
+                    started = time.perf_counter()
+                    loop.run_in_executor(None, render_pool.run_render, check_job, put, None, cancel)
+                    while True:
+                        item = await queue.get()
+                        if item[0] == "done":
+                            break
+                    timer.record("preview_frame" if RENDER_PREVIEW_FRAME else "dry_run", time.perf_counter() - started)
+                    if item[1] != 0:
+                        render_scheduler.scheduler.release(ticket)
+                        yield item
+                        return
+                    if RENDER_PREVIEW_FRAME:
+                        yield ("frame", item[3])
+                started = time.perf_counter()
+                loop.run_in_executor(None, render_pool.run_render, render_job, put, None, cancel)
+                while True:
+                    item = await queue.get()
+                    if item[0] == "done":
+                        timer.record("render", time.perf_counter() - started)
+                        timer.record_manifest(item[3])
+                        # 先释放渲染槽再交出结果：调用方拿到 done 后不会继续迭代本生成器
+                        render_scheduler.scheduler.release(ticket)
+                        yield item
+                        break
+                    yield item
+            finally:
+                # 客户端断开时在此被取消：结束仍在运行的渲染进程组并释放渲染槽
+                cancel.set()
+                render_scheduler.scheduler.release(ticket)
+
+        async def publish_frame(manifest):
+            """预览帧移到 static/videos/<task_id>.frame.png，返回带内容哈希的地址；失败返回 None。"""
+            src_dir = os.path.dirname((manifest or {}).get("image_file_path") or "")
+            dest = video_post.frame_path(os.path.join(media_dir, output_file))
+            if not render_pool.publish_output(manifest, dest, field="image_file_path"):
+                return None
+            # manim 为 -s 建的 images/<脚本名> 目录此时已空
+            with contextlib.suppress(OSError):
+                os.rmdir(src_dir)
+            digest = await asyncio.get_running_loop().run_in_executor(None, video_post.content_hash, dest)
+            return f"/videos/{os.path.basename(dest)}?v={digest}"
+
+        async def publish_video(manifest):
+            """按 manifest 把视频移到 static/videos/<task_id>.mp4 并做后处理，返回 (是否成功, 地址字段)。"""
+            final_path = os.path.join(media_dir, output_file)
+            with timer.stage("publish"):
+                published = render_pool.publish_output(manifest, final_path)
+            if published:
                 try:
                     os.remove(py_path)
                 except Exception:
                     pass
-                return True, final_url
+                with timer.stage("post_process"):
+                    return True, await _finalize_video(final_path)
             return False, None
 
         manim_returncode = -1
         manim_stderr = ""
-        async for item in run_manim_stream_logs(cmd):
-            if item[0] == "log":
-                yield f"data: {json.dumps({'step': 'rendering', 'message': item[1], 'progress': 40})}\n\n"
-            else:
-                manim_returncode = item[1]
-                manim_stderr = item[2]
-                break
+        manim_manifest = None
+        if speculated and speculated[0] == "winner":
+            # 胜出候选已渲染完成，manifest 指向其输出
+            manim_returncode, manim_manifest = 0, speculated[3]
+        elif speculated and speculated[2] is not None:
+            # 候选均失败：直接用序号最小的失败候选的报错进入修正流程
+            manim_returncode, manim_stderr = speculated[2], speculated[3] or ""
+        else:
+            async for item in run_manim_stream_logs(job, code):
+                if item[0] == "log":
+                    yield {'step': 'rendering', 'message': item[1], 'progress': 40}
+                elif item[0] == "queued":
+                    yield {"step": "queued", "message": f"渲染排队中，您当前排在第 {item[1]} 位", "position": item[1], "progress": 40}
+                elif item[0] == "preflight":
+                    yield {'step': 'rendering', 'message': '预检中：试运行 construct...', 'progress': 40}
+                elif item[0] == "frame":
+                    frame_url = await publish_frame(item[1])
+                    if frame_url:
+                        yield {'step': 'preview_frame', 'message': '预览帧已生成，正在渲染完整视频...', 'image_url': frame_url, 'progress': 45}
+                elif item[0] == "busy":
+                    yield {"step": "error", "message": item[1]}
+                    return
+                else:
+                    manim_returncode = item[1]
+                    manim_stderr = item[2]
+                    manim_manifest = item[3]
+                    break
 
         if manim_returncode == 0:
-            yield f"data: {json.dumps({'step': 'rendering', 'message': '渲染完成，处理文件中...', 'progress': 90})}\n\n"
-            ok, final_url = locate_and_yield_complete()
+            yield {'step': 'rendering', 'message': '渲染完成，处理文件中...', 'progress': 90}
+            ok, video = await publish_video(manim_manifest)
             if ok:
-                yield f"data: {json.dumps({'step': 'complete', 'message': '渲染完成！', 'video_url': final_url, 'progress': 100})}\n\n"
+                render_cache.cache.store(cache_key, output_file)
+                code_cache.cache.put(code_key, code)
+                yield {'step': 'complete', 'message': '渲染完成！', **video, 'upgrade': upgrade, 'progress': 100}
+                if upgrade:
+                    render_upgrade.upgrader.start(code, user_key, task_id)
             else:
-                yield f"data: {json.dumps({'step': 'error', 'message': '渲染成功但未找到视频文件，请检查日志。'})}\n\n"
+                yield {'step': 'error', 'message': '渲染成功但未找到视频文件，请检查日志。'}
             return
 
         err_msg = manim_stderr or "Unknown Error or Timeout"
         logger.error(f"Manim Error: {err_msg}")
+        limit = render_sandbox.exceeded(manim_returncode, manim_stderr, limits)
+        if limit:
+            # 让大模型知道是场景过重，而不是语法错误
+            err_msg = render_sandbox.describe(limit, limits) + "，请简化场景（减少对象数量、循环次数与动画时长）。\n" + err_msg
 
         # 自动修正：将错误信息发给大模型，修正代码后重试一次
-        yield f"data: {json.dumps({'step': 'fixing_code', 'message': '渲染报错，正在根据错误信息修正代码并重试...', 'progress': 35})}\n\n"
+        timer.retry()
+        yield {'step': 'fixing_code', 'message': '渲染报错，正在根据错误信息修正代码并重试...', 'progress': 35}
         fix_prompt = (
-            "上述 Manim 代码在渲染时报错，错误信息如下：\n\n"
+            "上述 Manim 代码在预检或渲染时报错，错误信息如下：\n\n"
             "```\n" + (err_msg[:3000] if err_msg else "Unknown Error or Timeout") + "\n```\n\n"
             "请根据错误信息修正代码。要求：只输出修正后的完整 Python 代码，不要输出任何解释或 Markdown。"
             "必须保留 `from manim import *` 和类名 `GenScene`，所有动画逻辑在 `def construct(self):` 中。"
@@ -698,46 +905,73 @@ async def generate_animation_stream(data: CalcModel):
             {"role": "user", "content": fix_prompt}
         ]
         try:
-            completion2 = client.chat.completions.create(model="qwen-plus", messages=fix_messages)
-            code2 = completion2.choices[0].message.content.strip()
+            with timer.stage("llm_fix"):
+                code2 = await llm.chat(model="qwen-plus", messages=fix_messages)
+            code2 = code2.strip()
             code2 = code2.replace("```python", "").replace("```", "").strip()
             with open(py_path, "w", encoding="utf-8") as f:
                 f.write(code2)
-            yield f"data: {json.dumps({'step': 'code_generated', 'message': '已根据报错修正代码，正在重新渲染...', 'code': code2, 'progress': 30})}\n\n"
-            yield f"data: {json.dumps({'step': 'rendering', 'message': 'Manim 重新渲染中...', 'progress': 40})}\n\n"
+            yield {'step': 'code_generated', 'message': '已根据报错修正代码，正在重新渲染...', 'code': code2, 'progress': 30}
+            yield {'step': 'rendering', 'message': 'Manim 重新渲染中...', 'progress': 40}
         except Exception as e:
             logger.error(f"LLM fix Error: {e}")
             payload = {"step": "error", "message": "渲染失败，且自动修正请求异常：\n" + str(e)}
-            yield "data: " + json.dumps(payload, ensure_ascii=False) + "\n\n"
+            yield payload
             return
 
         manim_returncode2 = -1
         manim_stderr2 = ""
-        async for item in run_manim_stream_logs(cmd):
+        manim_manifest2 = None
+        async for item in run_manim_stream_logs(job, code2):
             if item[0] == "log":
-                yield f"data: {json.dumps({'step': 'rendering', 'message': item[1], 'progress': 40})}\n\n"
+                yield {'step': 'rendering', 'message': item[1], 'progress': 40}
+            elif item[0] == "queued":
+                yield {"step": "queued", "message": f"渲染排队中，您当前排在第 {item[1]} 位", "position": item[1], "progress": 40}
+            elif item[0] == "preflight":
+                yield {'step': 'rendering', 'message': '预检中：试运行 construct...', 'progress': 40}
+            elif item[0] == "frame":
+                frame_url = await publish_frame(item[1])
+                if frame_url:
+                    yield {'step': 'preview_frame', 'message': '预览帧已生成，正在渲染完整视频...', 'image_url': frame_url, 'progress': 45}
+            elif item[0] == "busy":
+                yield {"step": "error", "message": item[1]}
+                return
             else:
                 manim_returncode2 = item[1]
                 manim_stderr2 = item[2]
+                manim_manifest2 = item[3]
                 break
         if manim_returncode2 == 0:
-            yield f"data: {json.dumps({'step': 'rendering', 'message': '渲染完成，处理文件中...', 'progress': 90})}\n\n"
-            ok, final_url = locate_and_yield_complete()
+            yield {'step': 'rendering', 'message': '渲染完成，处理文件中...', 'progress': 90}
+            ok, video = await publish_video(manim_manifest2)
             if ok:
-                yield f"data: {json.dumps({'step': 'complete', 'message': '修正后渲染完成！', 'video_url': final_url, 'progress': 100})}\n\n"
+                render_cache.cache.store(render_cache.make_key(code2), output_file)
+                code_cache.cache.put(code_key, code2)
+                yield {'step': 'complete', 'message': '修正后渲染完成！', **video, 'upgrade': upgrade, 'progress': 100}
+                if upgrade:
+                    render_upgrade.upgrader.start(code2, user_key, task_id)
             else:
-                yield f"data: {json.dumps({'step': 'error', 'message': '渲染成功但未找到视频文件，请检查日志。'})}\n\n"
+                yield {'step': 'error', 'message': '渲染成功但未找到视频文件，请检查日志。'}
             return
 
         err_msg2 = manim_stderr2 or "Unknown Error or Timeout"
+        limit = render_sandbox.exceeded(manim_returncode2, manim_stderr2, limits)
+        if limit:
+            yield {"step": "error", "message": f"已根据报错修正并重试一次，仍{render_sandbox.describe(limit, limits)}。请尝试简化算式。",
+                   "limit": limit}
+            return
         if manim_returncode2 == -1 or not err_msg2:
             error_msg = "已根据报错修正并重试一次，仍然超时。请尝试简化算式或稍后再试。"
         else:
             short_err = err_msg2.split("\n")[-5:]
             error_msg = "已根据报错修正并重试一次，仍失败：\n" + "\n".join(short_err)
-        yield "data: " + json.dumps({"step": "error", "message": error_msg}, ensure_ascii=False) + "\n\n"
+        yield {"step": "error", "message": error_msg}
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+    media_dir = VIDEO_DIR
+    job = job_registry.registry.start(
+        task_id, metrics.track(timer, event_generator()), user_key, "animate", key=request_key,
+        on_cancel=lambda: _cleanup_render_files(os.path.join(media_dir, f"gen_{task_id}.py"), media_dir))
+    return _job_response(request, job)
 
 
 class ManimCodeModel(BaseModel):
@@ -753,7 +987,7 @@ class AgentRequest(BaseModel):
 # main.py
 
 @app.post("/api/devtools/run_manim")
-async def run_custom_manim(data: ManimCodeModel):
+async def run_custom_manim(data: ManimCodeModel, request: Request, auth_session: Optional[str] = Cookie(None)):
     # 1. 安全检查 (稍微放宽，防止误杀)
     # 注意：这种基于字符串的检查非常脆弱，生产环境建议使用沙箱 (Docker/NSjail)
     forbidden = ["import os", "import sys", "import subprocess", "rm -rf", "shutil"]
@@ -762,92 +996,74 @@ async def run_custom_manim(data: ManimCodeModel):
             return JSONResponse(status_code=400,
                                 content={"status": "error", "message": f"安全拦截: 禁止使用 '{keyword}'"})
 
+    cache_key = render_cache.make_key(data.code)
+    cached_file = render_cache.cache.lookup(cache_key)
+    if cached_file:
+        return {"status": "success", **(await _cached_video(cached_file)), "cached": True}
+
+    user_key = _client_key(request, auth_session)
+    try:
+        ticket = render_scheduler.scheduler.submit(user_key)
+    except render_scheduler.QueueFull:
+        return _render_busy_response()
+
     task_id = str(uuid.uuid4())
     py_filename = f"dev_{task_id}.py"
-    py_path = os.path.join("static/videos", py_filename)
+    py_path = os.path.join(VIDEO_DIR, py_filename)
 
     try:
+        # 排队等待渲染槽
+        async for _ in render_scheduler.scheduler.wait(ticket):
+            pass
+
         # 写入代码
         with open(py_path, "w", encoding="utf-8") as f:
             f.write(data.code)
 
-        media_dir = os.path.abspath("static/videos")
+        media_dir = VIDEO_DIR
         output_file = f"{task_id}.mp4"
 
-        # 2. 构造命令
+        # 2. 构造渲染任务
         # -ql: 低质量快速渲染（480p15），已为 Manim 最快预设
         # 不传 --disable_caching：保留缓存，相同代码再次运行可复用缓存以加速
-        cmd = [
-            sys.executable, "-m", "manim",
-            "-ql",
-            "--media_dir", media_dir,
-            "-o", output_file,
-            os.path.abspath(py_path),
-            "GenScene"  # 确保前端传来的代码里类名也是 GenScene
-        ]
+        # 确保前端传来的代码里类名也是 GenScene
+        # 任意用户代码：在 rlimit（CPU / 内存 / 文件数 / 输出大小）与降低的调度优先级下执行
+        limits = render_sandbox.limits_for("devtools", render_sandbox.tier_of(user_key))
+        job = render_pool.make_job(py_path, "GenScene", "-ql", media_dir, output_file, limits=limits)
 
-        logger.info(f"Running Manim DevTools: {' '.join(cmd)}")
+        logger.info(f"Running Manim DevTools: {job}")
 
-        # 3. 执行
+        # 3. 执行（常驻渲染 worker，免去 python -m manim 冷启动）
         loop = asyncio.get_running_loop()
-        result = await loop.run_in_executor(None, lambda: subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            encoding="utf-8",
-            timeout=60
-        ))
+        returncode, stderr_text, manifest = await loop.run_in_executor(
+            None, lambda: render_pool.run_render(job, timeout=60))
 
         # 4. 处理结果
-        if result.returncode == 0:
-            # 查找文件逻辑
-            # Manim 的输出路径结构通常是: /media_dir/videos/filename/quality/scene_name.mp4
-            # 或者由 -o 参数强行指定
-
-            # 优先检查 -o 指定的直接路径
-            # 注意：Manim 的 -o 参数行为比较诡异，它有时只作为文件名，路径还是遵循目录结构
-
-            # 兼容性查找：递归搜索 media_dir 下所有新生成的 mp4
-            # 这里我们简化逻辑：尝试几个可能的路径
-
-            possible_paths = [
-                # 1. 绝对路径指定 (理想情况)
-                os.path.join(media_dir, output_file),
-                # 2. 默认结构: videos/dev_xxx/480p15/GenScene.mp4 (如果 -o 无效)
-                os.path.join(media_dir, "videos", py_filename.replace(".py", ""), "480p15", "GenScene.mp4"),
-                # 3. 指定了文件名: videos/dev_xxx/480p15/uuid.mp4
-                os.path.join(media_dir, "videos", py_filename.replace(".py", ""), "480p15", output_file)
-            ]
-
-            final_path = os.path.join("static/videos", output_file)
-            found = False
-
-            for p in possible_paths:
-                if os.path.exists(p):
-                    # 移动到静态资源根目录
-                    import shutil
-                    shutil.move(p, final_path)
-                    found = True
-                    break
-
-            if found:
+        if returncode == 0:
+            # 渲染 worker 返回的 manifest 带有确切输出路径，直接移动到静态资源根目录
+            final_path = os.path.join(VIDEO_DIR, output_file)
+            if render_pool.publish_output(manifest, final_path):
                 # 清理
                 try:
                     os.remove(py_path)
                 except:
                     pass
-                return {"status": "success", "video_url": f"/videos/{output_file}"}
+                render_cache.cache.store(cache_key, output_file)
+                return {"status": "success", **await _finalize_video(final_path)}
             else:
-                logger.error(f"Render success but file not found. Search paths: {possible_paths}")
+                logger.error(f"Render success but file not found. Manifest: {manifest}")
                 return JSONResponse(status_code=500, content={"status": "error", "message": "渲染成功但未找到输出文件"})
 
         else:
             # 执行失败
-            logger.error(f"Manim Stderr: {result.stderr}")
-            logger.error(f"Manim Stdout: {result.stdout}")
+            logger.error(f"Manim Stderr: {stderr_text}")
+            limit = render_sandbox.exceeded(returncode, stderr_text, limits)
+            if limit:
+                return JSONResponse(status_code=400, content={
+                    "status": "error", "message": render_sandbox.describe(limit, limits), "limit": limit})
 
             # 返回更有意义的错误信息给前端
-            error_msg = result.stderr if result.stderr else result.stdout
+            error_msg = stderr_text or "渲染失败"
             # 过滤掉一些无关的进度条信息
             error_lines = [line for line in error_msg.split('\n') if
                            'Error' in line or 'Exception' in line or 'Traceback' in line]
@@ -861,10 +1077,12 @@ async def run_custom_manim(data: ManimCodeModel):
     except Exception as e:
         logger.error(f"Server Error: {e}")
         return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
+    finally:
+        render_scheduler.scheduler.release(ticket)
 
 
 @app.post("/api/devtools/run_manim_stream")
-async def run_manim_stream_endpoint(data: ManimCodeModel):
+async def run_manim_stream_endpoint(data: ManimCodeModel, request: Request, auth_session: Optional[str] = Cookie(None)):
     """Manim 云端渲染（SSE 流式），向前端推送实时日志与结果。"""
     forbidden = ["import os", "import sys", "import subprocess", "rm -rf", "shutil"]
     for keyword in forbidden:
@@ -873,50 +1091,61 @@ async def run_manim_stream_endpoint(data: ManimCodeModel):
                 yield f"data: {json.dumps({'type': 'error', 'message': f'安全拦截: 禁止使用 {keyword}'})}\n\n"
             return StreamingResponse(err(), media_type="text/event-stream")
 
+    timer = metrics.StageTimer("devtools")
+    cache_key = render_cache.make_key(data.code)
+    cached_file = render_cache.cache.lookup(cache_key)
+    timer.cache_lookup("render", bool(cached_file))
+    if cached_file:
+        timer.finish("cached")
+
+        async def cached():
+            yield f"data: {json.dumps({'type': 'complete', **(await _cached_video(cached_file)), 'cached': True})}\n\n"
+        return StreamingResponse(cached(), media_type="text/event-stream")
+
+    user_key = _client_key(request, auth_session)
+    running = job_registry.registry.find_active(user_key, cache_key)
+    if running:
+        return _job_response(request, running)
+
+    try:
+        ticket = render_scheduler.scheduler.submit(user_key)
+    except render_scheduler.QueueFull:
+        return _render_busy_response()
+
     task_id = str(uuid.uuid4())
     py_filename = f"dev_{task_id}.py"
-    py_path = os.path.join("static/videos", py_filename)
-    media_dir = os.path.abspath("static/videos")
+    py_path = os.path.join(VIDEO_DIR, py_filename)
+    media_dir = VIDEO_DIR
     output_file = f"{task_id}.mp4"
 
     async def event_stream():
+        try:
+            with timer.stage("queue_wait"):
+                async for position in render_scheduler.scheduler.wait(ticket):
+                    yield {"type": "queued", "position": position, "message": f"渲染排队中，您当前排在第 {position} 位"}
+        except BaseException:
+            render_scheduler.scheduler.release(ticket)
+            raise
+        try:
+            yield {'type': 'start', 'message': 'Manim 引擎启动中...'}
+            async for chunk in render_and_stream():
+                yield chunk
+        finally:
+            render_scheduler.scheduler.release(ticket)
+
+    async def render_and_stream():
         try:
             os.makedirs(media_dir, exist_ok=True)
-            with open(py_path, "w", encoding="utf-8") as f:
+            with timer.stage("file_write"), open(py_path, "w", encoding="utf-8") as f:
                 f.write(data.code)
         except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e)}, ensure_ascii=False)}\n\n"
+            yield {'type': 'error', 'message': str(e)}
             return
 
-        cmd = [
-            sys.executable, "-m", "manim", "-ql",
-            "--media_dir", media_dir, "-o", output_file,
-            os.path.abspath(py_path), "GenScene"
-        ]
-        yield f"data: {json.dumps({'type': 'start', 'message': 'Manim 引擎启动中...'})}\n\n"
-
-        def _run_manim_sync(cmd_list, put_sentinel):
-            """在线程中运行 Manim 子进程，逐行把 stderr 通过 put_sentinel(line) 送出，最后 put_sentinel(('done', returncode, stderr_text))。"""
-            proc = subprocess.Popen(
-                cmd_list,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
-                cwd=None,
-            )
-            stderr_chunks = []
-            try:
-                for raw in iter(proc.stderr.readline, b""):
-                    stderr_chunks.append(raw)
-                    try:
-                        text = raw.decode("utf-8", errors="replace").strip()
-                        if text:
-                            put_sentinel(("line", text))
-                    except Exception:
-                        pass
-            finally:
-                proc.wait()
-                err_full = b"".join(stderr_chunks).decode("utf-8", errors="replace")
-                put_sentinel(("done", proc.returncode, err_full))
+        limits = render_sandbox.limits_for("devtools", render_sandbox.tier_of(user_key))
+        job = render_pool.make_job(py_path, "GenScene", "-ql", media_dir, output_file, limits=limits)
+        cancel = threading.Event()
+        timer.attempts += 1
 
         try:
             loop = asyncio.get_event_loop()
@@ -925,120 +1154,93 @@ async def run_manim_stream_endpoint(data: ManimCodeModel):
             def put(item):
                 loop.call_soon_threadsafe(queue.put_nowait, item)
 
-            loop.run_in_executor(None, _run_manim_sync, cmd, put)
+            started = time.perf_counter()
+            loop.run_in_executor(None, render_pool.run_render, job, put, None, cancel)
 
             returncode = -1
             stderr_full = ""
+            manifest = None
             while True:
                 try:
                     kind = await asyncio.wait_for(queue.get(), timeout=300.0)
                 except asyncio.TimeoutError:
-                    yield f"data: {json.dumps({'type': 'error', 'message': '渲染超时'}, ensure_ascii=False)}\n\n"
+                    # 超时同样结束渲染进程，不再让其在后台跑完
+                    cancel.set()
+                    _cleanup_render_files(py_path, media_dir)
+                    yield {'type': 'error', 'message': '渲染超时'}
                     return
-                if kind[0] == "line":
-                    yield f"data: {json.dumps({'type': 'log', 'message': kind[1]}, ensure_ascii=False)}\n\n"
+                if kind[0] == "log":
+                    yield {'type': 'log', 'message': kind[1]}
                 else:
                     returncode = kind[1]
                     stderr_full = kind[2]
+                    manifest = kind[3]
+                    timer.record("render", time.perf_counter() - started)
+                    timer.record_manifest(manifest)
                     break
 
             if returncode != 0:
                 err_text = (stderr_full or "渲染失败")[-2000:]
-                yield f"data: {json.dumps({'type': 'error', 'message': err_text}, ensure_ascii=False)}\n\n"
+                limit = render_sandbox.exceeded(returncode, stderr_full, limits)
+                if limit:
+                    yield {'type': 'error', 'message': render_sandbox.describe(limit, limits) + "\n" + err_text, 'limit': limit}
+                else:
+                    yield {'type': 'error', 'message': err_text}
                 return
 
-            import shutil
-            py_base = py_filename.replace(".py", "")
             final_path = os.path.join(media_dir, output_file)
-            possible_paths = [
-                os.path.join(media_dir, output_file),
-                os.path.join(media_dir, "videos", py_base, "480p15", "GenScene.mp4"),
-                os.path.join(media_dir, "videos", py_base, "480p15", output_file),
-            ]
-            found = False
-            for p in possible_paths:
-                if os.path.exists(p):
-                    if os.path.abspath(p) != os.path.abspath(final_path):
-                        shutil.move(p, final_path)
-                    found = True
-                    break
-            if not found:
-                td = os.path.join(media_dir, "videos", py_base, "480p15")
-                if os.path.isdir(td):
-                    for f in os.listdir(td):
-                        if f.endswith(".mp4"):
-                            shutil.move(os.path.join(td, f), final_path)
-                            found = True
-                            break
-            if not found and os.path.isdir(os.path.join(media_dir, "videos")):
-                for root, _, files in os.walk(os.path.join(media_dir, "videos")):
-                    for f in files:
-                        if f.endswith(".mp4") and py_base in root:
-                            shutil.move(os.path.join(root, f), final_path)
-                            found = True
-                            break
-                    if found:
-                        break
-
+            with timer.stage("publish"):
+                found = render_pool.publish_output(manifest, final_path)
             if found:
                 try:
                     os.remove(py_path)
                 except Exception:
                     pass
-                yield f"data: {json.dumps({'type': 'complete', 'video_url': f'/videos/{output_file}'})}\n\n"
+                with timer.stage("post_process"):
+                    video = await _finalize_video(final_path)
+                render_cache.cache.store(cache_key, output_file)
+                yield {'type': 'complete', **video}
             else:
-                yield f"data: {json.dumps({'type': 'error', 'message': '渲染成功但未找到输出文件'})}\n\n"
+                yield {'type': 'error', 'message': '渲染成功但未找到输出文件'}
         except asyncio.TimeoutError:
-            yield f"data: {json.dumps({'type': 'error', 'message': '渲染超时'})}\n\n"
+            yield {'type': 'error', 'message': '渲染超时'}
         except Exception as e:
             msg = str(e).strip() or repr(e)
             logger.error("run_manim_stream: %s\n%s", msg, traceback.format_exc())
-            yield f"data: {json.dumps({'type': 'error', 'message': msg}, ensure_ascii=False)}\n\n"
+            yield {'type': 'error', 'message': msg}
+        finally:
+            cancel.set()
 
-    return StreamingResponse(event_stream(), media_type="text/event-stream")
+    job = job_registry.registry.start(task_id, metrics.track(timer, event_stream()), user_key, "devtools", key=cache_key,
+                                      on_cancel=lambda: _cleanup_render_files(py_path, media_dir))
+    return _job_response(request, job)
 
 
-def _locate_manim_video(media_dir: str, output_file: str, py_path: str) -> Optional[str]:
-    """Manim 渲染完成后查找并移动视频到 static/videos，返回 /videos/xxx.mp4 或 None。"""
-    import shutil
-    py_base = os.path.basename(py_path).replace(".py", "")
-    final_path = os.path.join(media_dir, output_file)
-    possible_paths = [
-        os.path.join(media_dir, output_file),
-        os.path.join(media_dir, "videos", py_base, "480p15", "GenScene.mp4"),
-        os.path.join(media_dir, "videos", py_base, "480p15", output_file),
-    ]
-    for p in possible_paths:
-        if os.path.exists(p):
-            if os.path.abspath(p) != os.path.abspath(final_path):
-                shutil.move(p, final_path)
-            try:
-                os.remove(py_path)
-            except Exception:
-                pass
-            return f"/videos/{output_file}"
-    td = os.path.join(media_dir, "videos", py_base, "480p15")
-    if os.path.isdir(td):
-        for f in os.listdir(td):
-            if f.endswith(".mp4"):
-                shutil.move(os.path.join(td, f), final_path)
-                try:
-                    os.remove(py_path)
-                except Exception:
-                    pass
-                return f"/videos/{output_file}"
-    if os.path.isdir(os.path.join(media_dir, "videos")):
-        for root, _, files in os.walk(os.path.join(media_dir, "videos")):
-            for f in files:
-                if f.endswith(".mp4") and py_base in root:
-                    shutil.move(os.path.join(root, f), final_path)
-                    try:
-                        os.remove(py_path)
-                    except Exception:
-                        pass
-                    return f"/videos/{output_file}"
-            break
-    return None
+@app.get("/api/jobs/{task_id}")
+async def get_job_status(task_id: str):
+    """渲染任务状态：进行中/完成/失败/已取消，完成时附带最后一个事件（含 video_url 或错误信息）。"""
+    job = job_registry.registry.get(task_id)
+    if not job:
+        return JSONResponse(status_code=404, content={"status": "error", "message": "任务不存在或已过期"})
+    return {"status": "success", "job": job.snapshot()}
+
+
+@app.get("/api/jobs/{task_id}/upgrade")
+async def get_job_upgrade(task_id: str):
+    """高清升级状态：rendering / ready（带 video_url）/ skipped。"""
+    upgrade = render_upgrade.upgrader.status(task_id)
+    if upgrade is None:
+        return JSONResponse(status_code=404, content={"status": "error", "message": "没有该任务的高清升级"})
+    return {"status": "success", "upgrade": upgrade}
+
+
+@app.get("/api/jobs/{task_id}/events")
+async def get_job_events(task_id: str, request: Request):
+    """断线重连：按 Last-Event-ID 补发错过的事件，并继续推送进行中任务的后续事件。"""
+    job = job_registry.registry.get(task_id)
+    if not job:
+        return JSONResponse(status_code=404, content={"status": "error", "message": "任务不存在或已过期"})
+    return _job_response(request, job, _last_event_id(request))
 
 
 @app.post("/api/agent/execute")
@@ -1051,7 +1253,7 @@ async def agent_execute(data: AgentRequest):
             if not api_key:
                 latex_from_image = r"E = mc^2"
             else:
-                completion = client.chat.completions.create(
+                latex_from_image = await llm.chat(
                     model="qwen-vl-max",
                     messages=[{
                         "role": "user",
@@ -1061,7 +1263,7 @@ async def agent_execute(data: AgentRequest):
                         ]
                     }]
                 )
-                latex_from_image = completion.choices[0].message.content.strip()
+                latex_from_image = latex_from_image.strip()
                 latex_from_image = latex_from_image.replace("```latex", "").replace("```", "").replace("\\[", "").replace("\\]", "").strip()
         except Exception as e:
             logger.error(f"Agent image recognition: {e}")
@@ -1077,8 +1279,8 @@ async def agent_execute(data: AgentRequest):
         "trigger：用户要立刻生成动画填 generate；仅识别/展示结果填 recognize；只跳转不执行填 none。"
     )
     try:
-        completion = client.chat.completions.create(model="qwen-plus", messages=[{"role": "user", "content": prompt_for_llm}])
-        raw = completion.choices[0].message.content.strip()
+        raw = await llm.chat(model="qwen-plus", messages=[{"role": "user", "content": prompt_for_llm}])
+        raw = raw.strip()
         if "```" in raw:
             raw = raw.split("```")[1].replace("json", "").strip()
         import re
@@ -1108,13 +1310,103 @@ async def agent_execute(data: AgentRequest):
         return JSONResponse(status_code=200, content={"status": "error", "message": "理解您的描述时出错：" + str(e)})
 
 
+# --- 指标 (/metrics) ---
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# 各模块已有的 stats() 一并导出
+metrics.registry.register("llm", llm.stats, label="model")
+metrics.registry.register("render_scheduler", render_scheduler.scheduler.stats)
+metrics.registry.register("render_cache", render_cache.cache.stats)
+metrics.registry.register("render_upgrade", render_upgrade.upgrader.stats)
+metrics.registry.register("speculative", speculative.speculator.stats)
+metrics.registry.register("code_cache", code_cache.cache.stats)
+metrics.registry.register("jobs", job_registry.registry.stats)
+metrics.registry.register("password_hasher", hasher.stats)
+metrics.registry.register("captcha_pool", captcha.pool.stats)
+metrics.registry.register("gallery", gallery.index.stats)
+metrics.registry.register("video_gc", video_gc.gc.stats)
+metrics.registry.register("db", db.stats)
+metrics.registry.register("kv_store", lambda: {"session": SESSION_STORE.stats(), "captcha": CAPTCHA_STORE.stats(),
+                                               "rate_limit": rate_limit.limiter.store.stats()},
+                          label="store")
+metrics.registry.register("rate_limit", rate_limit.limiter.stats, label="route_class")
+
+
+@app.get("/metrics")
+async def prometheus_metrics(request: Request):
+    """Prometheus 文本格式指标；设置了 METRICS_TOKEN 时需带 Authorization: Bearer <token>。"""
+    if METRICS_TOKEN and not hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        return JSONResponse(status_code=401, content={"status": "error", "message": "未授权"})
+    return Response(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
+async def _saved_script_render_keys():
+    """已保存动画脚本对应的渲染缓存键，视频清理时保留这些视频；数据库不可用时返回 None（缓存中的视频一律保留）。"""
+    try:
+        return {render_cache.make_key(code) async for code in db.iter_script_codes()}
+    except Exception as e:
+        logger.warning(f"Video GC: cannot load saved scripts ({e}), keeping all cached videos")
+        return None
+
+
+_video_gc_task = None
+_loop_lag_task = None
+
+
+@app.on_event("startup")
+async def start_render_pool():
+    # 预热渲染 worker：import manim 的耗时在服务启动时完成，而非首个请求
+    render_pool.get_pool().start()
+    captcha.pool.start()
+    gallery.index.warm()
+    try:
+        await db.connect()
+    except Exception as e:
+        logger.error(f"Error creating database pool: {e}")
+    # 连接数据库之后再启动清理任务，首轮即可读取已保存脚本
+    global _video_gc_task, _loop_lag_task
+    _video_gc_task = asyncio.ensure_future(video_gc.gc.run_forever(_saved_script_render_keys))
+    _loop_lag_task = asyncio.ensure_future(metrics.monitor_loop_lag())
+
+
+@app.on_event("shutdown")
+async def stop_render_pool():
+    job_registry.registry.cancel_all()
+    render_upgrade.upgrader.cancel_all()
+    for task in (_video_gc_task, _loop_lag_task):
+        if task is not None:
+            task.cancel()
+    video_gc.gc.flush()
+    render_pool.get_pool().shutdown()
+    render_cache.cache.flush()
+    await llm.aclose()
+    await db.close()
+    hasher.shutdown()
+    captcha.pool.stop()
+
+
 # --- 静态资源与路由 ---
 app.mount("/css", StaticFiles(directory="static/css"), name="css")
 app.mount("/js", StaticFiles(directory="static/js"), name="js")
 app.mount("/assets", StaticFiles(directory="static/assets"), name="assets")
 app.mount("/docs", StaticFiles(directory="static/docs"), name="docs")
+class TrackedStaticFiles(StaticFiles):
+    """读取视频时记录访问时间，供视频清理任务按最近访问淘汰；按地址是否带内容哈希设置缓存头。"""
+
+    async def get_response(self, path, scope):
+        video_gc.gc.touch(os.path.basename(path))
+        response = await super().get_response(path, scope)
+        if response.status_code in (200, 206, 304):
+            if "v" in QueryParams(scope.get("query_string", b"")):
+                # 地址带内容哈希 (video_post.video_urls)：内容变化地址就变，可永久缓存
+                response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+            else:
+                response.headers["Cache-Control"] = "public, no-cache"
+        return response
+
+
 # /videos 单独挂载
-app.mount("/videos", StaticFiles(directory="static/videos"), name="videos")
+app.mount("/videos", TrackedStaticFiles(directory=VIDEO_DIR), name="videos")
 # 根静态
 app.mount("/static", StaticFiles(directory="static"), name="static_root")
 
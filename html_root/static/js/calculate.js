@@ -105,6 +105,7 @@ export async function startAnimation() {
         videoPlayer.pause();
         videoPlayer.style.display = 'none';
         videoPlayer.src = "";
+        videoPlayer.poster = "";
     }
     if(placeholder) placeholder.style.display = 'block';
     const saveScriptWrap = document.getElementById('calc-save-script-wrap');
@@ -125,9 +126,8 @@ export async function startAnimation() {
         logBox.scrollTop = logBox.scrollHeight;
     }
 
-    // 辅助：流式打字机显示代码
-    async function streamCodeBlock(fullCode) {
-        if (!logBox) return;
+    // 辅助：在日志区创建代码块
+    function createCodeBlock() {
         const pre = document.createElement('pre');
         pre.style.marginTop = "10px";
         pre.style.marginBottom = "10px";
@@ -144,6 +144,21 @@ export async function startAnimation() {
 
         pre.appendChild(codeEl);
         logBox.appendChild(pre);
+        return codeEl;
+    }
+
+    // 生成过程中实时追加的代码块（code_delta）
+    let liveCodeEl = null;
+    // 后台任务 ID 与最后收到的事件序号：断线重连与高清升级轮询都要用，响应头到达后赋值
+    let jobId = null;
+    let lastEventId = 0;
+    // 当前应播放的视频地址：高清版本可能在 complete 的延时播放之前就已就绪
+    let currentVideoUrl = '';
+
+    // 辅助：流式打字机显示代码
+    async function streamCodeBlock(fullCode) {
+        if (!logBox) return;
+        const codeEl = createCodeBlock();
 
         const chars = fullCode.split('');
         let currentText = "";
@@ -169,6 +184,138 @@ export async function startAnimation() {
         });
     }
 
+    // 高清升级在服务端独立的后台任务中渲染，SSE 流在 complete 后即结束；这里轮询升级状态，就绪后切换视频
+    async function pollUpgrade(id) {
+        while (true) {
+            await new Promise(r => setTimeout(r, 3000));
+            let upgrade;
+            try {
+                const resp = await fetch(`/api/jobs/${id}/upgrade`);
+                if (!resp.ok) return;
+                upgrade = (await resp.json()).upgrade;
+            } catch (e) {
+                return;
+            }
+            if (upgrade.state === 'rendering') continue;
+            if (upgrade.state !== 'ready') return;
+            addLog(`🎞 ${upgrade.quality} 高清版本已就绪`, "#a78bfa");
+            currentVideoUrl = upgrade.video_url;
+            // 已在播放低清版本：切换到高清并保持播放进度
+            if (videoPlayer && videoPlayer.getAttribute('src')) {
+                const position = videoPlayer.currentTime;
+                const paused = videoPlayer.paused;
+                videoPlayer.src = currentVideoUrl;
+                videoPlayer.addEventListener('loadedmetadata', () => {
+                    videoPlayer.currentTime = Math.min(position, videoPlayer.duration || position);
+                    if (!paused) videoPlayer.play();
+                }, { once: true });
+            }
+            return;
+        }
+    }
+
+    // 处理单个事件，返回 true 表示任务已结束 (complete / error)
+    async function handleEvent(data) {
+            if (data.progress) {
+                if(progBar) progBar.style.width = data.progress + '%';
+                if(percentText) percentText.innerText = data.progress + '%';
+
+                if(data.progress < 30 && progBar) progBar.style.background = "#3b82f6";
+                else if(data.progress < 90 && progBar) progBar.style.background = "#8b5cf6";
+                else if(progBar) progBar.style.background = "#10b981";
+            }
+
+            if (data.step === 'generating_code') {
+                addLog("正在构思数学可视化脚本...", "#fbbf24");
+            }
+            else if (data.step === 'code_delta') {
+                if (logBox && data.delta) {
+                    if (!liveCodeEl) {
+                        addLog("脚本生成中：", "#fbbf24");
+                        liveCodeEl = createCodeBlock();
+                    }
+                    liveCodeEl.textContent += data.delta;
+                    logBox.scrollTop = logBox.scrollHeight;
+                }
+            }
+            else if (data.step === 'code_generated') {
+                if (data.code) lastGeneratedCode = data.code;
+                if (liveCodeEl) {
+                    // 已实时显示过，替换为最终代码并高亮
+                    addLog(data.message || "脚本生成完毕", "#34d399");
+                    if (data.code) liveCodeEl.textContent = data.code;
+                    if (window.hljs) window.hljs.highlightElement(liveCodeEl);
+                    liveCodeEl = null;
+                } else {
+                    addLog("脚本生成完毕，代码预览：", "#34d399");
+                    if (data.code) {
+                        await streamCodeBlock(data.code);
+                    }
+                }
+            }
+            else if (data.step === 'fixing_code') {
+                addLog(data.message || "渲染报错，正在根据错误信息修正代码并重试...", "#fbbf24");
+            }
+            else if (data.step === 'speculating' || data.step === 'candidate_generated') {
+                addLog(data.message, "#fbbf24");
+            }
+            else if (data.step === 'candidate_dropped') {
+                addLog(data.message, "#94a3b8");
+            }
+            else if (data.step === 'queued') {
+                addLog("⏳ " + (data.message || "渲染排队中..."), "#fbbf24");
+            }
+            else if (data.step === 'rendering') {
+                if (data.message) {
+                    addLog(data.message, "#e2e8f0");
+                }
+            }
+            else if (data.step === 'preview_frame') {
+                // 先展示最后一帧，完整视频渲染完成后替换
+                addLog(data.message || "预览帧已生成", "#e2e8f0");
+                if (placeholder) placeholder.style.display = 'none';
+                if (videoPlayer && data.image_url) {
+                    videoPlayer.poster = data.image_url;
+                    videoPlayer.style.display = 'block';
+                }
+            }
+            else if (data.step === 'complete') {
+                if (renderLoading) renderLoading.style.display = 'none';
+                addLog("✨ 渲染完成！视频加载中...", "#a78bfa");
+                if (data.metrics) {
+                    // 各阶段耗时 (秒)，由服务端附带
+                    const stages = Object.entries(data.metrics.stages || {})
+                        .map(([name, sec]) => `${name} ${sec}s`).join(' · ');
+                    addLog(`总耗时 ${data.metrics.total}s${stages ? '（' + stages + '）' : ''}`, "#64748b");
+                }
+                currentVideoUrl = data.video_url;
+                setTimeout(() => {
+                    if (placeholder) placeholder.style.display = 'none';
+                    if (videoPlayer) {
+                        // video_url 带内容哈希，无需再追加时间戳绕过缓存
+                        videoPlayer.poster = data.preview_url || '';
+                        videoPlayer.src = currentVideoUrl;
+                        videoPlayer.style.display = 'block';
+                        videoPlayer.play();
+                    }
+                    const saveScriptWrap = document.getElementById('calc-save-script-wrap');
+                    if (saveScriptWrap && lastGeneratedCode) saveScriptWrap.style.display = 'block';
+                }, 500);
+                if (data.upgrade && jobId) {
+                    addLog("正在后台渲染高清版本...", "#94a3b8");
+                    pollUpgrade(jobId);
+                }
+                return true;
+            }
+            else if (data.step === 'error') {
+                if (renderLoading) renderLoading.style.display = 'none';
+                addLog("❌ 错误: " + data.message, "#ef4444");
+                if(progBar) progBar.style.background = "#ef4444";
+                return true;
+            }
+        return false;
+    }
+
     try {
         const response = await fetch('/api/animate/stream', {
             method: 'POST',
@@ -180,80 +327,67 @@ export async function startAnimation() {
             })
         });
 
-        const reader = response.body.getReader();
-        const decoder = new TextDecoder();
-        let buffer = '';
-
-        while (true) {
-            const { done, value } = await reader.read();
-            if (done) break;
-
-            buffer += decoder.decode(value, { stream: true });
-            const lines = buffer.split('\n\n');
-            buffer = lines.pop();
+        if (response.status === 429) {
+            const loadingEl = document.getElementById('calc-render-loading');
+            if (loadingEl) loadingEl.style.display = 'none';
+            const body = await response.json().catch(() => ({}));
+            addLog("⏳ " + (body.message || "渲染队列已满，请稍后再试"), "#f59e0b");
+            return;
+        }
 
-            for (const line of lines) {
-                if (line.startsWith('data: ')) {
-                    const jsonStr = line.replace('data: ', '');
+        // 读取 SSE 流直到任务结束；返回 false 表示连接提前中断
+        async function readStream(resp) {
+            const reader = resp.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) return false;
+
+                buffer += decoder.decode(value, { stream: true });
+                const blocks = buffer.split('\n\n');
+                buffer = blocks.pop();
+
+                for (const block of blocks) {
+                    let jsonStr = null;
+                    for (const line of block.split('\n')) {
+                        if (line.startsWith('id: ')) lastEventId = parseInt(line.slice(4), 10) || lastEventId;
+                        else if (line.startsWith('data: ')) jsonStr = line.slice(6);
+                    }
+                    if (jsonStr === null) continue;
+                    let data;
                     try {
-                        const data = JSON.parse(jsonStr);
-
-                        if (data.progress) {
-                            if(progBar) progBar.style.width = data.progress + '%';
-                            if(percentText) percentText.innerText = data.progress + '%';
-
-                            if(data.progress < 30 && progBar) progBar.style.background = "#3b82f6";
-                            else if(data.progress < 90 && progBar) progBar.style.background = "#8b5cf6";
-                            else if(progBar) progBar.style.background = "#10b981";
-                        }
-
-                        if (data.step === 'generating_code') {
-                            addLog("正在构思数学可视化脚本...", "#fbbf24");
-                        }
-                        else if (data.step === 'code_generated') {
-                            if (data.code) lastGeneratedCode = data.code;
-                            addLog("脚本生成完毕，代码预览：", "#34d399");
-                            if (data.code) {
-                                await streamCodeBlock(data.code);
-                            }
-                        }
-                        else if (data.step === 'fixing_code') {
-                            addLog(data.message || "渲染报错，正在根据错误信息修正代码并重试...", "#fbbf24");
-                        }
-                        else if (data.step === 'rendering') {
-                            if (data.message) {
-                                addLog(data.message, "#e2e8f0");
-                            }
-                        }
-                        else if (data.step === 'complete') {
-                            if (renderLoading) renderLoading.style.display = 'none';
-                            addLog("✨ 渲染完成！视频加载中...", "#a78bfa");
-                            setTimeout(() => {
-                                if (placeholder) placeholder.style.display = 'none';
-                                if (videoPlayer) {
-                                    videoPlayer.src = `${data.video_url}?t=${new Date().getTime()}`;
-                                    videoPlayer.style.display = 'block';
-                                    videoPlayer.play();
-                                }
-                                const saveScriptWrap = document.getElementById('calc-save-script-wrap');
-                                if (saveScriptWrap && lastGeneratedCode) saveScriptWrap.style.display = 'block';
-                            }, 500);
-                            return;
-                        }
-                        else if (data.step === 'error') {
-                            if (renderLoading) renderLoading.style.display = 'none';
-                            addLog("❌ 错误: " + data.message, "#ef4444");
-                            if(progBar) progBar.style.background = "#ef4444";
-                            return;
-                        }
-
+                        data = JSON.parse(jsonStr);
                     } catch (e) {
                         console.warn("JSON Parse Warning", e);
+                        continue;
                     }
+                    if (await handleEvent(data)) return true;
                 }
             }
         }
 
+        // 断线重连：凭任务 ID 与最后收到的事件序号续接同一任务，不会重新生成或重新渲染
+        jobId = response.headers.get('X-Job-Id');
+        let stream = response;
+        for (let attempt = 0; ; attempt++) {
+            try {
+                if (await readStream(stream)) return;
+            } catch (e) {
+                console.warn("Stream interrupted", e);
+            }
+            if (!jobId || attempt >= 5) throw new Error("stream closed");
+            addLog("连接中断，正在重新连接...", "#f59e0b");
+            await new Promise(r => setTimeout(r, 1000 * (attempt + 1)));
+            try {
+                stream = await fetch(`/api/jobs/${jobId}/events`, { headers: { 'Last-Event-ID': String(lastEventId) } });
+            } catch (e) {
+                continue;
+            }
+            if (stream.status === 404) throw new Error("job expired");
+        }
+
     } catch (e) {
         console.error(e);
         const loadingEl = document.getElementById('calc-render-loading');
@@ -276,7 +276,10 @@ export async function runDevManim() {
             body: JSON.stringify({ code })
         });
         if (!res.ok || !res.body) {
-            if (logEl) logEl.textContent = '请求失败';
+            if (logEl) {
+                const body = res.status === 429 ? await res.json().catch(() => ({})) : {};
+                logEl.textContent = body.message || '请求失败';
+            }
             placeholder.style.display = 'block';
             loading.style.display = 'none';
             return;
@@ -297,11 +300,13 @@ export async function runDevManim() {
                         if (data.type === 'log' && data.message && logEl) {
                             logEl.textContent += '> ' + data.message + '\n';
                             logEl.scrollTop = logEl.scrollHeight;
-                        } else if (data.type === 'start' && logEl) {
+                        } else if ((data.type === 'start' || data.type === 'queued') && logEl) {
                             logEl.textContent += '> ' + (data.message || '') + '\n';
                             logEl.scrollTop = logEl.scrollHeight;
                         } else if (data.type === 'complete' && data.video_url) {
-                            video.src = `${data.video_url}?t=${new Date().getTime()}`;
+                            // video_url 带内容哈希，无需再追加时间戳绕过缓存
+                            video.poster = data.preview_url || '';
+                            video.src = data.video_url;
                             video.style.display = 'block';
                             if (logEl) { logEl.textContent += '> 渲染完成。\n'; logEl.scrollTop = logEl.scrollHeight; }
                         } else if (data.type === 'error') {
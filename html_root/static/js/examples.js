@@ -32,7 +32,19 @@ function renderExampleCards(videos) {
     grid.innerHTML = videos.map(v => `
         <div class="video-card" onclick="playExample('${v.url}', '${v.title}', '${v.description}')">
             <div class="thumbnail video-preview-container">
-                <!-- 鼠标悬停预览 (静音) -->
+                <!-- 有封面时只加载封面图，悬停时才开始下载视频预览 (静音) -->
+                ${v.poster ? `
+                <video 
+                    poster="${v.poster}" 
+                    data-src="${v.url}" 
+                    muted 
+                    loop 
+                    playsinline 
+                    preload="none"
+                    onmouseover="if (!this.getAttribute('src')) this.src = this.dataset.src; this.play()" 
+                    onmouseout="this.pause(); this.currentTime=0;"
+                    style="width:100%; height:100%; object-fit:cover;"
+                ></video>` : `
                 <video 
                     src="${v.url}#t=0.5" 
                     muted 
@@ -42,10 +54,11 @@ function renderExampleCards(videos) {
                     onmouseover="this.play()" 
                     onmouseout="this.pause(); this.currentTime=0.5;"
                     style="width:100%; height:100%; object-fit:cover;"
-                ></video>
+                ></video>`}
                 <div class="play-overlay">
                     <i class="fa-solid fa-play-circle"></i>
                 </div>
+                ${v.duration ? `<span class="video-duration">${formatDuration(v.duration)}</span>` : ''}
             </div>
             <div class="info">
                 <h4>${v.title}</h4>
@@ -55,6 +68,11 @@ function renderExampleCards(videos) {
     `).join('');
 }
 
+function formatDuration(seconds) {
+    const total = Math.round(seconds);
+    return `${Math.floor(total / 60)}:${String(total % 60).padStart(2, '0')}`;
+}
+
 export function playExample(videoSrc, title, desc) {
     const player = document.getElementById('example-video-player');
     const titleEl = document.getElementById('video-modal-title');
@@ -12,6 +12,56 @@ function getCurrentUser() {
     return null;
 }
 
+// --- 列表分页 + ETag 协商缓存 ---
+// 第一页带 If-None-Match 重新验证：304 只说明第一页没变，"加载更多"取到的后续页未经校验，
+// 所以只保留第一页、游标退回第一页末尾，用户再点"加载更多"时重新拉取
+const listCache = {
+    formulas: { user: null, etag: null, items: [], nextCursor: null, firstPageSize: 0, firstCursor: null },
+    scripts: { user: null, etag: null, items: [], nextCursor: null, firstPageSize: 0, firstCursor: null },
+};
+
+async function fetchListPage(url, etag) {
+    const headers = etag ? { 'If-None-Match': etag } : {};
+    const res = await fetch(url, { headers, cache: 'no-store' });
+    if (res.status === 304) return { notModified: true };
+    const data = await res.json();
+    return { notModified: false, data, etag: res.headers.get('ETag') };
+}
+
+// 返回 'not-modified' | 'updated' | 'error'
+async function revalidateList(kind, url, user) {
+    const cache = listCache[kind];
+    const page = await fetchListPage(url, cache.user === user ? cache.etag : null);
+    if (page.notModified) {
+        if (cache.items.length === cache.firstPageSize) return 'not-modified';
+        cache.items = cache.items.slice(0, cache.firstPageSize);
+        cache.nextCursor = cache.firstCursor;
+        return 'updated';
+    }
+    if (page.data.status !== 'success') return 'error';
+    Object.assign(cache, {
+        user, etag: page.etag, items: page.data.data, nextCursor: page.data.next_cursor,
+        firstPageSize: page.data.data.length, firstCursor: page.data.next_cursor,
+    });
+    return 'updated';
+}
+
+async function fetchNextPage(kind, url) {
+    const cache = listCache[kind];
+    const { data } = await fetchListPage(`${url}&cursor=${encodeURIComponent(cache.nextCursor)}`);
+    if (!data || data.status !== 'success') return null;
+    cache.items = cache.items.concat(data.data);
+    cache.nextCursor = data.next_cursor;
+    return data.data;
+}
+
+function loadMoreHtml(id, handler) {
+    return `
+        <div class="load-more-wrap" style="grid-column:1/-1; text-align:center; padding:1rem 0;">
+            <button id="${id}" class="action-btn secondary" onclick="${handler}">加载更多</button>
+        </div>`;
+}
+
 // --- 核心：保存请求 ---
 async function performSave(user, latex, note) {
     try {
@@ -157,26 +207,80 @@ export async function loadMyFormulas() {
         return;
     }
 
-    container.innerHTML = `
-        <div class="empty-state">
-            <i class="fa-solid fa-spinner fa-spin"></i>
-            <p>正在同步云端数据...</p>
-        </div>`;
+    const cache = listCache.formulas;
+    const hasLocal = cache.user === user;
+    if (hasLocal) {
+        // 先显示本地数据，再向服务端校验是否有变化
+        if (!container.querySelector('.formula-card')) renderList(cache.items, cache.nextCursor);
+    } else {
+        container.innerHTML = `
+            <div class="empty-state">
+                <i class="fa-solid fa-spinner fa-spin"></i>
+                <p>正在同步云端数据...</p>
+            </div>`;
+    }
 
     try {
-        const res = await fetch(`/api/formulas/list?username=${user}`);
-        const data = await res.json();
-        if (data.status === 'success') {
-            renderList(data.data);
-        } else {
+        const result = await revalidateList('formulas', `/api/formulas/list?username=${encodeURIComponent(user)}`, user);
+        if (result === 'updated') {
+            renderList(cache.items, cache.nextCursor);
+        } else if (result === 'error' && !hasLocal) {
             container.innerHTML = "加载失败";
         }
     } catch(e) {
-        container.innerHTML = "网络错误";
+        if (!hasLocal) container.innerHTML = "网络错误";
     }
 }
 
-function renderList(formulas) {
+export async function loadMoreFormulas() {
+    const user = getCurrentUser();
+    const container = document.getElementById('formula-list');
+    const btn = document.getElementById('formulas-load-more');
+    if (!user || !container || !listCache.formulas.nextCursor) return;
+    if (btn) btn.disabled = true;
+    try {
+        const items = await fetchNextPage('formulas', `/api/formulas/list?username=${encodeURIComponent(user)}`);
+        if (!items) { if (btn) btn.disabled = false; return; }
+        // 只追加新的一页并排版这部分公式，不重排已显示的卡片
+        const wrap = btn ? btn.parentElement : null;
+        const tmp = document.createElement('div');
+        tmp.innerHTML = items.map(formulaCardHtml).join('');
+        const added = Array.from(tmp.children);
+        added.forEach(card => container.insertBefore(card, wrap));
+        if (wrap) wrap.remove();
+        if (listCache.formulas.nextCursor) container.insertAdjacentHTML('beforeend', loadMoreHtml('formulas-load-more', 'Formulas.loadMoreFormulas()'));
+        if (window.MathJax) MathJax.typesetPromise(added);
+    } catch(e) {
+        if (btn) btn.disabled = false;
+    }
+}
+
+function formulaCardHtml(f) {
+    const displayLatex = normalizeLatex(f.latex);
+    return `
+        <div class="formula-card">
+            <div class="formula-preview">
+                \\[ ${displayLatex} \\]
+            </div>
+            <div class="formula-meta">
+                <span class="formula-note" title="${f.note}">${f.note || "未命名"}</span>
+                <div class="formula-actions">
+                    <button class="btn-icon" title="使用" onclick="useFormula('${encodeURIComponent(displayLatex)}')">
+                        <i class="fa-solid fa-share-from-square"></i>
+                    </button>
+                    <button class="btn-icon" title="编辑" onclick="openEditModal(${f.id}, '${encodeURIComponent(f.latex)}', '${encodeURIComponent(f.note || '')}')">
+                        <i class="fa-solid fa-pen-to-square"></i>
+                    </button>
+                    <button class="btn-icon delete" title="删除" onclick="deleteFormula(${f.id})">
+                        <i class="fa-solid fa-trash"></i>
+                    </button>
+                </div>
+            </div>
+        </div>
+    `;
+}
+
+function renderList(formulas, nextCursor) {
     const container = document.getElementById('formula-list');
 
     // --- 新建卡片 HTML ---
@@ -202,35 +306,10 @@ function renderList(formulas) {
     }
 
     // 有公式时，新建卡片放在第一个
-    const listHtml = formulas.map(f => {
-        const displayLatex = normalizeLatex(f.latex);
-        // ... (转义逻辑保持不变)
-        const safeLatex = f.latex.replace(/'/g, "\\'").replace(/"/g, '&quot;');
-        const safeNote = (f.note || "").replace(/'/g, "\\'").replace(/"/g, '&quot;');
+    const listHtml = formulas.map(formulaCardHtml).join('');
+    const moreHtml = nextCursor ? loadMoreHtml('formulas-load-more', 'Formulas.loadMoreFormulas()') : '';
 
-        return `
-        <div class="formula-card">
-            <div class="formula-preview">
-                \\[ ${displayLatex} \\]
-            </div>
-            <div class="formula-meta">
-                <span class="formula-note" title="${f.note}">${f.note || "未命名"}</span>
-                <div class="formula-actions">
-                    <button class="btn-icon" title="使用" onclick="useFormula('${encodeURIComponent(displayLatex)}')">
-                        <i class="fa-solid fa-share-from-square"></i>
-                    </button>
-                    <button class="btn-icon" title="编辑" onclick="openEditModal(${f.id}, '${encodeURIComponent(f.latex)}', '${encodeURIComponent(f.note || '')}')">
-                        <i class="fa-solid fa-pen-to-square"></i>
-                    </button>
-                    <button class="btn-icon delete" title="删除" onclick="deleteFormula(${f.id})">
-                        <i class="fa-solid fa-trash"></i>
-                    </button>
-                </div>
-            </div>
-        </div>
-    `}).join('');
-
-    container.innerHTML = addCardHtml + listHtml;
+    container.innerHTML = addCardHtml + listHtml + moreHtml;
 
     if (window.MathJax) MathJax.typesetPromise([container]);
 }
@@ -361,18 +440,59 @@ export async function loadAnimationScripts() {
         return;
     }
 
-    listEl.innerHTML = '<div style="text-align:center; padding:2rem; color:var(--text-secondary);"><i class="fa-solid fa-spinner fa-spin"></i> 加载中...</div>';
+    const cache = listCache.scripts;
+    const hasLocal = cache.user === user;
+    if (hasLocal) {
+        if (!listEl.querySelector('.formula-card')) renderScriptsList(cache.items, cache.nextCursor);
+    } else {
+        listEl.innerHTML = '<div style="text-align:center; padding:2rem; color:var(--text-secondary);"><i class="fa-solid fa-spinner fa-spin"></i> 加载中...</div>';
+    }
     try {
-        const res = await fetch(`/api/animation_scripts/list?username=${encodeURIComponent(user)}`);
-        const data = await res.json();
-        if (data.status === 'success') renderScriptsList(data.data);
-        else listEl.innerHTML = '<div class="empty-state" style="grid-column:1/-1;">加载失败</div>';
+        const result = await revalidateList('scripts', `/api/animation_scripts/list?username=${encodeURIComponent(user)}`, user);
+        if (result === 'updated') renderScriptsList(cache.items, cache.nextCursor);
+        else if (result === 'error' && !hasLocal) listEl.innerHTML = '<div class="empty-state" style="grid-column:1/-1;">加载失败</div>';
     } catch (e) {
-        listEl.innerHTML = '<div class="empty-state" style="grid-column:1/-1;">网络错误</div>';
+        if (!hasLocal) listEl.innerHTML = '<div class="empty-state" style="grid-column:1/-1;">网络错误</div>';
     }
 }
 
-function renderScriptsList(scripts) {
+export async function loadMoreScripts() {
+    const user = getCurrentUser();
+    const listEl = document.getElementById('animation-scripts-list');
+    const btn = document.getElementById('scripts-load-more');
+    if (!user || !listEl || !listCache.scripts.nextCursor) return;
+    if (btn) btn.disabled = true;
+    try {
+        const items = await fetchNextPage('scripts', `/api/animation_scripts/list?username=${encodeURIComponent(user)}`);
+        if (!items) { if (btn) btn.disabled = false; return; }
+        if (btn) btn.parentElement.remove();
+        listEl.insertAdjacentHTML('beforeend', items.map(scriptCardHtml).join(''));
+        if (listCache.scripts.nextCursor) listEl.insertAdjacentHTML('beforeend', loadMoreHtml('scripts-load-more', 'Formulas.loadMoreScripts()'));
+    } catch (e) {
+        if (btn) btn.disabled = false;
+    }
+}
+
+function scriptCardHtml(s) {
+    const note = (s.note || '未命名').replace(/</g, '&lt;').replace(/>/g, '&gt;');
+    const preview = (s.code_preview || s.code || '').replace(/</g, '&lt;').replace(/>/g, '&gt;').substring(0, 120) + (s.code_preview && s.code_preview.length > 120 ? '...' : '');
+    return `
+        <div class="formula-card">
+            <div class="formula-preview" style="font-size:0.8rem; font-family:monospace; white-space:pre-wrap; text-align:left; justify-content:flex-start;">
+                ${preview}
+            </div>
+            <div class="formula-meta">
+                <span class="formula-note" title="${note}">${note}</span>
+                <div class="formula-actions">
+                    <button class="btn-icon" title="在云端工作台编辑" onclick="Formulas.editScriptInWorkbench(${s.id})"><i class="fa-solid fa-pen-to-square"></i></button>
+                    <button class="btn-icon" title="在云端工作台运行" onclick="Formulas.runScriptInWorkbench(${s.id})"><i class="fa-solid fa-play"></i></button>
+                    <button class="btn-icon delete" title="删除" onclick="Formulas.deleteScript(${s.id})"><i class="fa-solid fa-trash"></i></button>
+                </div>
+            </div>
+        </div>`;
+}
+
+function renderScriptsList(scripts, nextCursor) {
     const listEl = document.getElementById('animation-scripts-list');
     if (!listEl) return;
 
@@ -390,25 +510,9 @@ function renderScriptsList(scripts) {
         return;
     }
 
-    const cards = scripts.map(s => {
-        const note = (s.note || '未命名').replace(/</g, '&lt;').replace(/>/g, '&gt;');
-        const preview = (s.code_preview || s.code || '').replace(/</g, '&lt;').replace(/>/g, '&gt;').substring(0, 120) + (s.code_preview && s.code_preview.length > 120 ? '...' : '');
-        return `
-        <div class="formula-card">
-            <div class="formula-preview" style="font-size:0.8rem; font-family:monospace; white-space:pre-wrap; text-align:left; justify-content:flex-start;">
-                ${preview}
-            </div>
-            <div class="formula-meta">
-                <span class="formula-note" title="${note}">${note}</span>
-                <div class="formula-actions">
-                    <button class="btn-icon" title="在云端工作台编辑" onclick="Formulas.editScriptInWorkbench(${s.id})"><i class="fa-solid fa-pen-to-square"></i></button>
-                    <button class="btn-icon" title="在云端工作台运行" onclick="Formulas.runScriptInWorkbench(${s.id})"><i class="fa-solid fa-play"></i></button>
-                    <button class="btn-icon delete" title="删除" onclick="Formulas.deleteScript(${s.id})"><i class="fa-solid fa-trash"></i></button>
-                </div>
-            </div>
-        </div>`;
-    }).join('');
-    listEl.innerHTML = addCard + cards;
+    const cards = scripts.map(scriptCardHtml).join('');
+    const moreHtml = nextCursor ? loadMoreHtml('scripts-load-more', 'Formulas.loadMoreScripts()') : '';
+    listEl.innerHTML = addCard + cards + moreHtml;
 }
 
 export async function openScriptDetail(id) {
@@ -591,7 +695,9 @@ export async function runScriptFromDetail() {
                     } else if (data.type === 'start' && logEl) {
                         logEl.textContent += (data.message || '') + '\n';
                     } else if (data.type === 'complete' && data.video_url && video) {
-                        video.src = data.video_url + '?t=' + Date.now();
+                        // video_url 带内容哈希，无需再追加时间戳绕过缓存
+                        video.poster = data.preview_url || '';
+                        video.src = data.video_url;
                         video.style.display = 'block';
                         if (logEl) logEl.textContent += '渲染完成。\n';
                     } else if (data.type === 'error' && errEl) {
@@ -0,0 +1,6 @@
+# tests/conftest.py
+"""测试从 html_root 导入 logic 包：python -m pytest tests（在 html_root 下运行）。"""
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
@@ -0,0 +1,116 @@
+# tests/test_dao.py
+"""dao 在 SQLite 后端上的行为：内容去重、键集分页与游标、批量保存/删除、修改时的唯一约束。"""
+import asyncio
+
+import pytest
+
+from logic import dao
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = dao.SQLiteDatabase(str(tmp_path / "test.sqlite3"))
+    run(database.connect())
+    run(database.create_user("alice", "hash-a"))
+    run(database.create_user("bob", "hash-b"))
+    yield database
+    run(database.close())
+
+
+def test_add_formula_dedups_by_content(db):
+    first_id, created = run(db.add_formula("alice", r"x^2", "first"))
+    assert created
+    again_id, created = run(db.add_formula("alice", r"x^2", "second"))
+    assert (again_id, created) == (first_id, False)
+    # 去重只在同一用户内
+    other_id, created = run(db.add_formula("bob", r"x^2", ""))
+    assert created and other_id != first_id
+
+
+def test_add_script_dedups_by_content(db):
+    script_id, created = run(db.add_script("alice", "note", "print(1)"))
+    assert created
+    assert run(db.add_script("alice", "other note", "print(1)")) == (script_id, False)
+    assert run(db.get_script(script_id, "alice"))["note"] == "note"
+    assert run(db.get_script(script_id, "bob")) is None
+
+
+def test_bulk_add_reports_each_item(db):
+    existing_id, _ = run(db.add_formula("alice", "a", ""))
+    results = run(db.bulk_add_formulas("alice", [("a", ""), ("b", ""), ("b", "dup in batch"), ("c", "")]))
+    assert [r["status"] for r in results] == ["duplicate", "created", "duplicate", "created"]
+    assert results[0]["id"] == existing_id
+    assert results[1]["id"] == results[2]["id"]
+    assert len({r["id"] for r in results}) == 3
+    assert run(db.bulk_add_formulas("alice", [])) == []
+
+
+def test_bulk_delete_only_touches_own_rows(db):
+    ids = [r["id"] for r in run(db.bulk_add_scripts("alice", [("code1", ""), ("code2", "")]))]
+    bob_id, _ = run(db.add_script("bob", "", "code3"))
+    results = run(db.bulk_delete_scripts("alice", [ids[0], bob_id, ids[0], 999999]))
+    assert results == [{"id": ids[0], "status": "deleted"},
+                       {"id": bob_id, "status": "not_found"},
+                       {"id": 999999, "status": "not_found"}]
+    assert run(db.get_script(ids[1], "alice")) is not None
+    assert run(db.get_script(bob_id, "bob")) is not None
+
+
+def test_keyset_pagination_walks_all_rows_once(db):
+    # 同一秒内插入：created_at 相同时按 id 区分，不重不漏
+    run(db.bulk_add_formulas("alice", [(f"f{i}", "") for i in range(7)]))
+    run(db.add_formula("bob", "not mine", ""))
+    seen, cursor, pages = [], None, 0
+    while True:
+        rows, cursor = run(db.list_formulas("alice", limit=3, cursor=cursor))
+        seen.extend(r["id"] for r in rows)
+        pages += 1
+        if cursor is None:
+            break
+    assert pages == 3
+    assert len(seen) == len(set(seen)) == 7
+    assert seen == sorted(seen, reverse=True)
+
+
+def test_page_limit_is_clamped(db):
+    run(db.bulk_add_formulas("alice", [(f"f{i}", "") for i in range(3)]))
+    rows, cursor = run(db.list_formulas("alice", limit=0))
+    assert len(rows) == 1 and cursor is not None
+    rows, cursor = run(db.list_scripts("alice"))
+    assert rows == [] and cursor is None
+
+
+def test_invalid_cursor_raises(db):
+    with pytest.raises(dao.InvalidCursor):
+        run(db.list_formulas("alice", cursor="not-a-cursor"))
+    with pytest.raises(dao.InvalidCursor):
+        run(db.list_scripts("alice", cursor=dao.encode_cursor({"created_at": "yesterday", "id": 1})))
+
+
+def test_update_to_existing_content_raises_duplicate(db):
+    a_id, _ = run(db.add_formula("alice", "a", ""))
+    b_id, _ = run(db.add_formula("alice", "b", ""))
+    with pytest.raises(dao.DuplicateContent):
+        run(db.update_formula(b_id, "alice", "a", ""))
+    assert run(db.update_formula(b_id, "alice", "c", "renamed")) == 1
+    # 改成新内容后，原内容可以再次保存
+    assert run(db.add_formula("alice", "b", ""))[1]
+    assert run(db.update_formula(a_id, "bob", "z", "")) == 0
+
+
+def test_iter_script_codes_batches(db):
+    run(db.bulk_add_scripts("alice", [(f"code{i}", "") for i in range(5)]))
+
+    async def collect():
+        return [code async for code in db.iter_script_codes(batch=2)]
+
+    assert sorted(run(collect())) == [f"code{i}" for i in range(5)]
+
+
+def test_unconnected_database_raises():
+    with pytest.raises(dao.DatabaseUnavailable):
+        run(dao.SQLiteDatabase(":memory:").get_user("alice"))
@@ -15,7 +15,10 @@ CREATE TABLE IF NOT EXISTS formulas (
     user_id VARCHAR(255) NOT NULL, -- 存用户名
     latex TEXT NOT NULL,
     note VARCHAR(255),
+    content_hash CHAR(64) NOT NULL, -- SHA2(latex, 256)，同一用户内去重
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY uq_formulas_user_hash (user_id, content_hash),
+    INDEX idx_formulas_user_created (user_id, created_at, id), -- 列表按 (created_at, id) 倒序分页
     FOREIGN KEY (user_id) REFERENCES users(username) ON DELETE CASCADE
 );
 
@@ -25,6 +28,23 @@ CREATE TABLE IF NOT EXISTS animation_scripts (
     user_id VARCHAR(255) NOT NULL,
     note VARCHAR(255) DEFAULT '',
     code MEDIUMTEXT NOT NULL,
+    content_hash CHAR(64) NOT NULL, -- SHA2(code, 256)
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE KEY uq_scripts_user_hash (user_id, content_hash),
+    INDEX idx_scripts_user_created (user_id, created_at, id),
     FOREIGN KEY (user_id) REFERENCES users(username) ON DELETE CASCADE
-);
\ No newline at end of file
+);
+
+-- 已有数据库升级：补建列表分页用的复合索引
+-- ALTER TABLE formulas ADD INDEX idx_formulas_user_created (user_id, created_at, id);
+-- ALTER TABLE animation_scripts ADD INDEX idx_scripts_user_created (user_id, created_at, id);
+
+-- 已有数据库升级：内容哈希去重列（回填后删除重复行，保留最早一条）
+-- ALTER TABLE formulas ADD COLUMN content_hash CHAR(64) NULL AFTER note;
+-- UPDATE formulas SET content_hash = SHA2(latex, 256);
+-- DELETE f FROM formulas f JOIN formulas g ON f.user_id = g.user_id AND f.content_hash = g.content_hash AND f.id > g.id;
+-- ALTER TABLE formulas MODIFY content_hash CHAR(64) NOT NULL, ADD UNIQUE KEY uq_formulas_user_hash (user_id, content_hash);
+-- ALTER TABLE animation_scripts ADD COLUMN content_hash CHAR(64) NULL AFTER code;
+-- UPDATE animation_scripts SET content_hash = SHA2(code, 256);
+-- DELETE s FROM animation_scripts s JOIN animation_scripts t ON s.user_id = t.user_id AND s.content_hash = t.content_hash AND s.id > t.id;
+-- ALTER TABLE animation_scripts MODIFY content_hash CHAR(64) NOT NULL, ADD UNIQUE KEY uq_scripts_user_hash (user_id, content_hash);